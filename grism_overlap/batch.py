@@ -0,0 +1,182 @@
+"""
+Run the SOSS contamination calculation for a list of targets.
+
+Calling grism_overlap_soss_contam in a loop reloads the PSF, spot mask,
+SIAF and source catalogs for every target and only parallelizes within a
+target.  run_batch loads the shared inputs once, keeps the source catalogs
+on disk next to the results so reruns skip the catalog queries, and runs
+the (target, PA) work units of several targets through one pool of worker
+processes that share the PSF, spot mask and scenes through shared memory.
+
+read_targets:   read a target list from a CSV or JSON file
+
+run_batch:   calculate the contamination of every target at every
+             schedulable PA and write one result file per target plus a
+             summary table
+"""
+import json
+import os
+from multiprocessing import cpu_count
+
+from astropy.table import Table
+import numpy as np
+
+from . import contamination as ct
+from . import grism_overlap_tool as got
+from . import pa_sweep as ps
+from . import scene_image as si
+from . import soss_scene as ss
+from . import visibility as vis
+from .precision import get_dtype
+
+SUMMARY_COLUMNS = ['name', 'ra', 'dec', 'n_pa', 'best_pa', 'min_contam', 'max_contam']
+
+
+def read_targets(target_file):
+    """
+    Read a list of targets.
+
+    Parameters
+    ----------
+    target_file: str
+        A CSV file with ra and dec columns, or a JSON file holding a list
+        of objects with ra and dec keys, both in decimal degrees; an
+        optional name is used for the output files
+
+    Returns
+    -------
+    list
+        The targets as dicts of name, ra and dec
+    """
+    if target_file.endswith('.json'):
+        with open(target_file) as f:
+            rows = json.load(f)
+    else:
+        table = Table.read(target_file, format='ascii.csv')
+        rows = [dict(zip(table.colnames, row)) for row in table]
+
+    targets = []
+    for n, row in enumerate(rows):
+        if 'ra' not in row or 'dec' not in row:
+            raise ValueError('Target {} in {} has no ra and dec.'.format(n, target_file))
+        ra, dec = float(row['ra']), float(row['dec'])
+        name = row.get('name') or '{}_{}'.format(ra, dec)
+        targets.append({'name': str(name), 'ra': ra, 'dec': dec})
+
+    return targets
+
+
+def run_batch(targets, outdir, subarray='SUBSTRIP256', skip_PA=10, nproc=None, chunk_size=None, start=None, end=None, dtype=None):
+    """
+    Calculate the contamination of many targets.
+
+    For every target the contamination ratio of each column of its trace
+    at each schedulable PA (see contamination.contamination_ratio) is
+    written to <outdir>/<name>.npz, with the arrays pa, ratio (PA x
+    column), ra and dec.  The summary table is written to
+    <outdir>/summary.csv.
+
+    Parameters
+    ----------
+    targets: str or list
+        A target file (see read_targets) or a list of target dicts
+    outdir: str
+        The output directory, which also caches the source catalogs
+    subarray: str
+        The subarray, ['FULL', 'SUBSTRIP256', 'SUBSTRIP96']
+    skip_PA: int
+        The PA step in degrees
+    nproc: int
+        The number of worker processes, all cores if None
+    chunk_size: int
+        The number of targets whose scenes are shared with the workers at
+        once, nproc if None; each scene takes 72MB at float32
+    start: str, float, astropy.time.Time
+        The first date to consider for the visibility; today if None
+    end: str, float, astropy.time.Time
+        The last date to consider; a year after start if None
+    dtype: str or type
+        The floating point type of the simulation, float32 or float64;
+        the precision module default if None
+
+    Returns
+    -------
+    astropy.table.Table
+        The summary table, one row per target
+    """
+    if isinstance(targets, str):
+        targets = read_targets(targets)
+    os.makedirs(outdir, exist_ok=True)
+    nproc = nproc or cpu_count()
+    chunk_size = chunk_size or nproc
+
+    # Warm the caches shared by every target
+    si.get_siaf('NIRISS')
+    arrays = {'psfimage': ss.get_psf_image(dtype=get_dtype(dtype)), 'spotmask': ss.get_spotmask()}
+    support = ss.get_psf_support(dtype=get_dtype(dtype))
+
+    radius = got.scene_radius(subarray)
+
+    rows = []
+    for first in range(0, len(targets), chunk_size):
+        chunk = targets[first:first + chunk_size]
+        scenes, tables, apertures, units = {}, [], [], []
+
+        for n, target in enumerate(chunk):
+            ra, dec = target['ra'], target['dec']
+            starname = os.path.join(outdir, '{}_sources.txt'.format(target['name']))
+
+            # Make a scene of only the target and one without it, both
+            # without the background, which is not contamination
+            targ_frame = got.grism_overlap_soss(ra, dec, 0, exclude=np.arange(2, 1000), starname=starname, subarray=subarray, plot=False, dtype=dtype, radius=radius,
+                                                background=0.)
+            mask = ct.trace_mask(targ_frame)
+            apertures.append((mask, ct.aperture_flux(targ_frame, mask)))
+            scenes['scene_{}'.format(n)], star_table = got.prepare_scene(ra, dec, exclude=[0, 1], starname=starname, dtype=dtype, add_background=False,
+                                                                         radius=radius)
+            tables.append(star_table)
+
+            # Only simulate the PAs that can be scheduled
+            pa_grid, allowed = vis.allowed_pas(ra, dec, start=start, end=end)
+            units += [(n, pa) for pa in np.arange(0, 360, skip_PA) if allowed[int(pa)]]
+
+        kwargs = {'subarray': subarray, 'star_tables': tables, 'apertures': apertures, 'support': support}
+        results = ps.run_sweep(_batch_worker, units, arrays={**arrays, **scenes}, kwargs=kwargs, executor='process', nproc=nproc)
+        del scenes
+
+        for n, target in enumerate(chunk):
+            pa_list = np.array([pa for i, pa in units if i == n])
+            ratio = np.array([result for (i, _), result in zip(units, results) if i == n]).reshape(len(pa_list), apertures[n][1].size)
+            np.savez(os.path.join(outdir, '{}.npz'.format(target['name'])), pa=pa_list, ratio=ratio, ra=target['ra'], dec=target['dec'])
+            rows.append(_summarize(target, pa_list, ratio))
+
+    summary = Table(rows=rows, names=SUMMARY_COLUMNS) if rows else Table(names=SUMMARY_COLUMNS)
+    summary.write(os.path.join(outdir, 'summary.csv'), format='ascii.csv', overwrite=True)
+
+    return summary
+
+
+def _batch_worker(unit, psfimage, spotmask, subarray, star_tables, apertures, support=None, **scenes):
+    """
+    Simulate one (target, PA) work unit in a worker process and reduce the
+    frame to the contamination ratio of the target's trace
+    """
+    n, pa = unit
+    frame, _ = got._rotate_disperse_trim_worker(pa, scenes['scene_{}'.format(n)], subarray, star_tables[n], psfimage=psfimage, spotmask=spotmask,
+                                                  support=support, workers=1)
+
+    return ct.contamination_ratio(frame, *apertures[n])
+
+
+def _summarize(target, pa_list, ratio):
+    """
+    Summarize the contamination of a target as the mean ratio at its best
+    PA and the largest ratio at any PA
+    """
+    summary = ct.summarize(pa_list, ratio)
+    if summary['best_pa'] is None:
+        return target['name'], target['ra'], target['dec'], len(pa_list), np.nan, np.nan, np.nan
+
+    best = np.nanmin(summary['mean_ratio'])
+
+    return target['name'], target['ra'], target['dec'], len(pa_list), summary['best_pa'], best, np.nanmax(summary['max_ratio'])
@@ -0,0 +1,297 @@
+"""
+Contamination metrics of the target's spectral trace.
+
+A sweep produces one dispersed frame of the neighbouring sources per PA.
+What is actually used is, for every PA and spectral column, the flux of
+those sources inside the target's trace over the target's own flux there.
+These functions reduce each frame to that ratio as it is simulated, so
+the frames themselves need not be kept.
+
+trace_mask:   the pixels of the target's trace, from a frame of only the
+              target
+
+aperture_flux:   the flux of a frame inside the trace, per column
+
+contamination_ratio:   the contaminating flux over the target flux, per
+                       column
+
+summarize:   summary statistics of the ratios of a sweep
+
+source_contributions:   the contamination ratio that each source adds to
+                        each column, by placing the PSF at its position
+
+contributions_table:   a sparse (PA, source, column) table of those ratios
+                       over a sweep
+
+top_contributors:   the sources that contaminate the most at a PA
+"""
+from astropy.table import Table
+import numpy as np
+
+from . import scene_image as si
+from . import soss_scene as ss
+
+
+def trace_mask(targ_frame, fraction=0.01, floor=1e-4):
+    """
+    Find the target's trace.
+
+    Parameters
+    ----------
+    targ_frame: np.ndarray
+        The dispersed frame of only the target
+    fraction: float
+        The smallest signal, as a fraction of each column's peak, that is
+        part of the trace; the column minimum is taken as the background
+    floor: float
+        Columns whose peak is at or below this fraction of the brightest
+        column's peak, e.g. FFT noise beyond the end of the trace, have no
+        trace
+
+    Returns
+    -------
+    np.ndarray
+        A boolean mask of the trace pixels
+    """
+    signal = targ_frame - np.nanmin(targ_frame, axis=0)
+    peak = np.nanmax(signal, axis=0)
+
+    return (signal >= fraction * peak) & (peak > floor * np.max(peak))
+
+
+def aperture_flux(frame, mask):
+    """
+    Sum a frame inside the trace.
+
+    Parameters
+    ----------
+    frame: np.ndarray
+        A dispersed frame
+    mask: np.ndarray
+        The trace mask, see trace_mask
+
+    Returns
+    -------
+    np.ndarray
+        The flux inside the trace of each column, ignoring NaNs
+    """
+    return np.where(mask & np.isfinite(frame), frame, 0.).sum(axis=0)
+
+
+def contamination_ratio(frame, mask, target_flux):
+    """
+    Calculate the contamination of the target's trace.
+
+    Parameters
+    ----------
+    frame: np.ndarray
+        The dispersed frame of the contaminating sources at one PA
+    mask: np.ndarray
+        The trace mask, see trace_mask
+    target_flux: np.ndarray
+        The target's flux inside the trace of each column, see aperture_flux
+
+    Returns
+    -------
+    np.ndarray
+        The ratio of contaminating to target flux of each column, NaN where
+        the target has no flux
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(target_flux > 0, aperture_flux(frame, mask) / target_flux, np.nan)
+
+
+def summarize(pa_list, ratio, level=0.01):
+    """
+    Summarize the contamination ratios of a sweep.
+
+    Parameters
+    ----------
+    pa_list: sequence
+        The position angles in degrees
+    ratio: np.ndarray
+        The contamination ratio of each PA and column, see
+        contamination_ratio
+    level: float
+        The ratio above which a column counts as contaminated
+
+    Returns
+    -------
+    dict
+        The PAs ('pa'), the ratios ('ratio'), the largest and mean ratio of
+        each PA ('max_ratio', 'mean_ratio'), the number of columns above
+        level at each PA ('n_contaminated'), and the PA with the lowest
+        mean ratio ('best_pa')
+    """
+    pa_list = np.asarray(pa_list)
+    ratio = np.asarray(ratio)
+    summary = {'pa': pa_list, 'ratio': ratio, 'level': level}
+
+    with np.errstate(invalid='ignore'):
+        summary['n_contaminated'] = (ratio > level).sum(axis=1)
+    if ratio.size and np.isfinite(ratio).any():
+        summary['max_ratio'] = np.nanmax(ratio, axis=1)
+        summary['mean_ratio'] = np.nanmean(ratio, axis=1)
+        summary['best_pa'] = pa_list[np.nanargmin(summary['mean_ratio'])]
+    else:
+        summary['max_ratio'] = summary['mean_ratio'] = np.full(len(pa_list), np.nan)
+        summary['best_pa'] = None
+
+    return summary
+
+
+def source_contributions(xpos, ypos, flux, mask, target_flux, psfimage, subarray='SUBSTRIP256', spotmask=None,
+                         throughput=0.8, support=None, threshold=0.):
+    """
+    Calculate the contamination ratio that each source adds to each column.
+
+    Dispersion is linear, so the frame of a point source is the PSF placed
+    at its position, as in the 'same' mode convolution of soss_scene.  Only
+    the part of the PSF that lands on trace rows is summed, so no frame is
+    made.  Sources outside the POM image are not dispersed and add nothing.
+
+    Parameters
+    ----------
+    xpos: np.ndarray
+        The x positions of the sources in the subarray, see
+        soss_scene.subarray_positions
+    ypos: np.ndarray
+        The y positions of the sources in the subarray
+    flux: np.ndarray
+        The flux of each source in the scene
+    mask: np.ndarray
+        The trace mask of the subarray, see trace_mask
+    target_flux: np.ndarray
+        The target's flux inside the trace of each column, see aperture_flux
+    psfimage: np.ndarray
+        The SOSS PSF image
+    subarray: str or sequence
+        One of soss_scene.SUBARRAY_WINDOWS or a (y0, y1, x0, x1) POM image window,
+        used to find the sources in the POM image and on the spot mask
+    spotmask: np.ndarray
+        The 2048x2048 occulting spot mask, or None to ignore it
+    throughput: float
+        The grism throughput value
+    support: sequence
+        The (y0, y1, x0, x1) bounding box of the PSF, see
+        convolution.kernel_support; the whole image if None
+    threshold: float
+        Only keep ratios above this value
+
+    Returns
+    -------
+    index, column, ratio
+        Sparse arrays of the source index, the column and the ratio
+    """
+    # Only the rows that hold part of the trace matter
+    rows = np.flatnonzero(mask.any(axis=1))
+    if len(rows) == 0:
+        return np.array([], dtype=int), np.array([], dtype=int), np.array([])
+    rows = (rows[0], rows[-1] + 1)
+
+    index, column, ratio = [], [], []
+    dispersed = ss.in_field(xpos, ypos, subarray)
+    for n, (x, y, f) in enumerate(zip(np.rint(xpos).astype(int), np.rint(ypos).astype(int), flux)):
+        if not dispersed[n]:
+            continue
+
+        # The output pixels within reach of the PSF support
+        placement = ss.psf_placement(x, y, mask.shape, psfimage.shape, support=support, rows=rows)
+        if placement is None:
+            continue
+        frame_slices, psf_slices = placement
+        x0 = frame_slices[1].start
+
+        # Sources behind the occulting spot are dimmed before dispersion
+        scale = f * throughput * ss.spot_transmission(x, y, subarray, spotmask)
+        column_flux = (psfimage[psf_slices] * mask[frame_slices]).sum(axis=0) * scale
+        with np.errstate(divide='ignore', invalid='ignore'):
+            source_ratio = np.where(target_flux[frame_slices[1]] > 0, column_flux / target_flux[frame_slices[1]], 0.)
+
+        keep = np.flatnonzero(source_ratio > threshold)
+        index.append(np.full(len(keep), n))
+        column.append(keep + x0)
+        ratio.append(source_ratio[keep])
+
+    if not index:
+        return np.array([], dtype=int), np.array([], dtype=int), np.array([])
+
+    return np.concatenate(index), np.concatenate(column), np.concatenate(ratio)
+
+
+def contributions_table(star_table, positions, mask, target_flux, psfimage, threshold=1e-5, **kwargs):
+    """
+    Make a sparse table of the contamination ratio of each source in each
+    column at every PA of a sweep.
+
+    Each source is weighted by the flux it holds in the rotated scene,
+    which rotate_image changes, see scene_image.rotate_sources.
+
+    Parameters
+    ----------
+    star_table: astropy.table.Table
+        The table of sources, with name and flux columns and their xloc
+        and yloc positions in the 4231x4231 scene
+    positions: list
+        The xloc, yloc and PA dict of each PA, as returned by
+        grism_overlap_tool.rotate_disperse_trim
+    mask: np.ndarray
+        The trace mask, see trace_mask
+    target_flux: np.ndarray
+        The target's flux inside the trace of each column
+    psfimage: np.ndarray
+        The SOSS PSF image
+    threshold: float
+        Only keep ratios above this value
+    kwargs: dict
+        Other arguments for source_contributions
+
+    Returns
+    -------
+    astropy.table.Table
+        The PA, source name, column and ratio of every contribution
+    """
+    if not positions:
+        return Table(names=['PA', 'source', 'column', 'ratio'], dtype=[float, str, int, float])
+
+    flux = np.asarray(star_table['flux'])
+    names = np.asarray(star_table['name'])
+    pas, sources, columns, ratios = [], [], [], []
+    for position in positions:
+        rotated = si.rotate_sources(star_table['xloc'], star_table['yloc'], position['PA']).sum(axis=(1, 2))
+        index, column, ratio = source_contributions(position['xloc'], position['yloc'], flux * rotated, mask, target_flux, psfimage,
+                                                    threshold=threshold, **kwargs)
+        pas.append(np.full(len(index), position['PA'], dtype=float))
+        sources.append(names[index])
+        columns.append(column)
+        ratios.append(ratio)
+
+    return Table([np.concatenate(pas), np.concatenate(sources), np.concatenate(columns), np.concatenate(ratios)],
+                 names=['PA', 'source', 'column', 'ratio'])
+
+
+def top_contributors(contributions, pa, count=5):
+    """
+    Find the sources that contaminate the target the most at a PA.
+
+    Parameters
+    ----------
+    contributions: astropy.table.Table
+        The table from contributions_table
+    pa: float
+        The position angle in degrees
+    count: int
+        The number of sources to return
+
+    Returns
+    -------
+    astropy.table.Table
+        The source names and their summed ratio over all columns, largest
+        first
+    """
+    rows = contributions[contributions['PA'] == pa]
+    sources, inverse = np.unique(np.asarray(rows['source']), return_inverse=True)
+    total = np.bincount(inverse.ravel(), weights=np.asarray(rows['ratio']), minlength=len(sources))
+    order = np.argsort(total)[::-1][:count]
+
+    return Table([sources[order], total[order]], names=['source', 'ratio'])
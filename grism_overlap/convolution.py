@@ -0,0 +1,862 @@
+"""
+FFT convolution backends for the scene and dispersion code.
+
+The default backend uses scipy.fft with a pool of worker threads, so a
+single convolution of the scene with a dispersion PSF uses all cores.  If
+pyFFTW is installed it can be selected instead, in which case FFTW plans
+are cached between calls.  The scipy.signal implementation is kept as a
+single threaded reference.
+
+fftconvolve:   convolve two 2-d images with the selected backend
+
+oaconvolve:    overlap-add convolution in blocks chosen so the FFT buffers
+               stay under a memory ceiling
+
+fftconvolve_stack:  convolve a stack of images with one kernel, using a
+                    single kernel spectrum and batched transforms
+
+kernel_spectra:  the spectra of several kernels at one common FFT shape,
+                 for fftconvolve_multi
+
+fftconvolve_multi:  convolve one image with several kernels, using a
+                    single image spectrum
+
+tile_weights:  the tiles of an image axis and their blending weights
+
+tiled_spectra:  the kernel spectra of the tiles of an image, for
+                tiled_convolve
+
+tiled_convolve:  convolve an image with a spatially varying kernel, one
+                 kernel per tile, blending the tiles where they overlap
+
+add_convolved:  add the convolution of a small patch into an image, by
+                FFT or one kernel per pixel, whichever is cheaper
+
+windowed_convolve:  compute only a rectangular window of a 'same' mode
+                    convolution, from the input pixels within kernel reach
+
+kernel_support:  the bounding box of the significant part of a kernel
+
+set_backend:   change the default backend, number of worker threads or
+               FFTW planner effort
+
+get_backend:   return the current backend settings
+
+get_workers:   return the number of threads the FFTs will use
+"""
+import os
+
+import numpy
+from scipy import fft as sp_fft
+from scipy import signal
+
+try:
+    import pyfftw
+    import pyfftw.interfaces.scipy_fft as fftw_fft
+    pyfftw.interfaces.cache.enable()
+except ImportError:
+    pyfftw = None
+    fftw_fft = None
+
+BACKENDS = ['scipy', 'pyfftw', 'signal']
+
+_config = {'backend': 'scipy', 'workers': -1, 'planner_effort': 'FFTW_ESTIMATE', 'max_memory': None}
+
+
+def set_backend(backend=None, workers=None, planner_effort=None, max_memory=None):
+    """
+    Set the default FFT convolution backend.
+
+    Parameters
+    ----------
+    backend: str
+        One of 'scipy', 'pyfftw' or 'signal'
+    workers: int
+        The number of FFT threads; negative values count back from the
+        number of cores, so -1 uses all of them
+    planner_effort: str
+        The FFTW planner effort used by the pyfftw backend, e.g.
+        'FFTW_ESTIMATE' or 'FFTW_MEASURE'
+    max_memory: float
+        The default memory ceiling in bytes for a convolution; larger
+        convolutions switch to the overlap-add mode.  Pass 0 to remove
+        the ceiling.
+
+    Returns
+    -------
+    dict
+        The previous settings, which can be passed back as keywords
+    """
+    previous = get_backend()
+    if backend is not None:
+        _check_backend(backend)
+        _config['backend'] = backend
+    if workers is not None:
+        _config['workers'] = int(workers)
+    if planner_effort is not None:
+        _config['planner_effort'] = planner_effort
+    if max_memory is not None:
+        _config['max_memory'] = max_memory or None
+
+    return previous
+
+
+def get_backend():
+    """
+    Return the current FFT convolution settings.
+
+    Returns
+    -------
+    dict
+        The backend name, worker count, planner effort and memory ceiling
+    """
+    return dict(_config)
+
+
+def get_workers(workers=None):
+    """
+    Resolve a worker setting to a number of threads.
+
+    Parameters
+    ----------
+    workers: int
+        A worker count, or None for the configured default
+
+    Returns
+    -------
+    int
+        The number of threads, at least 1
+    """
+    if workers is None:
+        workers = _config['workers']
+    if workers < 0:
+        workers = (os.cpu_count() or 1) + 1 + workers
+
+    return max(1, workers)
+
+
+def fftconvolve(image, kernel, mode='same', backend=None, workers=None, max_memory=None):
+    """
+    Convolve two 2-d images using FFTs.
+
+    The kernel is first cut down to the pixels that can reach the output
+    (for the 8192x8192 SOSS PSF and a 2322x2322 field in 'same' mode that
+    is the central 4643x4643), the transforms are padded to fast lengths
+    and the product of the two spectra is formed in place.  If the
+    transforms would need more than max_memory bytes the overlap-add mode
+    (oaconvolve) is used instead.
+
+    Parameters
+    ----------
+    image: np.ndarray
+        The 2-d image to convolve
+    kernel: np.ndarray
+        The 2-d kernel (PSF) image
+    mode: str
+        'full', 'same' or 'valid', as for scipy.signal.fftconvolve
+    backend: str
+        The backend for this call, the default from set_backend if None
+    workers: int
+        The number of FFT threads for this call, the default if None
+    max_memory: float
+        A memory ceiling in bytes for this call, the default if None
+
+    Returns
+    -------
+    np.ndarray
+        The convolved image, in the floating point type of the inputs
+    """
+    backend = backend or _config['backend']
+    _check_backend(backend)
+    starts, outshape = _output_window(image.shape, kernel.shape, mode)
+    if backend == 'signal':
+        return signal.fftconvolve(image, kernel, mode=mode)
+
+    dtype = numpy.result_type(image.dtype, kernel.dtype, numpy.float32)
+
+    # Only the kernel pixels within reach of the output window matter
+    kernel, starts = _crop_kernel(image.shape, kernel, starts, outshape)
+    fshape = _fast_shape(image.shape, kernel.shape)
+
+    max_memory = max_memory or _config['max_memory']
+    if max_memory and _fft_memory(fshape, dtype) > max_memory:
+        return oaconvolve(image, kernel, mode=mode, max_memory=max_memory, backend=backend, workers=workers)
+
+    rfftn, irfftn, options = _fft_functions(backend, workers)
+    spectrum = rfftn(image, fshape, **options)
+    spectrum *= rfftn(kernel, fshape, **options)
+    result = irfftn(spectrum, fshape, **options)
+    del spectrum
+
+    # Cut the requested area out of the full convolution
+    result = result[starts[0]:starts[0] + outshape[0], starts[1]:starts[1] + outshape[1]]
+
+    return numpy.array(result, dtype=dtype)
+
+
+def oaconvolve(image, kernel, mode='same', max_memory=None, backend=None, workers=None):
+    """
+    Convolve two 2-d images by overlap-add, keeping the memory under a ceiling.
+
+    The image is split into blocks, and if that is not enough the output
+    is split into windows as well.  Each block is convolved only with the
+    part of the kernel that can reach the output window, and the results
+    are added into the output.  Block sizes are chosen automatically so
+    that the output plus the FFT buffers of one block fit in max_memory.
+    The result matches fftconvolve to rounding error.
+
+    Parameters
+    ----------
+    image: np.ndarray
+        The 2-d image to convolve
+    kernel: np.ndarray
+        The 2-d kernel (PSF) image
+    mode: str
+        'full', 'same' or 'valid', as for scipy.signal.fftconvolve
+    max_memory: float
+        The memory ceiling in bytes; without one the whole image is done
+        as one block, which is still cheaper than fftconvolve for 'same'
+        because the kernel is cut down to the part within reach
+    backend: str
+        The backend for this call, the default from set_backend if None
+        ('signal' is replaced by 'scipy')
+    workers: int
+        The number of FFT threads for this call, the default if None
+
+    Returns
+    -------
+    np.ndarray
+        The convolved image, in the floating point type of the inputs
+    """
+    backend = backend or _config['backend']
+    _check_backend(backend)
+    if backend == 'signal':
+        backend = 'scipy'
+    rfftn, irfftn, options = _fft_functions(backend, workers)
+
+    dtype = numpy.result_type(image.dtype, kernel.dtype, numpy.float32)
+    starts, outshape = _output_window(image.shape, kernel.shape, mode)
+    blocks = _choose_blocks(image.shape, kernel.shape, outshape, dtype, max_memory)
+    outimage = numpy.zeros(outshape, dtype=dtype)
+
+    # Loop over output windows and image blocks, one axis pair at a time
+    ysteps = _block_steps(image.shape[0], kernel.shape[0], starts[0], outshape[0], *blocks[0])
+    xsteps = _block_steps(image.shape[1], kernel.shape[1], starts[1], outshape[1], *blocks[1])
+    for (ya, yb, yq0, yq1, yo) in ysteps:
+        for (xa, xb, xq0, xq1, xo) in xsteps:
+            block = image[ya:yb, xa:xb]
+            kblock = kernel[yq0:yq1, xq0:xq1]
+            fshape = [sp_fft.next_fast_len(n1 + n2 - 1, real=True) for n1, n2 in zip(block.shape, kblock.shape)]
+            spectrum = rfftn(block, fshape, **options)
+            spectrum *= rfftn(kblock, fshape, **options)
+            result = irfftn(spectrum, fshape, **options)
+            del spectrum
+
+            # Full index of result[0, 0] is (ya + yq0, xa + xq0); add the
+            # part that lands inside the output window
+            _add_overlap(outimage, result, (ya + yq0 - starts[0] - yo[0], xa + xq0 - starts[1] - xo[0]), (yo, xo))
+
+    return outimage
+
+
+def fftconvolve_stack(images, kernel, mode='same', max_memory=None, backend=None, workers=None):
+    """
+    Convolve a stack of 2-d images with the same kernel.
+
+    The kernel spectrum is computed once and the images are transformed
+    together with batched rfftn/irfftn calls over the last two axes.  The
+    number of images per batch is chosen so the FFT buffers stay under
+    max_memory; without a ceiling the whole stack is one batch.
+
+    Parameters
+    ----------
+    images: np.ndarray
+        The (N, H, W) stack of images to convolve
+    kernel: np.ndarray
+        The 2-d kernel (PSF) image
+    mode: str
+        'full', 'same' or 'valid', as for scipy.signal.fftconvolve
+    max_memory: float
+        The memory ceiling in bytes, the set_backend default if None
+    backend: str
+        The backend for this call, the default from set_backend if None
+        ('signal' is replaced by 'scipy')
+    workers: int
+        The number of FFT threads for this call, the default if None
+
+    Returns
+    -------
+    np.ndarray
+        The (N, ...) stack of convolved images
+    """
+    backend = backend or _config['backend']
+    _check_backend(backend)
+    if backend == 'signal':
+        backend = 'scipy'
+    rfftn, irfftn, options = _fft_functions(backend, workers)
+
+    dtype = numpy.result_type(images.dtype, kernel.dtype, numpy.float32)
+    imshape = images.shape[-2:]
+    starts, outshape = _output_window(imshape, kernel.shape, mode)
+    kernel, starts = _crop_kernel(imshape, kernel, starts, outshape)
+    fshape = _fast_shape(imshape, kernel.shape)
+    kspectrum = rfftn(kernel, fshape, **options)
+
+    # Images per batch: one image's FFT buffers each, after the output
+    # stack and the kernel spectrum
+    max_memory = max_memory or _config['max_memory']
+    outimages = numpy.empty((images.shape[0], *outshape), dtype=dtype)
+    nbatch = images.shape[0]
+    if max_memory:
+        spare = max_memory - outimages.nbytes - kspectrum.nbytes
+        nbatch = int(spare // _fft_memory(fshape, dtype))
+        if nbatch < 1:
+            raise ValueError('Cannot fit one image of the stack into {} bytes.'.format(max_memory))
+
+    for first in range(0, images.shape[0], nbatch):
+        last = min(first + nbatch, images.shape[0])
+        spectrum = rfftn(images[first:last], fshape, **options)
+        spectrum *= kspectrum
+        result = irfftn(spectrum, fshape, **options)
+        del spectrum
+        outimages[first:last] = result[:, starts[0]:starts[0] + outshape[0], starts[1]:starts[1] + outshape[1]]
+
+    return outimages
+
+
+def kernel_spectra(imshape, kernels, mode='same', backend=None, workers=None):
+    """
+    Transform several kernels for convolution with images of one shape.
+
+    Each kernel is cut down to the pixels that can reach the output, and
+    all are transformed at the largest padded shape any of them needs, so
+    one image spectrum serves them all (see fftconvolve_multi).
+
+    Parameters
+    ----------
+    imshape: tuple
+        The shape of the 2-d images to convolve
+    kernels: sequence
+        The 2-d kernel (PSF) images
+    mode: str
+        'full', 'same' or 'valid', as for scipy.signal.fftconvolve
+    backend: str
+        The backend for this call, the default from set_backend if None
+        ('signal' is replaced by 'scipy')
+    workers: int
+        The number of FFT threads for this call, the default if None
+
+    Returns
+    -------
+    spectra, fshape, starts, outshapes
+        The kernel spectra, the padded FFT shape, and the start and shape
+        of each output in the padded convolution
+    """
+    backend = backend or _config['backend']
+    _check_backend(backend)
+    if backend == 'signal':
+        backend = 'scipy'
+    rfftn, _, options = _fft_functions(backend, workers)
+
+    cropped, starts, outshapes = [], [], []
+    for kernel in kernels:
+        start, outshape = _output_window(imshape, kernel.shape, mode)
+        kernel, start = _crop_kernel(imshape, kernel, start, outshape)
+        cropped.append(kernel)
+        starts.append(start)
+        outshapes.append(outshape)
+
+    # A padded length that suits the largest kernel suits them all
+    fshape = numpy.max([_fast_shape(imshape, kernel.shape) for kernel in cropped], axis=0).tolist()
+    spectra = [rfftn(kernel, fshape, **options) for kernel in cropped]
+
+    return spectra, fshape, starts, outshapes
+
+
+def fftconvolve_multi(image, kernels=None, mode='same', scales=None, spectra=None, backend=None, workers=None):
+    """
+    Convolve one 2-d image with several kernels.
+
+    The image is transformed once, and each result costs one product and
+    one inverse transform, so N kernels take one forward and N inverse
+    FFTs instead of N of each.  A scale per kernel is applied to the
+    spectrum product, for images that only differ from this one by a
+    constant factor.
+
+    Parameters
+    ----------
+    image: np.ndarray
+        The 2-d image to convolve
+    kernels: sequence
+        The 2-d kernel (PSF) images, not needed with spectra
+    mode: str
+        'full', 'same' or 'valid', as for scipy.signal.fftconvolve
+    scales: sequence
+        A factor for each result, 1 if None
+    spectra: tuple
+        The kernel_spectra of the kernels for images of this shape, e.g.
+        from a cache
+    backend: str
+        The backend for this call, the default from set_backend if None
+        ('signal' is replaced by 'scipy')
+    workers: int
+        The number of FFT threads for this call, the default if None
+
+    Returns
+    -------
+    list
+        The convolved images, in the floating point type of the inputs
+    """
+    backend = backend or _config['backend']
+    _check_backend(backend)
+    if backend == 'signal':
+        backend = 'scipy'
+    rfftn, irfftn, options = _fft_functions(backend, workers)
+
+    if spectra is None:
+        spectra = kernel_spectra(image.shape, kernels, mode=mode, backend=backend, workers=workers)
+    kspectra, fshape, starts, outshapes = spectra
+    if scales is None:
+        scales = [1.] * len(kspectra)
+    dtype = numpy.result_type(image.dtype, kspectra[0].real.dtype, numpy.float32)
+
+    ispectrum = rfftn(image, fshape, **options)
+    outimages = []
+    for kspectrum, scale, start, outshape in zip(kspectra, scales, starts, outshapes):
+        spectrum = ispectrum * kspectrum
+        if scale != 1.:
+            spectrum *= scale
+        result = irfftn(spectrum, fshape, **options)
+        del spectrum
+        outimages.append(numpy.array(result[start[0]:start[0] + outshape[0], start[1]:start[1] + outshape[1]], dtype=dtype))
+
+    return outimages
+
+
+def tile_weights(n, ntiles, overlap=64):
+    """
+    Split an image axis into tiles that overlap by a blending ramp.
+
+    Inside a tile its weight is 1.  Across each edge between two tiles
+    the weight of one falls linearly from 1 to 0 over overlap pixels while
+    the other rises, so the weights of all tiles add up to 1 at every
+    pixel.
+
+    Parameters
+    ----------
+    n: int
+        The number of pixels along the axis
+    ntiles: int
+        The number of tiles
+    overlap: int
+        The width in pixels of the blending ramps
+
+    Returns
+    -------
+    ranges, weights
+        The (start, stop) pixels of each tile, ramps included, and the
+        weight of each of its pixels
+    """
+    edges = numpy.rint(numpy.linspace(0, n, ntiles + 1)).astype(int)
+    if ntiles > 1 and overlap >= numpy.min(numpy.diff(edges)):
+        raise ValueError('A {} pixel overlap does not fit {} tiles of {} pixels.'.format(overlap, ntiles, n))
+    half = -(-overlap // 2)
+    pixels = numpy.arange(n) + 0.5
+
+    # The fraction of each pixel past each edge: 1 before the first, 0
+    # after the last
+    ramps = [numpy.ones(n)]
+    for edge in edges[1:-1]:
+        if overlap > 0:
+            ramps.append(numpy.clip((pixels - edge + overlap / 2) / overlap, 0., 1.))
+        else:
+            ramps.append((pixels > edge).astype(float))
+    ramps.append(numpy.zeros(n))
+
+    ranges, weights = [], []
+    for i in range(ntiles):
+        start, stop = max(0, int(edges[i]) - half), min(n, int(edges[i + 1]) + half)
+        ranges.append((start, stop))
+        weights.append((ramps[i] - ramps[i + 1])[start:stop])
+
+    return ranges, weights
+
+
+def tiled_spectra(imshape, kernels, overlap=64, backend=None, workers=None):
+    """
+    Transform the kernel of every tile of an image once, see tiled_convolve.
+
+    Parameters
+    ----------
+    imshape: tuple
+        The shape of the 2-d images to convolve
+    kernels: np.ndarray
+        The (ny, nx, ky, kx) kernel of each tile
+    overlap: int
+        The width in pixels of the blending ramps between tiles
+    backend: str
+        The backend for this call, the default from set_backend if None
+    workers: int
+        The number of FFT threads for this call, the default if None
+
+    Returns
+    -------
+    tuple
+        The kernel_spectra of the kernels, in row order, for full
+        convolutions of the largest tile
+    """
+    tileshape = [max(stop - start for start, stop in tile_weights(n, ntiles, overlap)[0])
+                 for n, ntiles in zip(imshape, kernels.shape[:2])]
+
+    return kernel_spectra(tileshape, [kernel for row in kernels for kernel in row], mode='full', backend=backend,
+                          workers=workers)
+
+
+def tiled_convolve(image, kernels, overlap=64, mode='same', spectra=None, backend=None, workers=None):
+    """
+    Convolve a 2-d image with a kernel that varies over the image.
+
+    The image is split into a grid of tiles (see tile_weights), each tile
+    is weighted by its blending ramps and convolved with its own kernel,
+    and the results are added into the output.  A source in the core of a
+    tile is convolved with that tile's kernel, and one in a ramp with the
+    weighted sum of the kernels of the tiles that share it.  Tiles without
+    signal are skipped.  With one tile the result matches fftconvolve.
+
+    Parameters
+    ----------
+    image: np.ndarray
+        The 2-d image to convolve
+    kernels: np.ndarray
+        The (ny, nx, ky, kx) kernel of each tile, all of one shape
+    overlap: int
+        The width in pixels of the blending ramps between tiles
+    mode: str
+        'full', 'same' or 'valid', as for scipy.signal.fftconvolve
+    spectra: tuple
+        The tiled_spectra of the kernels for images of this shape, e.g.
+        from a cache
+    backend: str
+        The backend for this call, the default from set_backend if None
+        ('signal' is replaced by 'scipy')
+    workers: int
+        The number of FFT threads for this call, the default if None
+
+    Returns
+    -------
+    np.ndarray
+        The convolved image, in the floating point type of the inputs
+    """
+    kernels = numpy.asarray(kernels)
+    if kernels.ndim != 4:
+        raise ValueError('Expected a (ny, nx, ky, kx) array of kernels, not shape {}.'.format(kernels.shape))
+    (yranges, yweights), (xranges, xweights) = [tile_weights(n, ntiles, overlap)
+                                                for n, ntiles in zip(image.shape, kernels.shape[:2])]
+    if spectra is None:
+        spectra = tiled_spectra(image.shape, kernels, overlap=overlap, backend=backend, workers=workers)
+    kspectra, fshape, kstarts, koutshapes = spectra
+
+    dtype = numpy.result_type(image.dtype, kernels.dtype, numpy.float32)
+    starts, outshape = _output_window(image.shape, kernels.shape[2:], mode)
+    outimage = numpy.zeros(outshape, dtype=dtype)
+
+    for i, ((y0, y1), yweight) in enumerate(zip(yranges, yweights)):
+        for j, ((x0, x1), xweight) in enumerate(zip(xranges, xweights)):
+            tile = image[y0:y1, x0:x1] * numpy.outer(yweight, xweight).astype(dtype)
+            if not tile.any():
+                continue
+
+            # Full index of result[0, 0] is the tile origin
+            n = i * kernels.shape[1] + j
+            result = fftconvolve_multi(tile, spectra=([kspectra[n]], fshape, [kstarts[n]], [koutshapes[n]]),
+                                       backend=backend, workers=workers)[0]
+            _add_overlap(outimage, result, (y0 - starts[0], x0 - starts[1]), ((0, outshape[0]), (0, outshape[1])))
+
+    return outimage
+
+
+def add_convolved(outimage, patch, kernel, offset, scale=1., backend=None, workers=None):
+    """
+    Add the full convolution of a small image patch into a larger image
+    in place.
+
+    A sparse patch is added as one scaled kernel per non-zero pixel, a
+    dense one by FFT convolution, whichever is cheaper.
+
+    Parameters
+    ----------
+    outimage: np.ndarray
+        The 2-d image to add to
+    patch: np.ndarray
+        The 2-d patch to convolve
+    kernel: np.ndarray
+        The 2-d kernel (PSF) image
+    offset: sequence
+        The (y, x) pixel of outimage where the full convolution starts,
+        which may lie outside it; the part outside is dropped
+    scale: float
+        A factor for the convolution, e.g. -1 to subtract it
+    backend: str
+        The FFT backend for this call, the default from set_backend if None
+    workers: int
+        The number of FFT threads for this call, the default if None
+
+    Returns
+    -------
+    np.ndarray
+        The updated image
+    """
+    windows = ((0, outimage.shape[0]), (0, outimage.shape[1]))
+    ys, xs = numpy.nonzero(patch)
+    if len(ys) == 0:
+        return outimage
+
+    fsize = numpy.prod(_fast_shape(patch.shape, kernel.shape))
+    if len(ys) * kernel.size < 3 * fsize * numpy.log2(fsize):
+        for y, x in zip(ys, xs):
+            _add_overlap(outimage, (scale * patch[y, x]) * kernel, (offset[0] + y, offset[1] + x), windows)
+    else:
+        result = fftconvolve(patch, kernel, mode='full', backend=backend, workers=workers)
+        if scale != 1.:
+            result *= scale
+        _add_overlap(outimage, result, tuple(offset), windows)
+
+    return outimage
+
+
+def windowed_convolve(image, kernel, window, support=None, method='auto', backend=None, workers=None, max_memory=None):
+    """
+    Compute one rectangular window of a 'same' mode convolution.
+
+    Only the input pixels that the kernel support can carry into the
+    window are used, so the cost follows the window area plus the kernel
+    support rather than the whole image.  The window is then computed
+    either by FFT convolution of the reduced problem or, when there are
+    few non-zero input pixels, by adding a scaled kernel patch for each.
+
+    Parameters
+    ----------
+    image: np.ndarray
+        The 2-d image to convolve
+    kernel: np.ndarray
+        The 2-d kernel (PSF) image
+    window: sequence
+        The (y0, y1, x0, x1) output pixel ranges, in 'same' mode pixels
+    support: sequence
+        The (y0, y1, x0, x1) kernel pixel ranges to use, as returned by
+        kernel_support; the whole kernel if None
+    method: str
+        'fft', 'direct', or 'auto' to pick the cheaper one
+    backend: str
+        The FFT backend for this call, the default from set_backend if None
+    workers: int
+        The number of FFT threads for this call, the default if None
+    max_memory: float
+        A memory ceiling in bytes for the FFT of the reduced problem, see
+        fftconvolve
+
+    Returns
+    -------
+    np.ndarray
+        The (y1 - y0, x1 - x0) window of the convolved image
+    """
+    if method not in ['auto', 'fft', 'direct']:
+        raise ValueError("Method {} not recognized. Try 'auto', 'fft' or 'direct'".format(method))
+    if support is None:
+        support = (0, kernel.shape[0], 0, kernel.shape[1])
+
+    dtype = numpy.result_type(image.dtype, kernel.dtype, numpy.float32)
+    starts, _ = _output_window(image.shape, kernel.shape, 'same')
+    outimage = numpy.zeros((window[1] - window[0], window[3] - window[2]), dtype=dtype)
+
+    # Window pixels n in full-convolution pixels, reached from input
+    # pixels p = n - q for kernel pixels q in the support
+    pranges, qranges = [], []
+    for axis in range(2):
+        n0, n1 = starts[axis] + window[2 * axis], starts[axis] + window[2 * axis + 1]
+        s0, s1 = support[2 * axis], support[2 * axis + 1]
+        p0, p1 = max(0, n0 - (s1 - 1)), min(image.shape[axis], n1 - s0)
+        if p1 <= p0:
+            return outimage
+        pranges.append((p0, p1))
+        qranges.append((max(s0, n0 - (p1 - 1)), min(s1, n1 - p0)))
+    subimage = image[pranges[0][0]:pranges[0][1], pranges[1][0]:pranges[1][1]]
+    subkernel = kernel[qranges[0][0]:qranges[0][1], qranges[1][0]:qranges[1][1]]
+
+    # Pick the cheaper method: one kernel patch per non-zero pixel, or
+    # three FFTs of the reduced problem
+    ys, xs = numpy.nonzero(subimage)
+    if method == 'auto':
+        fsize = numpy.prod(_fast_shape(subimage.shape, subkernel.shape))
+        method = 'direct' if len(ys) * outimage.size < 3 * fsize * numpy.log2(fsize) else 'fft'
+
+    # Offset of the window within the full convolution of the reduced problem
+    offsets = [starts[axis] + window[2 * axis] - pranges[axis][0] - qranges[axis][0] for axis in range(2)]
+    if method == 'fft':
+        result = fftconvolve(subimage, subkernel, mode='full', backend=backend, workers=workers, max_memory=max_memory)
+        _add_overlap(outimage, result, (-offsets[0], -offsets[1]), ((0, outimage.shape[0]), (0, outimage.shape[1])))
+    else:
+        for y, x in zip(ys, xs):
+            _add_overlap(outimage, subimage[y, x] * subkernel, (y - offsets[0], x - offsets[1]),
+                         ((0, outimage.shape[0]), (0, outimage.shape[1])))
+
+    return outimage
+
+
+def kernel_support(kernel, threshold=0.):
+    """
+    Find the bounding box of the significant part of a kernel.
+
+    Parameters
+    ----------
+    kernel: np.ndarray
+        The 2-d kernel (PSF) image
+    threshold: float
+        Pixels with absolute values at or below this fraction of the peak
+        are ignored; 0 keeps every non-zero pixel, which is exact
+
+    Returns
+    -------
+    tuple
+        The (y0, y1, x0, x1) pixel ranges, empty if the kernel is all zero
+    """
+    values = numpy.abs(kernel)
+    significant = values > threshold * numpy.max(values)
+    rows = numpy.flatnonzero(numpy.any(significant, axis=1))
+    columns = numpy.flatnonzero(numpy.any(significant, axis=0))
+    if len(rows) == 0:
+        return (0, 0, 0, 0)
+
+    return (int(rows[0]), int(rows[-1]) + 1, int(columns[0]), int(columns[-1]) + 1)
+
+
+def _output_window(shape1, shape2, mode):
+    """Return the start and shape of the output in full-convolution pixels"""
+    fullshape = [n1 + n2 - 1 for n1, n2 in zip(shape1, shape2)]
+    if mode == 'full':
+        outshape = fullshape
+    elif mode == 'same':
+        outshape = list(shape1)
+    elif mode == 'valid':
+        outshape = [abs(n1 - n2) + 1 for n1, n2 in zip(shape1, shape2)]
+    else:
+        raise ValueError("Mode {} not recognized. Try 'full', 'same' or 'valid'".format(mode))
+
+    # The output is the centre of the full convolution, as in scipy
+    starts = [(n - m) // 2 for n, m in zip(fullshape, outshape)]
+
+    return starts, outshape
+
+
+def _crop_kernel(imshape, kernel, starts, outshape):
+    """
+    Cut the kernel down to the pixels that can reach the output window and
+    return it with the window start in the cropped full convolution
+    """
+    qranges = [(max(0, start - (n1 - 1)), min(n2, start + nout)) for start, nout, n1, n2
+               in zip(starts, outshape, imshape, kernel.shape)]
+    kernel = kernel[qranges[0][0]:qranges[0][1], qranges[1][0]:qranges[1][1]]
+    starts = [start - q[0] for start, q in zip(starts, qranges)]
+
+    return kernel, starts
+
+
+def _fast_shape(shape1, shape2):
+    """The padded FFT shape for a full convolution"""
+    return [sp_fft.next_fast_len(n1 + n2 - 1, real=True) for n1, n2 in zip(shape1, shape2)]
+
+
+def _fft_memory(fshape, dtype):
+    """
+    Estimate the peak bytes of one FFT convolution of the given padded
+    shape: the padded input, two half-plane spectra and the real inverse
+    """
+    return 4 * int(numpy.prod(fshape)) * numpy.dtype(dtype).itemsize
+
+
+def _block_fshape(nimage, nkernel, block, window):
+    """The padded FFT length for one image block and one output window"""
+    nkern = min(nkernel, block + window - 1)
+    return sp_fft.next_fast_len(min(block, nimage) + nkern - 1, real=True)
+
+
+def _choose_blocks(imshape, kshape, outshape, dtype, max_memory):
+    """
+    Choose (image block, output window) sizes per axis so the output plus
+    the FFT buffers of one block fit in max_memory
+    """
+    sizes = [[imshape[0], outshape[0]], [imshape[1], outshape[1]]]
+    if not max_memory:
+        return sizes
+
+    outbytes = int(numpy.prod(outshape)) * numpy.dtype(dtype).itemsize
+
+    def memory(trial):
+        fshape = [_block_fshape(imshape[i], kshape[i], *trial[i]) for i in range(2)]
+        return outbytes + _fft_memory(fshape, dtype)
+
+    # Halve whichever block or window size lowers the memory most
+    while memory(sizes) > max_memory:
+        trials = []
+        for axis in range(2):
+            for which in range(2):
+                if sizes[axis][which] > 1:
+                    trial = [list(i) for i in sizes]
+                    trial[axis][which] = (trial[axis][which] + 1) // 2
+                    trials.append((memory(trial), trial))
+        if not trials:
+            raise ValueError('Cannot fit the convolution into {} bytes.'.format(max_memory))
+        sizes = min(trials, key=lambda i: i[0])[1]
+
+    return sizes
+
+
+def _block_steps(nimage, nkernel, start, nout, block, window):
+    """
+    List the (image start, image end, kernel start, kernel end, output
+    window) index ranges along one axis
+    """
+    steps = []
+    for o0 in range(0, nout, window):
+        o1 = min(o0 + window, nout)
+        for a in range(0, nimage, block):
+            b = min(a + block, nimage)
+
+            # Kernel pixels q reach full pixels n = p + q inside the window
+            q0 = max(0, start + o0 - (b - 1))
+            q1 = min(nkernel, start + o1 - a)
+            if q1 > q0:
+                steps.append((a, b, q0, q1, (o0, o1)))
+
+    return steps
+
+
+def _add_overlap(outimage, result, offset, windows):
+    """
+    Add a block result into the output window, where offset is the
+    position of result[0, 0] relative to the window origin
+    """
+    (yo0, yo1), (xo0, xo1) = windows
+    ny, nx = yo1 - yo0, xo1 - xo0
+    y0, x0 = max(0, offset[0]), max(0, offset[1])
+    y1, x1 = min(ny, offset[0] + result.shape[0]), min(nx, offset[1] + result.shape[1])
+    if y1 > y0 and x1 > x0:
+        outimage[yo0 + y0:yo0 + y1, xo0 + x0:xo0 + x1] += result[y0 - offset[0]:y1 - offset[0], x0 - offset[1]:x1 - offset[1]]
+
+
+def _check_backend(backend):
+    """Raise a ValueError for unknown or unavailable backends"""
+    if backend not in BACKENDS:
+        raise ValueError('Backend {} not recognized. Try {}'.format(backend, BACKENDS))
+    if backend == 'pyfftw' and pyfftw is None:
+        raise ValueError('The pyfftw backend needs pyFFTW to be installed.')
+
+
+def _fft_functions(backend, workers):
+    """Return the rfftn and irfftn functions and keywords for a backend"""
+    options = {'axes': (-2, -1), 'workers': get_workers(workers)}
+    if backend == 'pyfftw':
+        options['planner_effort'] = _config['planner_effort']
+        return fftw_fft.rfftn, fftw_fft.irfftn, options
+
+    return sp_fft.rfftn, sp_fft.irfftn, options
@@ -11,14 +11,14 @@ in the field.
 
 """
 import os
-from functools import partial
 from pkg_resources import resource_filename
-from multiprocessing.pool import ThreadPool
+from functools import partial
 from multiprocessing import cpu_count
+import threading
 import time
 import sys
 
-from astropy.table import vstack
+from astropy.io import ascii
 from bokeh.plotting import show
 from bokeh.models import LabelSet, ColumnDataSource, Patch
 from hotsoss.plotting import plot_frame
@@ -26,11 +26,18 @@ from mirage.catalogs import create_catalog as cc
 from mirage.catalogs import catalog_generator as cg
 import numpy as np
 
+from . import contamination as ct
+from . import convolution as cv
+from . import pa_sweep as ps
 from . import scene_image as si
+from . import soss_overlap as so
 from . import soss_scene as ss
+from . import visibility as vis
+from . import wfss_overlap as wo
+from . import wfss_scene as ws
 
 
-def grism_overlap_soss_contam(ra, dec, subarray='SUBSTRIP256', skip_PA=10, plot=True, **kwargs):
+def grism_overlap_soss_contam(ra, dec, subarray='SUBSTRIP256', skip_PA=10, plot=True, nthreads=None, workers=None, max_memory=None, stack_size=None, executor='thread', adaptive=False, rtol=0.05, outfile=None, start=None, end=None, checkpoint=None, frames=True, contributions=False, psffile=None, angle=None, **kwargs):
     """
     Generate a contamination figure for all PA values for given coordinates
 
@@ -40,48 +47,325 @@ def grism_overlap_soss_contam(ra, dec, subarray='SUBSTRIP256', skip_PA=10, plot=
         The RA in decimal degrees
     dec: float
         The Declination in decimal degrees
+    nthreads: int
+        The number of PAs to simulate at once; by default the cores left
+        over by the multithreaded FFTs, so one PA at a time when the FFTs
+        use every core
+    workers: int
+        The number of FFT threads per PA, the convolution module default if None
+    max_memory: float
+        A ceiling in bytes for the FFT buffers of each PA, so several PAs
+        can run at once without running out of memory
+    stack_size: int
+        If given, disperse this many PAs at a time with one batched FFT
+        call (see rotate_disperse_trim_stack) instead of a thread per PA;
+        max_memory then bounds the whole batch
+    executor: str
+        How to run PAs concurrently, 'serial', 'thread' or 'process'; the
+        process executor shares the scene, spot mask and PSF with the
+        workers through shared memory (see pa_sweep.run_sweep)
+    adaptive: bool
+        Start from a skip_PA grid and simulate extra PAs only where the
+        contamination ratio changes by more than rtol of its peak between
+        neighbouring PAs, down to 1 degree (see pa_sweep.adaptive_sweep)
+    rtol: float
+        The refinement tolerance of the adaptive sampling
+    outfile: str
+        A .npy file to stream the per-PA frames into as they finish; the
+        frames are then returned as a memory map, so memory does not grow
+        with the number of PAs (in adaptive mode the frames are written
+        once the sampling is done)
+    start: str, float, astropy.time.Time
+        The first date to consider when dropping PAs at which the target
+        cannot be observed; today if None
+    end: str, float, astropy.time.Time
+        The last date to consider; a year after start if None
+    checkpoint: str
+        A directory to save each PA's frame and star table to as it
+        finishes; rerunning with the same inputs and directory only
+        simulates the PAs that are missing (see pa_sweep.Checkpoint)
+    frames: bool
+        Return the per-PA frames, or only the contamination metrics, which
+        take megabytes instead of gigabytes
+    contributions: bool
+        Add a sparse table of the ratio that each source adds to each
+        column at each PA to the metrics ('contributions'), found by placing
+        the PSF at the source positions (see contamination.top_contributors)
+    psffile: str
+        An alternate path to the SOSS PSF image
+    angle: float
+        An optional rotation angle in degrees to apply to the PSF image
 
     Returns
     -------
-    np.ndarray
-        The contamination figure
+    contam_frames, targ_frame, star_table, metrics
+        The contamination frame of each PA (None unless frames), the frame
+        of the target alone, the source positions at each PA, and the
+        contamination metrics (see contamination.summarize), with the
+        ratio of each PA and column inside the target's trace; in adaptive
+        mode the metrics also hold the 1 degree PA grid ('dense_pa') and
+        the ratios interpolated onto it ('dense_ratio')
     """
-    start = time.time()
+    if contributions and subarray not in ss.SUBARRAY_WINDOWS:
+        raise ValueError('Contributions need one of the subarrays {}'.format(list(ss.SUBARRAY_WINDOWS)))
+
+    timer = time.time()
     print('Starting contam calculation...')
 
+    # Only query and project the sources that can reach the subarray
+    kwargs.setdefault('radius', scene_radius(subarray, psffile=psffile, angle=angle))
+
     # Make a scene of only the target
-    targ_frame = grism_overlap_soss(ra, dec, 0, exclude=np.arange(2, 1000), subarray=subarray, plot=False, **kwargs)
+    targ_frame = grism_overlap_soss(ra, dec, 0, exclude=np.arange(2, 1000), subarray=subarray, plot=False, psffile=psffile, angle=angle, **kwargs)
 
-    # Prepare the scene without the target
-    scene_image, star_table = prepare_scene(ra, dec, exclude=[0, 1], **kwargs)
+    # Prepare the scene without the target, leaving the background to the
+    # dispersion, which adds it analytically
+    scene_image, star_table = prepare_scene(ra, dec, exclude=[0, 1], add_background=False, **kwargs)
+    background = kwargs.get('background', 0.1)
+
+    # The dispersed background is in every frame but is not contamination
+    background_frame = 0.
+    if background:
+        background_frame, _ = rotate_disperse_trim(0, np.zeros_like(scene_image), subarray, star_table, angle=angle, psffile=psffile,
+                                                   background=background)
+
+    # Reduce each frame to the contamination of the target's trace
+    mask = ct.trace_mask(targ_frame - background_frame)
+    target_flux = ct.aperture_flux(targ_frame - background_frame, mask)
+
+    def reduce(frame):
+        """The contamination ratio per column"""
+        return ct.contamination_ratio(frame - background_frame, mask, target_flux)
 
     # Exclude PAs where target is not visible to speed up calculation
-    minPA, maxPA, _, _, _, badPAs = using_gtvt(ra, dec, instrument='NIRISS')
+    pa_grid, allowed = vis.allowed_pas(ra, dec, start=start, end=end)
+    badPAs = [int(pa) for pa in pa_grid[~allowed]]
     pa_list = [pa for pa in np.arange(0, 360, skip_PA) if pa not in badPAs]
 
-    # Generate the contamination at each PA (skip some and interpolate for speed)
-    pool = ThreadPool(cpu_count())
-    func = partial(rotate_disperse_trim, scene_image=scene_image, subarray=subarray, star_table=star_table)
-    results = pool.map(func, pa_list)
-    pool.close()
-    pool.join()
-    del pool
+    # A target that is never visible has no contamination to simulate
+    if not pa_list:
+        print('No PA of the target can be scheduled')
+        metrics = ct.summarize(pa_list, np.empty((0, targ_frame.shape[-1])))
+        if adaptive:
+            metrics.update(dense_pa=np.empty(0), dense_ratio=np.empty((0, targ_frame.shape[-1])))
+        if contributions:
+            metrics['contributions'] = ct.contributions_table(star_table, [], mask, target_flux, None)
+        contam_frames = np.empty((0,) + targ_frame.shape, dtype=targ_frame.dtype) if frames else None
+
+        return contam_frames, targ_frame, _positions_table(star_table, []), metrics
+
+    # Worker processes each get one FFT thread unless told otherwise
+    if executor == 'process' and workers is None:
+        workers = 1
+    if nthreads is None:
+        nthreads = max(1, cpu_count() // cv.get_workers(workers))
+    arrays = {'scene_image': scene_image}
+    sweep_kwargs = {'subarray': subarray, 'star_table': star_table, 'workers': workers, 'max_memory': max_memory, 'background': background}
+    if executor == 'process':
+        # The shared PSF is already rotated, and its support is found once
+        # here rather than at every PA
+        arrays['psfimage'] = ss.get_psf_image(psffile, angle, dtype=scene_image.dtype)
+        arrays['spotmask'] = ss.get_spotmask()
+        sweep_kwargs['support'] = ss.get_psf_support(psffile, angle, dtype=scene_image.dtype)
+    else:
+        sweep_kwargs.update(psffile=psffile, angle=angle)
+    if executor == 'process' and background:
+        arrays['background_pattern'] = ss.get_background_pattern(psffile, angle, dtype=scene_image.dtype)
+
+    def sweep(pas):
+        """Generate the contamination at each PA, in order as they finish"""
+        if stack_size is not None:
+            for first in range(0, len(pas), stack_size):
+                yield from rotate_disperse_trim_stack(pas[first:first + stack_size], scene_image, subarray, star_table, angle=angle, psffile=psffile,
+                                                      workers=workers, max_memory=max_memory, background=background)
+        else:
+            yield from ps.iter_sweep(_rotate_disperse_trim_worker, pas, arrays=arrays, kwargs=sweep_kwargs, executor=executor, nproc=nthreads)
+
+    # Reuse the PAs finished by an earlier run with the same inputs
+    if checkpoint is not None:
+        inputs = ps.hash_inputs(scene_image, ra=ra, dec=dec, subarray=subarray, psffile=psffile, angle=angle, **kwargs)
+        compute = sweep
+        sweep = partial(ps.Checkpoint(checkpoint, inputs).run, compute=compute)
+
+    if adaptive:
+        # Refine the skip_PA grid only where the contamination changes
+        sampled = {}
+
+        def evaluate(pas):
+            """The contamination ratio per column, NaN where the target is not visible"""
+            visible = [pa for pa in pas if int(pa) not in badPAs]
+            for pa, (frame, positions) in zip(visible, sweep(visible)):
+                sampled[pa] = {'frame': frame if frames else None, 'positions': positions, 'ratio': reduce(frame)}
+            return [sampled[pa]['ratio'] if pa in sampled else np.full(targ_frame.shape[-1], np.nan) for pa in pas]
+
+        _, _, dense_pas, dense_ratio = ps.adaptive_sweep(evaluate, coarse_step=skip_PA, min_step=1., rtol=rtol)
+        pa_list = sorted(sampled)
+        ratio = np.array([sampled[pa]['ratio'] for pa in pa_list])
+        positions = [sampled[pa]['positions'] for pa in pa_list]
+        contam_frames = None
+        if frames:
+            contam_frames, _, _ = ps.stream_frames(((sampled.pop(pa)['frame'],) for pa in pa_list), len(pa_list), outfile=outfile)
+    else:
+        # Skip some PAs and interpolate for speed, reducing the frames as
+        # they finish
+        contam_frames, ratio, positions = ps.stream_frames(sweep(pa_list), len(pa_list), outfile=outfile, keep=frames, reduce=reduce)
 
     # Add all star locations to star table
-    star_table_final = vstack([i[1] for i in results])
+    star_table_final = _positions_table(star_table, positions)
 
-    # Sum along y-axis to make a plot of wavelength (x-axis) vs. PA
-    contam_frames = np.array([i[0] for i in results])
-    contam_final = np.nansum(contam_frames, axis=1)
+    metrics = ct.summarize(pa_list, ratio)
+    if adaptive:
+        metrics.update(dense_pa=dense_pas, dense_ratio=dense_ratio)
 
-    print('Finished: {}'.format(round(time.time() - start, 3), 's'))
+    # Break the contamination down by source
+    if contributions:
+        psfimage = ss.get_psf_image(psffile, angle, dtype=scene_image.dtype)
+        support = ss.get_psf_support(psffile, angle, dtype=scene_image.dtype)
+        metrics['contributions'] = ct.contributions_table(star_table, positions, mask, target_flux, psfimage, subarray=subarray,
+                                                          spotmask=ss.get_spotmask(), support=support)
+
+    print('Finished: {}'.format(round(time.time() - timer, 3), 's'))
 
     # if plot:
     #     show(plot_frame(final))
 
-    return contam_frames, targ_frame, star_table_final
+    return contam_frames, targ_frame, star_table_final, metrics
+
 
-def rotate_disperse_trim(pa, scene_image, subarray, star_table, angle=None, psffile=None):
+def grism_overlap_wfss_contam(ra, dec, filtername='F150W', grisms=('GR150R', 'GR150C'), x0=955, y0=955, skip_PA=10, nthreads=None, workers=None, max_memory=None, executor='thread', start=None, end=None, level=0.01, **kwargs):
+    """
+    Calculate the contamination of every source in a WFSS field for all PA
+    values and both grisms
+
+    Parameters
+    ----------
+    ra: float
+        The RA in decimal degrees
+    dec: float
+        The Declination in decimal degrees
+    filtername: str
+        The WFSS blocking filter, which also sets the source fluxes
+    grisms: sequence
+        The grisms, 'GR150R' and/or 'GR150C'
+    x0: int
+        The lower left corner x pixel value for the POM image read-out area
+    y0: int
+        The lower left corner y pixel value for the POM image read-out area
+    skip_PA: int
+        The PA step in degrees
+    nthreads: int
+        The number of PAs to simulate at once, as for grism_overlap_soss_contam
+    workers: int
+        The number of FFT threads per PA, the convolution module default if None
+    max_memory: float
+        A ceiling in bytes for the FFT buffers of each PA
+    executor: str
+        How to run PAs concurrently, 'serial', 'thread' or 'process'
+    start: str, float, astropy.time.Time
+        The first date to consider when dropping PAs at which the field
+        cannot be observed; today if None
+    end: str, float, astropy.time.Time
+        The last date to consider; a year after start if None
+    level: float
+        The ratio above which a source counts as contaminated
+    kwargs: dict
+        Other arguments for prepare_scene
+
+    Returns
+    -------
+    star_table, metrics
+        The sources, and a dict of the PAs ('pa'), the grisms ('grisms'),
+        the ratio of contaminating to own flux in the trace box of each
+        source at each PA and grism ('ratio', PA x grism x source, NaN off
+        the detector; see wfss_overlap.source_contamination), and the
+        number of sources above level at each PA and grism
+        ('n_contaminated')
+    """
+    timer = time.time()
+    print('Starting WFSS contam calculation...')
+
+    # Every source but the pointing itself is a target
+    scene_image, star_table = prepare_scene(ra, dec, exclude=[0], add_background=False, filter1=filtername, **kwargs)
+
+    # Only simulate the PAs that can be scheduled
+    pa_grid, allowed = vis.allowed_pas(ra, dec, start=start, end=end)
+    pa_list = [pa for pa in np.arange(0, 360, skip_PA) if allowed[int(pa)]]
+
+    # The PSFs are read once and shared with the workers
+    if executor == 'process' and workers is None:
+        workers = 1
+    if nthreads is None:
+        nthreads = max(1, cpu_count() // cv.get_workers(workers))
+    arrays = {'scene_image': scene_image, 'spotmask': ss.get_spotmask()}
+    for grism in grisms:
+        arrays['psf_' + grism] = ws.get_wfss_psf(filtername, grism, dtype=scene_image.dtype)
+    sweep_kwargs = {'filtername': filtername, 'grisms': list(grisms), 'x0': x0, 'y0': y0, 'star_table': star_table, 'workers': workers,
+                    'max_memory': max_memory}
+
+    results = ps.run_sweep(_wfss_contam_worker, pa_list, arrays=arrays, kwargs=sweep_kwargs, executor=executor, nproc=nthreads)
+    ratio = np.array(results, dtype=np.float32).reshape(len(pa_list), len(grisms), len(star_table))
+
+    with np.errstate(invalid='ignore'):
+        n_contaminated = (ratio > level).sum(axis=2)
+    metrics = {'pa': np.array(pa_list), 'grisms': list(grisms), 'ratio': ratio, 'level': level, 'n_contaminated': n_contaminated}
+
+    print('Finished: {}'.format(round(time.time() - timer, 3), 's'))
+
+    return star_table, metrics
+
+
+def _wfss_contam_worker(pa, scene_image, spotmask, filtername, grisms, x0, y0, star_table, workers=None, max_memory=None, **psfimages):
+    """
+    Rotate the scene once and reduce the dispersed frame of each grism to
+    the contamination of every source
+    """
+    rotated = si.rotate_image(scene_image, pa)
+    xpos, ypos = si.rotate_positions(star_table['xloc'], star_table['yloc'], pa)
+    xpos, ypos = xpos - x0, ypos - y0
+    transmission = ws.spot_transmission(xpos, ypos, spotmask)
+
+    # The pixels the rotation spreads each source over, which hold more
+    # than its flux
+    stamps = si.rotate_sources(star_table['xloc'], star_table['yloc'], pa, shape=scene_image.shape)
+
+    # Transform the field once for all grisms with the shared PSFs, so
+    # process workers never read them again, unless the memory is limited
+    configs = [(filtername, grism) for grism in grisms]
+    if max_memory is None:
+        frames = ws.wfss_scene_multi(rotated, configs, x0, y0, psfimages={config: psfimages['psf_' + config[1]] for config in configs},
+                                     spotmask=spotmask, dtype=scene_image.dtype, workers=workers)
+    else:
+        frames = {(filtername, grism): ws.wfss_scene(rotated, filtername, grism, x0, y0, psfimage=psfimages['psf_' + grism], spotmask=spotmask,
+                                                     dtype=scene_image.dtype, workers=workers, max_memory=max_memory) for grism in grisms}
+
+    ratios = []
+    for config in configs:
+        ratios.append(wo.source_contamination(frames[config], xpos, ypos, star_table['flux'], psfimages['psf_' + config[1]],
+                                              transmission=transmission, stamps=stamps))
+
+    return np.array(ratios)
+
+
+_WORKSPACES = threading.local()
+
+
+def _rotate_disperse_trim_worker(pa, scene_image, subarray, star_table, **kwargs):
+    """
+    Run rotate_disperse_trim with the calling thread's workspace and copy
+    out the trimmed frame so it survives the next PA
+    """
+    workspace = getattr(_WORKSPACES, 'workspace', None)
+    if workspace is None or workspace.dtype != scene_image.dtype:
+        workspace = ss.SossWorkspace(dtype=scene_image.dtype)
+        _WORKSPACES.workspace = workspace
+
+    newimage, positions = rotate_disperse_trim(pa, scene_image, subarray, star_table, workspace=workspace, **kwargs)
+
+    return np.copy(newimage), positions
+
+
+def rotate_disperse_trim(pa, scene_image, subarray, star_table, angle=None, psffile=None, workspace=None, backend=None, workers=None, max_memory=None, psfimage=None, spotmask=None,
+                         support=None, background=0., background_pattern=None):
     """
     Rotate, disperse, and trim the scene image for the given PA
 
@@ -94,43 +378,251 @@ def rotate_disperse_trim(pa, scene_image, subarray, star_table, angle=None, psff
     subarray: str
         The subarray, ['FULL', 'SUBSTRIP256', 'SUBSTRIP96']
     star_table: astropy.table.Table
-        The table of sources
+        The table of sources, which is only read so one table can be
+        shared by concurrent PAs
+    workspace: soss_scene.SossWorkspace
+        Preallocated buffers to reuse; the returned image is then a view
+        into the workspace that the next call overwrites
+    backend: str
+        The FFT convolution backend, the convolution module default if None
+    workers: int
+        The number of FFT threads, the convolution module default if None
+    max_memory: float
+        A ceiling in bytes for the FFT buffers, see soss_scene
+    psfimage: np.ndarray
+        An already loaded SOSS PSF image, used instead of reading psffile
+    spotmask: np.ndarray
+        An already loaded occulting spot mask
+    support: sequence
+        The bounding box of psfimage, see soss_scene
+    background: float
+        The background level of a scene made without one, added as the
+        cached dispersed background pattern (see soss_scene)
+    background_pattern: np.ndarray
+        An already computed background pattern for psfimage and spotmask
 
     Returns
     -------
-    newimage, star_table
-        The rotated, dispersed, and trimmed scene and the modified table of sources
+    newimage, positions
+        The rotated, dispersed, and trimmed scene and a dict of new xloc
+        and yloc arrays of the sources in it and the PA
     """
     print('Generating dispersed image at PA={}'.format(pa))
 
+    if workspace is None:
+        workspace = ss.SossWorkspace(dtype=scene_image.dtype)
+
     # Rotate to the desired PA
     rotated_image = si.rotate_image(scene_image, pa)
 
+    # Subarrays only need their own output pixels, so disperse just those
+    if subarray in ss.SUBARRAY_WINDOWS:
+        newimage = ss.soss_scene(rotated_image, sossoffset=True, angle=angle, psffile=psffile, workspace=workspace, dtype=workspace.dtype,
+                                 backend=backend, workers=workers, max_memory=max_memory, window=subarray, psfimage=psfimage, spotmask=spotmask,
+                                 support=support, background=background, background_pattern=background_pattern)
+        return newimage, _source_positions(star_table, subarray, pa)
+
     # Generate the GR700XD dispersed image from the rotated scene
-    dispersed_image = ss.soss_scene(rotated_image, sossoffset=True, angle=angle, psffile=psffile)
-    fov = np.zeros_like(rotated_image)
-    fov[955:3277, 955:3277] = dispersed_image
+    dispersed_image = ss.soss_scene(rotated_image, sossoffset=True, angle=angle, psffile=psffile, workspace=workspace, dtype=workspace.dtype,
+                                    backend=backend, workers=workers, max_memory=max_memory, psfimage=psfimage, spotmask=spotmask,
+                                    background=background, background_pattern=background_pattern)
+    fov = workspace.embed(dispersed_image)
+
+    return _trim_to_subarray(fov, subarray, star_table, pa)
+
+
+def rotate_disperse_trim_stack(pa_list, scene_image, subarray, star_table, angle=None, psffile=None, backend=None, workers=None, max_memory=None, background=0.):
+    """
+    Rotate, disperse, and trim the scene image for several PAs at once
 
-    # Trim to appropriate size
-    newimage = np.copy(fov)
+    The rotated scenes are stacked and dispersed with one batched FFT call
+    that shares the PSF spectrum, see soss_scene.soss_scene_stack.
+
+    Parameters
+    ----------
+    pa_list: sequence
+        The position angles in degrees
+    max_memory: float
+        A ceiling in bytes for the FFT buffers, which sets how many PAs
+        are transformed together
+
+    All other parameters are as for rotate_disperse_trim.
+
+    Returns
+    -------
+    list
+        The (newimage, positions) result of each PA
+    """
+    print('Generating dispersed images at PA={}'.format(list(pa_list)))
+
+    # Rotate to each PA
+    rotated_images = np.empty((len(pa_list), *scene_image.shape), dtype=scene_image.dtype)
+    for rotated_image, pa in zip(rotated_images, pa_list):
+        rotated_image[:, :] = si.rotate_image(scene_image, pa)
+
+    # Generate the GR700XD dispersed images from the rotated scenes
+    dispersed_images = ss.soss_scene_stack(rotated_images, sossoffset=True, angle=angle, psffile=psffile, dtype=scene_image.dtype,
+                                           backend=backend, workers=workers, max_memory=max_memory, background=background)
+    del rotated_images
+
+    results = []
+    workspace = ss.SossWorkspace(dtype=scene_image.dtype)
+    for dispersed_image, pa in zip(dispersed_images, pa_list):
+        fov = workspace.embed(dispersed_image)
+        newimage, positions = _trim_to_subarray(fov, subarray, star_table, pa)
+        results.append((np.copy(newimage), positions))
+
+    return results
+
+
+def screen_overlap(ra, dec, subarray='SUBSTRIP256', pa_step=0.1, aperture=None, binsize=8, threshold=1e-4, psffile=None, angle=None, **kwargs):
+    """
+    Find the neighbours whose traces may cross the target's trace at each
+    PA from the geometry alone, without dispersing any scene (see
+    soss_overlap.overlap_screen)
+
+    Parameters
+    ----------
+    ra: float
+        The RA in decimal degrees
+    dec: float
+        The Declination in decimal degrees
+    subarray: str
+        The subarray, ['FULL', 'SUBSTRIP256', 'SUBSTRIP96']
+    pa_step: float
+        The PA step in degrees
+    aperture: np.ndarray
+        The boolean trace aperture of the subarray, e.g. from
+        contamination.trace_mask; the target's PSF footprint if None
+    binsize: int
+        The side of the screening grid cells in pixels, 1 for an exact
+        but slower screen
+    threshold: float
+        The fraction of the PSF peak at or below which pixels are ignored
+    psffile: str
+        An alternate path to the SOSS PSF image
+    angle: float
+        An optional PSF rotation angle in degrees
+    kwargs: dict
+        Other arguments for prepare_scene
+
+    Returns
+    -------
+    pa_list, overlaps, star_table
+        The PAs, a (PA, source) boolean array that is True where the
+        source may contaminate the target's trace, and the sources
+    """
+    # The scene's first source is the target
+    kwargs.setdefault('radius', scene_radius(subarray, psffile=psffile, angle=angle))
+    _, star_table = prepare_scene(ra, dec, exclude=[0], add_background=False, **kwargs)
+    target, star_table = star_table[0], star_table[1:]
+
+    psfimage = ss.get_psf_image(psffile, angle)
+    if aperture is None:
+        aperture = so.trace_aperture(target['xloc'], target['yloc'], psfimage, subarray=subarray, threshold=threshold)
+
+    pa_list = np.arange(0., 360., pa_step)
+    overlaps = so.overlap_screen(np.asarray(star_table['xloc']), np.asarray(star_table['yloc']), pa_list, aperture, psfimage,
+                                 subarray=subarray, binsize=binsize, threshold=threshold)
+
+    return pa_list, overlaps, star_table
+
+
+def _trim_to_subarray(fov, subarray, star_table, pa):
+    """
+    Trim the 4231x4231 dispersed canvas to the subarray and find the
+    source positions in it
+    """
+    newimage = fov
     if subarray in ['FULL', 'SUBSTRIP256', 'SUBSTRIP96']:
         newimage = newimage[1092:3140, 1092:3140]
-        star_table['xloc'] -= 1092
-        star_table['yloc'] -= 1092
     if subarray in ['SUBSTRIP96', 'SUBSTRIP256']:
         newimage = newimage[-256:, :]
-        star_table['xloc'] -= 1792
-        star_table['yloc'] -= 1792
     if subarray == 'SUBSTRIP96':
         newimage = newimage[:96, :]
 
-    # Add PA to star table
-    star_table['PA'] = pa
+    return newimage, _source_positions(star_table, subarray, pa)
+
+
+def _source_positions(star_table, subarray, pa):
+    """
+    Rotate the scene positions of the sources to the PA and shift them to
+    the subarray, as new arrays so the table itself is never modified
+    """
+    xloc, yloc = si.rotate_positions(star_table['xloc'], star_table['yloc'], pa)
+
+    xloc, yloc = ss.subarray_positions(xloc, yloc, _frame_window(subarray), sossoffset=True)
+
+    return {'xloc': xloc, 'yloc': yloc, 'PA': pa}
+
+
+def _frame_window(subarray):
+    """
+    The POM image window of a trimmed frame; without a subarray the frame
+    is the whole 4231x4231 canvas, whose POM area starts at 955
+    """
+    return subarray if subarray in ss.SUBARRAY_WINDOWS else (-955, None, -955, None)
+
+
+def update_frame(frame, star_table, pa, subarray='SUBSTRIP256', add=None, remove=None, angle=None, psffile=None):
+    """
+    Add or remove the dispersed light of some sources in a frame from
+    rotate_disperse_trim, in place, without dispersing the scene again
+
+    Parameters
+    ----------
+    frame: np.ndarray
+        The rotated, dispersed, and trimmed scene
+    star_table: astropy.table.Table
+        The table of sources with their scene positions and fluxes
+    pa: float
+        The position angle of the frame in degrees
+    subarray: str
+        The subarray of the frame
+    add: sequence
+        The rows of star_table to add
+    remove: sequence
+        The rows of star_table to remove, e.g. the target
+    angle: float
+        An optional rotation angle in degrees to apply to the PSF image
+    psffile: str
+        An alternate path to the SOSS PSF image
+
+    Returns
+    -------
+    np.ndarray
+        The updated frame
+    """
+    for rows, sign in [(add, 1.), (remove, -1.)]:
+        if rows is not None and len(rows) > 0:
+            sources = star_table[list(rows)]
+            positions = _source_positions(sources, subarray, pa)
+            stamps = si.rotate_sources(sources['xloc'], sources['yloc'], pa)
+            ss.add_sources(frame, positions['xloc'], positions['yloc'], sign * np.asarray(sources['flux']),
+                           window=_frame_window(subarray), angle=angle, psffile=psffile, stamps=stamps)
+
+    return frame
+
+
+def _positions_table(star_table, positions):
+    """
+    Make one table of the sources at every PA from the base table and the
+    positions returned by rotate_disperse_trim
+    """
+    table = star_table[np.tile(np.arange(len(star_table)), len(positions))]
+    if not positions:
+        table['PA'] = np.empty(0)
+        return table
+
+    table['xloc'] = np.concatenate([i['xloc'] for i in positions])
+    table['yloc'] = np.concatenate([i['yloc'] for i in positions])
+    table['PA'] = np.repeat([i['PA'] for i in positions], len(star_table))
 
-    return newimage, star_table
+    return table
 
 
-def grism_overlap_soss(ra, dec, pa, old=False, exclude=None, starname=None, source_file=None, background=0.1, angle=None, psffile=None, subarray='SUBSTRIP256', plot=True, simple=False, **kwargs):
+def grism_overlap_soss(ra, dec, pa, old=False, exclude=None, starname=None, source_file=None, background=0.1, angle=None, psffile=None, subarray='SUBSTRIP256', plot=True, simple=False, dtype=None, radius=None,
+                       min_flux_ratio=None, min_flux=None, **kwargs):
     """
     Generate contamination image for SOSS mode without using GUI
 
@@ -146,17 +638,31 @@ def grism_overlap_soss(ra, dec, pa, old=False, exclude=None, starname=None, sour
         A source file to use
     background: float
         The background level
+    dtype: str or type
+        The floating point type of the simulation, float32 or float64;
+        the precision module default if None
+    radius: float
+        The catalog radius in arcseconds; by default the smallest that
+        can reach the subarray at any PA, see scene_radius
+    min_flux_ratio: float
+        Leave out sources fainter than this fraction of the target's flux
+    min_flux: float
+        Leave out sources fainter than this many ADU/s
 
     Returns
     -------
     np.ndarray
         The final contamination image
     """
-    # Prepare the scene
-    scene_image, star_table = prepare_scene(ra, dec, old=old, exclude=exclude, starname=starname, source_file=source_file, background=background, simple=simple)
+    # Prepare the scene, leaving the background to the dispersion
+    if radius is None:
+        radius = scene_radius(subarray, psffile=psffile, angle=angle)
+    scene_image, star_table = prepare_scene(ra, dec, old=old, exclude=exclude, starname=starname, source_file=source_file, simple=simple, dtype=dtype,
+                                            add_background=False, radius=radius, min_flux_ratio=min_flux_ratio, min_flux=min_flux)
 
     # Rotate and trim scene
-    newimage, star_table = rotate_disperse_trim(pa, scene_image, subarray, star_table, angle=angle, psffile=psffile)
+    newimage, positions = rotate_disperse_trim(pa, scene_image, subarray, star_table, angle=angle, psffile=psffile, background=background)
+    star_table = _positions_table(star_table, [positions])
 
     # Plot
     if plot:
@@ -172,7 +678,8 @@ def grism_overlap_soss(ra, dec, pa, old=False, exclude=None, starname=None, sour
     return newimage
 
 
-def prepare_scene(ra, dec, old=False, exclude=None, starname=None, source_file=None, background=0.1, simple=False):
+def prepare_scene(ra, dec, old=False, exclude=None, starname=None, source_file=None, background=0.1, simple=False, dtype=None, add_background=True,
+                  min_flux_ratio=None, min_flux=None, radius=None, filter1='F200W'):
     """
     Generate contamination image for SOSS mode without using GUI
 
@@ -188,6 +695,23 @@ def prepare_scene(ra, dec, old=False, exclude=None, starname=None, source_file=N
         A source file to use
     background: float
         The background level
+    dtype: str or type
+        The floating point type of the scene, float32 or float64;
+        the precision module default if None
+    add_background: bool
+        Add the background to the scene, or leave it out so it can be
+        added analytically when the scene is dispersed
+    min_flux_ratio: float
+        Leave out sources fainter than this fraction of the target's flux
+    min_flux: float
+        Leave out sources fainter than this many ADU/s
+    radius: float
+        The radius in arcseconds to query the catalogs to and keep sources
+        within, see scene_radius; 250 and every source in the scene if None.
+        A catalog cached in starname is queried again if it was made for a
+        smaller radius
+    filter1: str
+        The NIRISS filter of the source fluxes
 
     Returns
     -------
@@ -199,14 +723,16 @@ def prepare_scene(ra, dec, old=False, exclude=None, starname=None, source_file=N
 
     if source_file is None:
 
-        # See if file is already generated
-        if not os.path.exists(starname):
+        # See if file is already generated, out to a large enough radius
+        query_radius = radius or 250
+        if not os.path.exists(starname) or (catalog_radius(starname) or 0) < query_radius:
 
             # Make the PSC for these coordinates
             tab = cg.PointSourceCatalog(ra=[ra], dec=[dec])
             filters = ['F277W', 'F356W', 'F380M', 'F430M', 'F444W', 'F480M', 'F090W', 'F115W', 'F158M', 'F140M', 'F150W', 'F200W']
-            cats, filter_names = cc.get_all_catalogs(ra, dec, 250, instrument='niriss', filters=filters)
+            cats, filter_names = cc.get_all_catalogs(ra, dec, query_radius, instrument='niriss', filters=filters)
             tab.add_catalog(cats)
+            tab.table.meta.setdefault('comments', []).append('query_radius = {}'.format(query_radius))
             tab.table.write(starname, format='ascii', overwrite=True)
 
         source_file = starname
@@ -215,20 +741,80 @@ def prepare_scene(ra, dec, old=False, exclude=None, starname=None, source_file=N
 
     # Make the star image
     if old:
-        stars_image, star_table = si.make_star_image(source_file, (ra, dec), filter1='F200W')
+        stars_image, star_table = si.make_star_image(source_file, (ra, dec), filter1=filter1)
     else:
-        stars_image, star_table = si.make_star_image_and_table(source_file, (ra, dec), filter1='F200W', exclude=exclude, simple=simple)
+        stars_image, star_table = si.make_star_image_and_table(source_file, (ra, dec), filter1=filter1, exclude=exclude, simple=simple, dtype=dtype,
+                                                               min_flux_ratio=min_flux_ratio, min_flux=min_flux, radius=radius)
 
     # TODO: Make galaxy image
     galaxy_image = np.zeros_like(stars_image)
 
-    # Combine star and galaxy images
-    scene_image = stars_image + galaxy_image + background
+    # Combine star and galaxy images, adding the background in place so a
+    # numpy float64 background does not promote a float32 scene
+    scene_image = stars_image + galaxy_image
+    if add_background:
+        scene_image += background
 
     return scene_image, star_table
 
 
-def disperse_image(work_image, image_option=1, sossoffset=False, display_option=-1, subarray='FULL'):
+def catalog_radius(starname):
+    """
+    Find the radius a cached source catalog was queried to
+
+    Parameters
+    ----------
+    starname: str
+        The catalog file written by prepare_scene
+
+    Returns
+    -------
+    float, None
+        The query radius in arcseconds, or None if it was not recorded
+    """
+    for comment in ascii.read(starname).meta.get('comments', []):
+        key, _, value = comment.partition('=')
+        if key.strip() == 'query_radius':
+            return float(value)
+
+    return None
+
+
+def scene_radius(subarray='SUBSTRIP256', psffile=None, angle=None, sossoffset=True, margin=10):
+    """
+    Find the smallest catalog radius that covers every source that can
+    reach a subarray at any PA
+
+    Parameters
+    ----------
+    subarray: str
+        The subarray, ['FULL', 'SUBSTRIP256', 'SUBSTRIP96'], or any other
+        value for the whole POM image
+    psffile: str
+        An alternate path to the SOSS PSF image
+    angle: float
+        An optional PSF rotation angle in degrees
+    sossoffset: bool
+        Offset the reference position to the SOSS acquisition position or not
+    margin: float
+        Extra pixels for the rounding of the source positions and the
+        distortion of the projection
+
+    Returns
+    -------
+    float
+        The radius in arcseconds
+    """
+    if subarray in ss.SUBARRAY_WINDOWS:
+        psfimage = ss.get_psf_image(psffile, angle)
+        radius = ss.footprint_radius(subarray, psfimage.shape, ss.get_psf_support(psffile, angle), sossoffset=sossoffset)
+    else:
+        radius = ss.footprint_radius(sossoffset=sossoffset)
+
+    return (radius + margin) * 0.0656
+
+
+def disperse_image(work_image, image_option=1, sossoffset=False, display_option=-1, subarray='FULL', workspace=None):
     """
     Take a rotated unconvolved image and make the output image requested.
 
@@ -236,21 +822,23 @@ def disperse_image(work_image, image_option=1, sossoffset=False, display_option=
     ----------
     work_image:   np.ndarray
         The image to disperse, [4031, 4031]
+    workspace: soss_scene.SossWorkspace
+        Preallocated buffers to reuse between calls
 
     Returns
     -------
     np.ndarray
         The dispersed image
     """
+    if workspace is None:
+        workspace = ss.SossWorkspace(dtype=work_image.dtype)
+
     if image_option == 0:
-        dispersed_image = ss.soss_scene(work_image, sossoffset)
-        big_image = work_image * 0.
-        big_image[955:3277, 955:3277] = dispersed_image
-        extracted = big_image
+        dispersed_image = ss.soss_scene(work_image, sossoffset, workspace=workspace, dtype=workspace.dtype)
+        extracted = workspace.embed(dispersed_image)
     elif image_option == 1:
-        dispersed_image = ss.soss_scene(work_image, sossoffset)
-        big_image = work_image * 0.
-        big_image[955:3277, 955:3277] = dispersed_image
+        dispersed_image = ss.soss_scene(work_image, sossoffset, workspace=workspace, dtype=workspace.dtype)
+        big_image = workspace.embed(dispersed_image)
         extracted = extract_image(big_image, display_option, subarray=subarray)
     else:
         extracted = extract_image(work_image, display_option)
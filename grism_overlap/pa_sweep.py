@@ -0,0 +1,495 @@
+"""
+Machinery for running a calculation over many position angles.
+
+run_sweep:   call a function for every PA in a list, serially, in a
+             thread pool, or in a pool of worker processes
+
+iter_sweep:   the same, yielding the results in order as they finish
+
+Checkpoint:   save each PA's result to a directory with a manifest of
+              the inputs and completed PAs, so a rerun only computes the
+              missing ones
+
+hash_inputs:   a digest of the arrays and parameters of a sweep
+
+stream_frames:   store per-PA frames in a preallocated, optionally
+                 memory-mapped cube as they arrive and reduce them on the fly
+
+SharedArrays:   publish read-only numpy arrays through
+                multiprocessing.shared_memory so worker processes can
+                attach to them without copying or pickling
+
+adaptive_sweep:   sample a PA-dependent metric on a coarse grid, refine
+                  only where it changes, and interpolate to a dense grid
+
+In process mode the large inputs of a sweep (the scene image, the spot
+mask and the 8192x8192 SOSS PSF) are published once and every worker maps
+the same memory, so the sweep scales across cores without the GIL and
+without one copy of the inputs per worker.
+"""
+from functools import partial
+import hashlib
+import json
+from multiprocessing import cpu_count, get_context, shared_memory
+from multiprocessing.pool import ThreadPool
+
+import os
+import pickle
+
+import numpy
+from numpy.lib.format import open_memmap
+
+EXECUTORS = ['serial', 'thread', 'process']
+
+# The arrays and keywords of the sweep, set once in each worker process
+_worker_state = {}
+
+
+class SharedArrays:
+    """
+    Copy a set of arrays into shared memory blocks.
+
+    Use as a context manager; the blocks are released on exit.  The specs
+    attribute is a small picklable description that attach_arrays turns
+    back into arrays in another process.
+
+    Parameters
+    ----------
+    arrays: dict
+        The numpy arrays to publish, by name
+    """
+
+    def __init__(self, arrays):
+        self.blocks = []
+        self.specs = {}
+        for name, array in arrays.items():
+            array = numpy.ascontiguousarray(array)
+            block = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+            shared = numpy.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+            shared[...] = array
+            self.blocks.append(block)
+            self.specs[name] = (block.name, array.shape, array.dtype.str)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Release the shared memory blocks"""
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+
+def attach_arrays(specs):
+    """
+    Attach to arrays published by SharedArrays.
+
+    Parameters
+    ----------
+    specs: dict
+        The specs attribute of a SharedArrays instance
+
+    Returns
+    -------
+    arrays: dict
+        Read-only arrays backed by the shared memory, by name
+    blocks: list
+        The shared memory handles, which must be kept alive as long as
+        the arrays are used
+    """
+    arrays, blocks = {}, []
+    for name, (block_name, shape, dtype) in specs.items():
+        try:
+            block = shared_memory.SharedMemory(name=block_name, track=False)
+        except TypeError:
+            # Python < 3.13 has no track keyword
+            block = shared_memory.SharedMemory(name=block_name)
+        array = numpy.ndarray(shape, dtype=dtype, buffer=block.buf)
+        array.flags.writeable = False
+        arrays[name] = array
+        blocks.append(block)
+
+    return arrays, blocks
+
+
+def run_sweep(func, pa_list, arrays=None, kwargs=None, executor='thread', nproc=None):
+    """
+    Call func(pa, **arrays, **kwargs) for every PA.
+
+    Parameters
+    ----------
+    func: callable
+        The per-PA function; for the process executor it must be a module
+        level function so it can be pickled
+    pa_list: sequence
+        The position angles in degrees
+    arrays: dict
+        Large read-only arrays to pass to every call; in process mode they
+        are shared through shared memory instead of being pickled
+    kwargs: dict
+        Other keyword arguments for every call
+    executor: str
+        'serial', 'thread' or 'process'
+    nproc: int
+        The number of threads or processes, all cores if None
+
+    Returns
+    -------
+    list
+        The results, in the order of pa_list
+    """
+    return list(iter_sweep(func, pa_list, arrays=arrays, kwargs=kwargs, executor=executor, nproc=nproc))
+
+
+def iter_sweep(func, pa_list, arrays=None, kwargs=None, executor='thread', nproc=None):
+    """
+    Like run_sweep, but yield each result as soon as it and the ones before
+    it are done, so the caller can store and drop them one at a time.
+
+    Parameters
+    ----------
+    func: callable
+        The per-PA function
+    pa_list: sequence
+        The position angles in degrees
+    arrays: dict
+        Large read-only arrays to pass to every call
+    kwargs: dict
+        Other keyword arguments for every call
+    executor: str
+        'serial', 'thread' or 'process'
+    nproc: int
+        The number of threads or processes, all cores if None
+
+    Returns
+    -------
+    generator
+        The results, in the order of pa_list
+    """
+    if executor not in EXECUTORS:
+        raise ValueError('Executor {} not recognized. Try {}'.format(executor, EXECUTORS))
+    arrays = arrays or {}
+    kwargs = kwargs or {}
+    nproc = nproc or cpu_count()
+
+    if executor == 'serial' or nproc == 1:
+        return (func(pa, **arrays, **kwargs) for pa in pa_list)
+
+    if executor == 'thread':
+        return _iter_threads(partial(func, **arrays, **kwargs), pa_list, nproc)
+
+    return _iter_processes(func, pa_list, arrays, kwargs, nproc)
+
+
+def _iter_threads(func, pa_list, nproc):
+    """Yield the results of a thread pool in order"""
+    with ThreadPool(nproc) as pool:
+        yield from pool.imap(func, pa_list)
+
+
+def _iter_processes(func, pa_list, arrays, kwargs, nproc):
+    """Yield the results of a process pool in order, sharing the arrays"""
+    with SharedArrays(arrays) as shared:
+        context = get_context()
+        with context.Pool(nproc, initializer=_init_worker, initargs=(func, shared.specs, kwargs)) as pool:
+            yield from pool.imap(_run_worker, pa_list)
+
+
+def hash_inputs(*args, **kwargs):
+    """
+    Digest the inputs of a sweep.
+
+    Parameters
+    ----------
+    args: sequence
+        Arrays, hashed by their dtype, shape and contents
+    kwargs: dict
+        Other parameters, hashed by their repr
+
+    Returns
+    -------
+    str
+        The SHA-256 hex digest
+    """
+    digest = hashlib.sha256()
+    for array in args:
+        array = numpy.ascontiguousarray(array)
+        digest.update('{}{}'.format(array.dtype.str, array.shape).encode())
+        digest.update(array.data)
+    digest.update(repr(sorted(kwargs.items())).encode())
+
+    return digest.hexdigest()
+
+
+class Checkpoint:
+    """
+    Keep the results of a sweep in a directory as they finish.
+
+    Each result is a tuple whose first item is the frame of one PA; the
+    frame is saved as a .npy file and the rest is pickled next to it.
+    manifest.json records the hash of the inputs and the completed PAs, and
+    is rewritten atomically after every PA, so an interrupted sweep can be
+    resumed.  A manifest for other inputs is discarded.
+
+    Parameters
+    ----------
+    directory: str
+        The checkpoint directory, created if needed
+    inputs: str
+        The hash of the sweep inputs, see hash_inputs
+    """
+
+    def __init__(self, directory, inputs):
+        self.directory = directory
+        self.inputs = inputs
+        self.completed = []
+        os.makedirs(directory, exist_ok=True)
+
+        if os.path.isfile(self.manifest):
+            with open(self.manifest) as f:
+                manifest = json.load(f)
+            if manifest.get('inputs') == inputs:
+                self.completed = manifest['completed']
+            else:
+                print('Inputs changed since the checkpoint in {} was written. Starting over.'.format(directory))
+
+    @property
+    def manifest(self):
+        """The path of the manifest file"""
+        return os.path.join(self.directory, 'manifest.json')
+
+    def _path(self, pa, ext):
+        """The path of a saved result"""
+        return os.path.join(self.directory, 'pa_{:08.3f}.{}'.format(float(pa), ext))
+
+    def done(self, pa):
+        """Whether the result of a PA is saved"""
+        return float(pa) in self.completed
+
+    def save(self, pa, result):
+        """Save the result of a PA and record it in the manifest"""
+        frame, *extra = result
+        numpy.save(self._path(pa, 'npy'), frame)
+        with open(self._path(pa, 'pkl'), 'wb') as f:
+            pickle.dump(extra, f)
+
+        if not self.done(pa):
+            self.completed.append(float(pa))
+        temp = self.manifest + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump({'inputs': self.inputs, 'completed': self.completed}, f)
+        os.replace(temp, self.manifest)
+
+    def load(self, pa):
+        """Load the saved result of a PA, the frame memory-mapped"""
+        frame = numpy.load(self._path(pa, 'npy'), mmap_mode='r')
+        with open(self._path(pa, 'pkl'), 'rb') as f:
+            extra = pickle.load(f)
+
+        return (frame, *extra)
+
+    def run(self, pa_list, compute):
+        """
+        Yield the results of every PA in order, loading the saved ones and
+        computing and saving the rest.
+
+        Parameters
+        ----------
+        pa_list: sequence
+            The position angles in degrees
+        compute: callable
+            Takes a list of PAs and returns or yields their results in order
+
+        Returns
+        -------
+        generator
+            The results, in the order of pa_list
+        """
+        missing = [pa for pa in pa_list if not self.done(pa)]
+        if len(missing) < len(pa_list):
+            print('Resuming from {}: {} of {} PAs already done.'.format(self.directory, len(pa_list) - len(missing), len(pa_list)))
+        computed = iter(compute(missing))
+
+        for pa in pa_list:
+            if self.done(pa):
+                yield self.load(pa)
+            else:
+                result = next(computed)
+                self.save(pa, result)
+                yield result
+
+
+def stream_frames(results, count, outfile=None, keep=True, reduce=None):
+    """
+    Store the frames of a sweep in one cube as they arrive.
+
+    The cube is allocated once, when the first frame arrives, either in
+    memory or as a memory-mapped .npy file, and each frame is reduced as it
+    is stored, so the results are never held twice and, with an outfile or
+    without keeping the frames, memory does not grow with the number of PAs.
+
+    Parameters
+    ----------
+    results: iterable
+        Tuples whose first item is the frame of one PA, e.g. from
+        iter_sweep
+    count: int
+        The number of results
+    outfile: str
+        The .npy file to write the cube to, or None to keep it in memory
+    keep: bool
+        Keep the frames, or only their reductions
+    reduce: callable
+        Reduces a frame to an array of fixed shape; the NaN-ignoring sum
+        along y if None
+
+    Returns
+    -------
+    cube: np.ndarray, np.memmap or None
+        The frames, shape (count, ny, nx), if kept
+    reduced: np.ndarray
+        The reduction of each frame, e.g. shape (count, nx)
+    extras: list
+        The remaining items of each result tuple
+    """
+    if reduce is None:
+        def reduce(frame):
+            return numpy.nansum(frame, axis=0)
+
+    cube, reduced, extras = None, None, []
+    for n, (frame, *extra) in enumerate(results):
+        value = numpy.asarray(reduce(frame))
+        if reduced is None:
+            reduced = numpy.empty((count,) + value.shape, dtype=value.dtype)
+            shape = (count,) + frame.shape
+            if keep and outfile is None:
+                cube = numpy.empty(shape, dtype=frame.dtype)
+            elif keep:
+                cube = open_memmap(outfile, mode='w+', dtype=frame.dtype, shape=shape)
+        if cube is not None:
+            cube[n] = frame
+        reduced[n] = value
+        extras.append(extra[0] if len(extra) == 1 else tuple(extra))
+
+    if isinstance(cube, numpy.memmap):
+        cube.flush()
+
+    return cube, reduced, extras
+
+
+def adaptive_sweep(evaluate, coarse_step=10., min_step=1., rtol=0.05, resolution=1., pa_range=(0., 360.)):
+    """
+    Sample a metric of PA adaptively and interpolate it to a dense grid.
+
+    The metric is evaluated on a coarse grid first.  Then every interval
+    between neighbouring PAs where the metric changes by more than rtol
+    times its largest coarse value is split at its midpoint, and this is
+    repeated until no interval wider than min_step needs splitting.  Each
+    round is evaluated as one batch so it can run in parallel.
+
+    Parameters
+    ----------
+    evaluate: callable
+        Takes a list of PAs and returns a list of metric values, scalars
+        or arrays of one shape (e.g. contamination per column); NaN
+        values are never refined around
+    coarse_step: float
+        The spacing of the first pass in degrees
+    min_step: float
+        Intervals this narrow are not split further
+    rtol: float
+        The change between neighbours, as a fraction of the largest
+        coarse metric value, that triggers a refinement
+    resolution: float
+        The spacing of the interpolated output grid in degrees
+    pa_range: sequence
+        The (start, end) PA range; a range of 360 degrees or more is
+        treated as periodic
+
+    Returns
+    -------
+    pas: np.ndarray
+        The PAs that were evaluated, sorted
+    samples: np.ndarray
+        The metric at each evaluated PA
+    dense_pas: np.ndarray
+        The output PA grid
+    curve: np.ndarray
+        The metric linearly interpolated onto dense_pas
+    """
+    start, end = pa_range
+    periodic = end - start >= 360.
+    pas = list(numpy.arange(start, end, coarse_step))
+    if not periodic and pas[-1] < end:
+        pas.append(end)
+    values = dict(zip(pas, evaluate(pas)))
+    tolerance = rtol * numpy.nanmax([numpy.nanmax(numpy.abs(i)) for i in values.values()])
+
+    # Split the intervals over which the metric changes too much
+    while True:
+        ordered = sorted(values)
+        pairs = list(zip(ordered[:-1], ordered[1:]))
+        if periodic:
+            pairs.append((ordered[-1], ordered[0] + 360.))
+        new = []
+        for pa1, pa2 in pairs:
+            change = numpy.abs(numpy.asarray(values[pa2 % 360. if periodic else pa2]) - numpy.asarray(values[pa1]))
+            if (pa2 - pa1 > min_step) and (numpy.nanmax(change) > tolerance):
+                new.append((pa1 + pa2) / 2. % 360. if periodic else (pa1 + pa2) / 2.)
+        if not new:
+            break
+        values.update(zip(new, evaluate(new)))
+
+    pas = numpy.array(sorted(values))
+    samples = numpy.array([values[pa] for pa in pas], dtype=float)
+    dense_pas = numpy.arange(start, end, resolution)
+
+    return pas, samples, dense_pas, interpolate_pa(dense_pas, pas, samples, periodic=periodic)
+
+
+def interpolate_pa(dense_pas, pas, samples, periodic=True):
+    """
+    Linearly interpolate sampled metrics of PA onto other PAs.
+
+    Parameters
+    ----------
+    dense_pas: np.ndarray
+        The PAs to interpolate to
+    pas: np.ndarray
+        The sorted sampled PAs
+    samples: np.ndarray
+        The metric at each sampled PA, with PA along the first axis
+    periodic: bool
+        Wrap around at 360 degrees
+
+    Returns
+    -------
+    np.ndarray
+        The interpolated metric, with PA along the first axis
+    """
+    if periodic:
+        pas = numpy.concatenate([[pas[-1] - 360.], pas, [pas[0] + 360.]])
+        samples = numpy.concatenate([samples[-1:], samples, samples[:1]])
+        dense_pas = numpy.mod(dense_pas - pas[0], 360.) + pas[0]
+
+    index = numpy.clip(numpy.searchsorted(pas, dense_pas, side='right') - 1, 0, len(pas) - 2)
+    weight = (dense_pas - pas[index]) / (pas[index + 1] - pas[index])
+    weight = numpy.clip(weight, 0., 1.).reshape(-1, *[1] * (samples.ndim - 1))
+
+    return samples[index] * (1. - weight) + samples[index + 1] * weight
+
+
+def _init_worker(func, specs, kwargs):
+    """Attach the shared arrays once when a worker process starts"""
+    arrays, blocks = attach_arrays(specs)
+    _worker_state.update(func=func, arrays=arrays, blocks=blocks, kwargs=kwargs)
+
+
+def _run_worker(pa):
+    """Run the sweep function for one PA in a worker process"""
+    state = _worker_state
+    return state['func'](pa, **state['arrays'], **state['kwargs'])
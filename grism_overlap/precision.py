@@ -0,0 +1,63 @@
+"""
+The floating point precision policy for scene images and their dispersion.
+
+Scenes are built as float32 and every later step (background, rotation,
+PSF convolution, trimming) keeps that type, which halves the memory and
+FFT time compared to float64.  Call set_dtype('float64') to run the whole
+pipeline in double precision, or pass dtype= to an individual routine.
+
+get_dtype:   return the data type to use, either the one given or the
+             pipeline default
+
+set_dtype:   change the pipeline default data type
+"""
+import numpy
+
+VALID_DTYPES = (numpy.dtype(numpy.float32), numpy.dtype(numpy.float64))
+
+_default_dtype = numpy.dtype(numpy.float32)
+
+
+def get_dtype(dtype=None):
+    """
+    Return the floating point type to use for a calculation.
+
+    Parameters
+    ----------
+    dtype: str, type, or None
+        An explicit data type, or None for the pipeline default
+
+    Returns
+    -------
+    numpy.dtype
+        Either float32 or float64
+    """
+    if dtype is None:
+        return _default_dtype
+
+    dtype = numpy.dtype(dtype)
+    if dtype not in VALID_DTYPES:
+        raise ValueError('Data type {} not supported. Try {}'.format(dtype, [str(i) for i in VALID_DTYPES]))
+
+    return dtype
+
+
+def set_dtype(dtype):
+    """
+    Set the pipeline default floating point type.
+
+    Parameters
+    ----------
+    dtype: str or type
+        Either float32 (the default) or float64
+
+    Returns
+    -------
+    numpy.dtype
+        The previous default, so it can be restored
+    """
+    global _default_dtype
+    previous = _default_dtype
+    _default_dtype = get_dtype(dtype)
+
+    return previous
@@ -13,6 +13,8 @@ make_star_image:  Make a star scene image from a Mirage star list file, with
                   the PSF assumed to be a single pixel (for later convolution
                   with the real PSF)
 
+faint_sources:  Find the sources too faint to contaminate the target
+
 make_galaxy_image:  Make a galaxy scene image from a Mirage galaxy list file,
                     based on the Sersic parameters
 
@@ -21,6 +23,12 @@ do_convolve:  Convolve the ideal scene image with a suitable NIRISS PSF image
 
 rotate_image:  Use the scipy.ndimage.rotate function to rotate a scene image
 
+rotate_positions:  Find where pixel positions land in an image rotated by
+                   rotate_image
+
+rotate_sources:  Find the pixels rotate_image gives each point source of a
+                 scene
+
 generate_image: Make an ideal star image from a list of stellar positions and
                 total signal values
 
@@ -28,12 +36,15 @@ get_pixel:   Calculate the pixel position of a given (RA, Dec) sky position
              with respect to a given image reference position (RA0, Dec0),
              using pysiaf.
 
+get_siaf:   Load the SIAF of an instrument once and keep it in memory
+
 rel_pos:   Calculate the pixel position of a given (RA, Dec) sky position
            with respect to an given image reference position (RA0, Dec0)
            using direct geometry.
 
 """
 
+from functools import lru_cache
 import math
 
 import astropy.io.fits as fits
@@ -42,11 +53,15 @@ from astropy.io import ascii as ii
 from astropy.coordinates import SkyCoord
 import numpy
 import pysiaf
-import scipy.signal as signal
 import scipy.ndimage as ndimage
+from scipy import special
+
+from . import convolution
+from .precision import get_dtype
 
 
-def generate_image_and_table(star_table, position, rotation=0., simple=False, exclude=None):
+def generate_image_and_table(star_table, position, rotation=0., simple=False, exclude=None,
+                             dtype=None):
     """
     Do the work of making a star scene image.  Each star is one pixel in size.
 
@@ -65,6 +80,9 @@ def generate_image_and_table(star_table, position, rotation=0., simple=False, ex
                    pixel positions, if False use pysiaf.  The latter is the
                    default.
 
+    dtype:         An optional floating point type for the image, float32
+                   or float64; the precision module default if None
+
 
     Returns
     -------
@@ -75,11 +93,10 @@ def generate_image_and_table(star_table, position, rotation=0., simple=False, ex
                      values for the stars within the field
     """
     # Empty image and list of sources to keep
-    scene_image = numpy.zeros((4231, 4231), dtype=numpy.float32)
+    scene_image = numpy.zeros((4231, 4231), dtype=get_dtype(dtype))
     keep = []
 
-    if exclude is None:
-        exclude = []
+    exclude = set() if exclude is None else set(exclude)
 
     # Place each source on the image
     # Index 0 is the center of the frame, not a source
@@ -119,8 +136,48 @@ def generate_image_and_table(star_table, position, rotation=0., simple=False, ex
     return scene_image, new_star_table
 
 
+def faint_sources(flux, reference=None, min_flux_ratio=None, min_flux=None):
+    """
+    Find the sources that are too faint to matter.
+
+    Parameters
+    ----------
+
+    flux:            the source fluxes in ADU/s
+
+    reference:       the flux that min_flux_ratio is relative to, usually
+                     the target's
+
+    min_flux_ratio:  an optional float, sources fainter than this fraction
+                     of the reference flux are faint
+
+    min_flux:        an optional float, sources fainter than this many ADU/s
+                     are faint
+
+    Returns
+    -------
+
+    faint:          the indices of the faint sources
+
+    dropped_flux:   the summed flux of the faint sources, an upper bound on
+                    the flux they would add to any frame
+    """
+    flux = numpy.asarray(flux, dtype=float)
+    threshold = 0.
+    if min_flux_ratio is not None:
+        if reference is None:
+            raise ValueError('A reference flux is needed for min_flux_ratio.')
+        threshold = min_flux_ratio * reference
+    if min_flux is not None:
+        threshold = max(threshold, min_flux)
+
+    faint = numpy.flatnonzero(flux < threshold)
+
+    return faint, flux[faint].sum()
+
+
 def make_star_image_and_table(star_file_name, position, filter1, exclude=None,
-                    simple=False):
+                    simple=False, dtype=None, min_flux_ratio=None, min_flux=None, radius=None):
     """
     Make the star scene image from an input file of positions/brightnesses,
     each star on a single pixel.
@@ -148,6 +205,19 @@ def make_star_image_and_table(star_file_name, position, filter1, exclude=None,
                      sky->pixel calculation, if False, the default, use
                      pysiaf
 
+    dtype:           an optional floating point type for the image, float32
+                     or float64; the precision module default if None
+
+    min_flux_ratio:  an optional float, leave out sources fainter than this
+                     fraction of the target's flux, see faint_sources
+
+    min_flux:        an optional float, leave out sources fainter than this
+                     many ADU/s
+
+    radius:          an optional float, leave out sources further than this
+                     many arcseconds from the centre, before they are
+                     projected onto the image
+
     Returns
     -------
 
@@ -165,7 +235,9 @@ def make_star_image_and_table(star_file_name, position, filter1, exclude=None,
 
     star_list:      A tuple of the [ra, dec, signal] values found within the
                     scene, each element being a numpy array; if no stars are
-                    found in the field then the values are None.
+                    found in the field then the values are None.  The number
+                    of faint sources left out and their summed flux are in
+                    its meta as 'n_pruned' and 'pruned_flux'.
     """
     mag0 = [1.243877e+11, 1.041117e+11, 3.256208e+10, 6.172448e+10,
             2.877868e+10, 4.245261e+10, 2.472333e+10, 1.626810e+10,
@@ -203,8 +275,21 @@ def make_star_image_and_table(star_file_name, position, filter1, exclude=None,
     table['distance'] = [center.separation(SkyCoord(i['x_or_RA'], i['y_or_Dec'], frame='icrs', unit="deg")).arcsecond for i in table]
     table.sort('distance')
 
+    # Leave out the faint sources, keeping the row numbers so exclude still
+    # applies.  The target is the nearest entry after the pointing's own.
+    faint, _ = faint_sources(table['flux'], reference=numpy.max(table['flux'][:2]),
+                             min_flux_ratio=min_flux_ratio, min_flux=min_flux)
+    faint = faint[faint >= 2]
+    exclude = set() if exclude is None else set(exclude)
+    if radius is not None:
+        exclude.update(numpy.flatnonzero(table['distance'] > radius))
+    pruned = numpy.array([idx for idx in faint if idx not in exclude], dtype=int)
+    exclude.update(pruned)
+
     # Generate the image
-    scene_image, new_star_table = generate_image_and_table(table, position, simple=simple, exclude=exclude)
+    scene_image, new_star_table = generate_image_and_table(table, position, simple=simple, exclude=exclude, dtype=dtype)
+    new_star_table.meta['n_pruned'] = len(pruned)
+    new_star_table.meta['pruned_flux'] = float(numpy.sum(table['flux'][pruned]))
 
     return scene_image, new_star_table
 
@@ -463,7 +548,8 @@ def make_galaxy_image(galaxy_file_name, position, filter1, simple=False):
         return None
 
 
-def generate_galaxy_image(galaxy_list, position, rotation=0., simple=False):
+def generate_galaxy_image(galaxy_list, position, rotation=0., simple=False,
+                          dtype=None):
     """
     Do the work of making a galaxies scene image.
 
@@ -484,6 +570,9 @@ def generate_galaxy_image(galaxy_list, position, rotation=0., simple=False):
                    pixel positions, if False use pysiaf.  The latter is the
                    default.
 
+    dtype:         An optional floating point type for the image, float32
+                   or float64; the precision module default if None
+
     Returns
     -------
 
@@ -503,7 +592,7 @@ def generate_galaxy_image(galaxy_list, position, rotation=0., simple=False):
     ellipvalues = galaxy_list[5]
     pavalues = galaxy_list[6] * twopi / 360.0
     indvalues = galaxy_list[7]
-    galaxy_image = numpy.zeros((4231, 4231), dtype=numpy.float32)
+    galaxy_image = numpy.zeros((4231, 4231), dtype=get_dtype(dtype))
     for loop in range(len(indvalues)):
         mod = Sersic2D(amplitude=1., r_eff=radvalues[loop],
                        n=indvalues[loop], x_0=xcen, y_0=ycen,
@@ -554,7 +643,7 @@ def generate_galaxy_image(galaxy_list, position, rotation=0., simple=False):
     return galaxy_image
 
 
-def do_convolve(scene_image, filter1, path):
+def do_convolve(scene_image, filter1, path, backend=None, workers=None):
     """
     Convolve a scene image with a PSF file for the filter name given.
 
@@ -568,22 +657,28 @@ def do_convolve(scene_image, filter1, path):
 
     path:          a string giving the path to the imaging PSF images
 
+    backend:       an optional string, the FFT convolution backend; the
+                   convolution module default if None
+
+    workers:       an optional integer, the number of FFT threads; the
+                   convolution module default if None
+
     Returns
     -------
 
     convolved_image:  a two-dimensional numpy float array of the convolved
-                      image, of the same dimensions are scene_image, or
-                      None is there is an issue.
+                      image, of the same dimensions and type as scene_image,
+                      or None is there is an issue.
     """
     psfname = 'niriss_NIS_x1024_y1024_' + filter1.lower() + '_predicted_0_0p00_0p00.fits'
     if path[-1] != '/':
         path = path + '/'
     try:
-        psf_image = fits.getdata(path + psfname)
+        psf_image = numpy.asarray(fits.getdata(path + psfname), dtype=scene_image.dtype)
     except Exception:
         print('Failed to read PSF image %d.' % (path + psfname))
         return None
-    convolved_image = signal.fftconvolve(scene_image, psf_image, mode='same')
+    convolved_image = convolution.fftconvolve(scene_image, psf_image, mode='same', backend=backend, workers=workers)
     return convolved_image
 
 
@@ -603,8 +698,8 @@ def rotate_image(scene_image, angle):
     Returns:
 
     rotated_image:  a numpy two-dimensional array of float values, of the
-                    same dimensions as the scene_image array, containing the
-                    rotated version of the image
+                    same dimensions and type as the scene_image array,
+                    containing the rotated version of the image
 
     The rotation is done using the scipy ndimage package.
     """
@@ -633,6 +728,125 @@ def rotate_image(scene_image, angle):
     return rotated_image
 
 
+def rotate_positions(xpos, ypos, angle, shape=(4231, 4231)):
+    """
+    Calculate the positions that pixels of an image move to when it is
+    rotated with rotate_image, without rotating any pixels.
+
+    Parameters
+    ----------
+
+    xpos:     a numpy array of float values, the x pixel positions
+
+    ypos:     a numpy array of float values, the y pixel positions
+
+    angle:    a float value, the angle of rotation in degrees
+
+    shape:    a two-element tuple, the shape of the rotated image
+
+    Returns
+    -------
+
+    newx:     a new numpy array of the rotated x positions
+
+    newy:     a new numpy array of the rotated y positions
+    """
+    xpos = numpy.asarray(xpos, dtype=float)
+    ypos = numpy.asarray(ypos, dtype=float)
+    rotangle = angle - math.floor(angle / 360.) * 360.
+    if rotangle == 0.:
+        return xpos.copy(), ypos.copy()
+
+    # Follow ndimage.rotate, which grows the image to hold the rotated
+    # corners, and the crop in rotate_image
+    cosine, sine = math.cos(math.radians(rotangle)), math.sin(math.radians(rotangle))
+    ny, nx = shape
+    bounds = numpy.array([[cosine, sine], [-sine, cosine]]) @ [[0, 0, ny, ny], [0, nx, 0, nx]]
+    outy, outx = (numpy.ptp(bounds, axis=1) + 0.5).astype(int)
+    ycen = (outy - 1) / 2. - (outy - ny) // 2
+    xcen = (outx - 1) / 2. - (outx - nx) // 2
+
+    dy = ypos - (ny - 1) / 2.
+    dx = xpos - (nx - 1) / 2.
+    newy = cosine * dy - sine * dx + ycen
+    newx = sine * dy + cosine * dx + xcen
+
+    return newx, newy
+
+
+def rotate_sources(xpos, ypos, angle, shape=(4231, 4231), radius=16):
+    """
+    Rotate a unit point source at each position the way rotate_image rotates
+    the whole scene, without rotating the scene.
+
+    rotate_image interpolates the scene with an order 5 spline and clips
+    the ringing of the spline around each point source to the scene
+    minimum, so an isolated source holds more flux after a rotation than
+    before.  Its pixels are found here by evaluating the same spline of a
+    single pixel at the same output pixels and clipping them at zero.
+
+    Parameters
+    ----------
+
+    xpos:     a numpy array of float values, the x pixel positions of the
+              sources, each a single pixel of the scene as placed by
+              generate_image_and_table
+
+    ypos:     a numpy array of float values, the y pixel positions
+
+    angle:    a float value, the angle of rotation in degrees
+
+    shape:    a two-element tuple, the shape of the rotated image
+
+    radius:   an integer value, the half width of the stamps in pixels
+
+    Returns
+    -------
+
+    stamps:   a numpy array of shape (N, 2 * radius + 1, 2 * radius + 1),
+              the rotated unit source centred on the pixel nearest to each
+              rotated position (see rotate_positions); its sum is the
+              fraction of the source flux that the rotated scene holds
+    """
+    xpos = numpy.rint(numpy.asarray(xpos, dtype=float)).ravel()
+    ypos = numpy.rint(numpy.asarray(ypos, dtype=float)).ravel()
+    size = 2 * radius + 1
+    stamps = numpy.zeros((len(xpos), size, size))
+    rotangle = angle - math.floor(angle / 360.) * 360.
+    if rotangle == 0.:
+        stamps[:, radius, radius] = 1.
+        return stamps
+
+    # The transform of ndimage.rotate, from the pixels of the cropped
+    # output back to the scene
+    matrix = numpy.array([[special.cosdg(rotangle), special.sindg(rotangle)],
+                          [-special.sindg(rotangle), special.cosdg(rotangle)]])
+    inshape = numpy.array(shape)
+    bounds = matrix @ [[0, 0, shape[0], shape[0]], [0, shape[1], 0, shape[1]]]
+    outshape = (numpy.ptp(bounds, axis=1) + 0.5).astype(int)
+    offset = (inshape - 1) / 2. - matrix @ ((outshape - 1) / 2.) + matrix @ ((outshape - inshape) // 2)
+
+    # The output pixels around each rotated source, as scene pixels
+    # relative to the source
+    newx, newy = rotate_positions(xpos, ypos, rotangle, shape)
+    steps = numpy.arange(size) - radius
+    outy = (numpy.rint(newy)[:, None, None] + steps[None, :, None]) * numpy.ones(size)
+    outx = (numpy.rint(newx)[:, None, None] + steps[None, None, :]) * numpy.ones((size, 1))
+    iny = matrix[0, 0] * outy + matrix[0, 1] * outx + offset[0] - ypos[:, None, None]
+    inx = matrix[1, 0] * outy + matrix[1, 1] * outx + offset[1] - xpos[:, None, None]
+
+    # The spline of a single pixel, with room for its coefficients to
+    # decay to nothing, sampled there
+    margin = 2 * size
+    unit = numpy.zeros((2 * margin + 1, 2 * margin + 1))
+    unit[margin, margin] = 1.
+    coefficients = ndimage.spline_filter(unit, order=5)
+    stamps[:] = ndimage.map_coordinates(coefficients, [iny + margin, inx + margin], order=5, prefilter=False)
+    numpy.maximum(stamps, 0., out=stamps)
+
+    return stamps
+
+
 def generate_image(star_list, position, rotation=0., simple=False):
     """
     Do the work of making a star scene image.  Each star is one pixel in size.
@@ -663,7 +877,7 @@ def generate_image(star_list, position, rotation=0., simple=False):
                      values for the stars within the field
     """
     nout = 0
-    scene_image = numpy.zeros((4231, 4231), dtype=numpy.float32)
+    scene_image = numpy.zeros((4231, 4231), dtype=get_dtype())
     ravalues = star_list[0]
     decvalues = star_list[1]
     signals = star_list[2]
@@ -729,8 +943,7 @@ def get_pixel(ratarget, dectarget, ra0, dec0, rotation, instrument, aperture):
 
     """
     dtor = 3.14159265358979 / 180.
-    siaf_instance = pysiaf.Siaf(instrument)
-    siaf = siaf_instance[aperture]
+    siaf = get_siaf(instrument)[aperture]
     v2_arcsec = siaf.V2Ref
     v3_arcsec = siaf.V3Ref
     v2 = v2_arcsec * dtor / 3600.
@@ -751,6 +964,24 @@ def get_pixel(ratarget, dectarget, ra0, dec0, rotation, instrument, aperture):
     return xpixel, ypixel
 
 
+@lru_cache(maxsize=4)
+def get_siaf(instrument):
+    """
+    Load the SIAF of an instrument, which takes about a second, once per
+    process instead of once per source.
+
+    Parameters
+    ----------
+    instrument:   a string variable giving the instrument name (e.g. 'NIRISS')
+
+    Returns
+    -------
+    pysiaf.Siaf
+        The science instrument aperture file
+    """
+    return pysiaf.Siaf(instrument)
+
+
 def relpos(ra1, dec1, ra0, dec0, rotation, pixelsize):
     """
     Calculate the offset from position (RA0, Dec0) to (RA1, Dec1) in pixels.
@@ -0,0 +1,202 @@
+"""
+A geometry-only screen for SOSS trace overlaps.
+
+Simulating a PA means rotating and dispersing a 4231x4231 scene.  Whether
+a neighbour's traces can cross the target's trace at all only depends on
+where the PSF image is non-zero, so it can be answered for every PA
+without simulating any.  The PSF footprint and the target aperture are
+reduced to coarse boolean grids, and their cross-correlation is computed
+once: it holds, for every offset of a source from the field origin,
+whether the source's footprint touches the aperture.  Screening a PA is
+then a lookup per source.
+
+The grids are conservative: a source whose footprint comes within one
+grid cell of the aperture is flagged, so a source that is not flagged
+cannot contaminate the aperture above the footprint threshold.  With one
+pixel cells the screen is exact.
+
+occupancy:   a coarse boolean grid of where an image is significant
+
+trace_aperture:   the geometric trace of a source in a subarray, from the
+                  PSF footprint at its position
+
+overlap_lookup:   the cross-correlation of an aperture with the PSF
+                  footprint, for overlap_screen
+
+overlap_screen:   which sources may overlap the aperture at each PA
+"""
+import numpy as np
+from scipy import ndimage
+from scipy.signal import fftconvolve
+
+from . import scene_image as si
+from . import soss_scene as ss
+
+
+def occupancy(image, binsize=8, threshold=1e-4):
+    """
+    Find the coarse grid cells that hold a significant pixel.
+
+    Parameters
+    ----------
+    image: np.ndarray
+        A 2-d image, e.g. the PSF
+    binsize: int
+        The side of a grid cell in pixels
+    threshold: float
+        Pixels with absolute values at or below this fraction of the peak
+        are insignificant; a boolean image is used as is
+
+    Returns
+    -------
+    np.ndarray
+        The boolean grid, with the partial cells at the far edges included
+    """
+    if image.dtype == bool:
+        significant = image
+    else:
+        values = np.abs(image)
+        significant = values > threshold * np.max(values)
+
+    ny, nx = (-(-n // binsize) for n in significant.shape)
+    padded = np.zeros((ny * binsize, nx * binsize), dtype=bool)
+    padded[:significant.shape[0], :significant.shape[1]] = significant
+
+    return padded.reshape(ny, binsize, nx, binsize).any(axis=(1, 3))
+
+
+def trace_aperture(xpos, ypos, psfimage, subarray='SUBSTRIP256', threshold=1e-4, sossoffset=True):
+    """
+    Make the geometric trace of a source, where its PSF footprint lands in
+    a subarray.
+
+    Parameters
+    ----------
+    xpos: float
+        The x position of the source in the 4231x4231 scene
+    ypos: float
+        The y position of the source in the scene
+    psfimage: np.ndarray
+        The SOSS PSF image
+    subarray: str or tuple
+        One of soss_scene.SUBARRAY_WINDOWS or a (y0, y1, x0, x1) POM image window
+    threshold: float
+        The fraction of the PSF peak at or below which pixels are ignored
+    sossoffset: bool
+        Offset the reference position to the SOSS acquisition position or not
+
+    Returns
+    -------
+    np.ndarray
+        The boolean aperture of the subarray
+    """
+    window = ss.SUBARRAY_WINDOWS.get(subarray, subarray)
+    shape = (window[1] - window[0], window[3] - window[2])
+    x, y = ss.subarray_positions(xpos, ypos, window, sossoffset=sossoffset)
+
+    aperture = np.zeros(shape, dtype=bool)
+    placement = ss.psf_placement(int(np.rint(x)), int(np.rint(y)), shape, psfimage.shape)
+    if placement is not None:
+        frame_slices, psf_slices = placement
+        values = np.abs(psfimage)
+        aperture[frame_slices] = values[psf_slices] > threshold * np.max(values)
+
+    return aperture
+
+
+def overlap_lookup(aperture, psfimage, subarray='SUBSTRIP256', binsize=8, threshold=1e-4):
+    """
+    Cross-correlate an aperture with the PSF footprint on a coarse grid.
+
+    A source at POM image pixel p covers the pixels p + s - c, for the
+    footprint pixels s and the PSF centre c (see soss_scene.psf_placement).
+    Cell d of the result is True if a source with (p - c) // binsize = d
+    may touch the aperture.
+
+    Parameters
+    ----------
+    aperture: np.ndarray
+        The boolean aperture of the subarray, e.g. from trace_aperture or
+        contamination.trace_mask
+    psfimage: np.ndarray
+        The SOSS PSF image
+    subarray: str or tuple
+        One of soss_scene.SUBARRAY_WINDOWS or a (y0, y1, x0, x1) POM image window
+    binsize: int
+        The side of a grid cell in pixels
+    threshold: float
+        The fraction of the PSF peak at or below which pixels are ignored
+
+    Returns
+    -------
+    lookup, origin
+        The boolean lookup grid and the cell of the grid that holds d = 0
+    """
+    window = ss.SUBARRAY_WINDOWS.get(subarray, subarray)
+    field = np.zeros((2322, 2322), dtype=bool)
+    field[window[0]:window[1], window[2]:window[3]] = aperture
+    grid = occupancy(field, binsize)
+    footprint = occupancy(psfimage, binsize, threshold)
+
+    # Full correlation, with cell i holding d = i - (footprint size - 1)
+    overlap = fftconvolve(grid.astype(float), footprint[::-1, ::-1].astype(float), mode='full') > 0.5
+
+    # A pixel offset within cell d can reach cells d and d + 1 of the grid
+    lookup = overlap
+    if binsize > 1:
+        lookup = ndimage.maximum_filter(overlap, size=2, origin=-1, mode='constant')
+    origin = (footprint.shape[0] - 1, footprint.shape[1] - 1)
+
+    return lookup, origin
+
+
+def overlap_screen(xpos, ypos, pa_list, aperture, psfimage, subarray='SUBSTRIP256', binsize=8, threshold=1e-4,
+                   sossoffset=True):
+    """
+    Find the sources whose traces may overlap an aperture at each PA.
+
+    Parameters
+    ----------
+    xpos: np.ndarray
+        The x positions of the sources in the 4231x4231 scene at PA 0
+    ypos: np.ndarray
+        The y positions of the sources in the scene at PA 0
+    pa_list: sequence
+        The position angles in degrees
+    aperture: np.ndarray
+        The boolean aperture of the subarray, see overlap_lookup
+    psfimage: np.ndarray
+        The SOSS PSF image
+    subarray: str or tuple
+        One of soss_scene.SUBARRAY_WINDOWS or a (y0, y1, x0, x1) POM image window
+    binsize: int
+        The side of a grid cell in pixels
+    threshold: float
+        The fraction of the PSF peak at or below which pixels are ignored
+    sossoffset: bool
+        Offset the reference position to the SOSS acquisition position or not
+
+    Returns
+    -------
+    np.ndarray
+        A (PA, source) boolean array, True where the source may overlap
+    """
+    lookup, origin = overlap_lookup(aperture, psfimage, subarray=subarray, binsize=binsize, threshold=threshold)
+    centre = np.array([(psfimage.shape[0] - 1) // 2, (psfimage.shape[1] - 1) // 2])
+
+    overlaps = np.zeros((len(pa_list), len(xpos)), dtype=bool)
+    for n, pa in enumerate(pa_list):
+
+        # The POM image positions of the sources at this PA
+        x, y = si.rotate_positions(xpos, ypos, pa)
+        x, y = ss.subarray_positions(x, y, (0, 2322, 0, 2322), sossoffset=sossoffset)
+        x, y = np.rint(x).astype(int), np.rint(y).astype(int)
+
+        # Only the POM image is dispersed
+        inside = (x >= 0) & (x < 2322) & (y >= 0) & (y < 2322)
+        i = (y - centre[0]) // binsize + origin[0]
+        j = (x - centre[1]) // binsize + origin[1]
+        inside &= (i >= 0) & (i < lookup.shape[0]) & (j >= 0) & (j < lookup.shape[1])
+        overlaps[n, inside] = lookup[i[inside], j[inside]]
+
+    return overlaps
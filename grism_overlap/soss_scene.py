@@ -2,15 +2,26 @@
 The code here takes a scene image and convolves with the NIRISS SOSS "PSF"
 image to produce a simulated dispersed scene.
 """
+from functools import lru_cache
 from glob import glob
 from pkg_resources import resource_filename
 
 from astropy.io import fits
 import numpy as np
-from scipy import signal, ndimage
+from scipy import ndimage
 
+from . import convolution
+from .precision import get_dtype
 
-def soss_scene(scene_image, sossoffset=True, psffile=None, throughput=0.8, angle=None):
+# Detector subarrays as (y0, y1, x0, x1) windows of the 2322x2322 POM image
+SUBARRAY_WINDOWS = {'FULL': (137, 2185, 137, 2185),
+                    'SUBSTRIP256': (1929, 2185, 137, 2185),
+                    'SUBSTRIP96': (1929, 2025, 137, 2185)}
+
+
+def soss_scene(scene_image, sossoffset=True, psffile=None, throughput=0.8, angle=None,
+               psfimage=None, spotmask=None, workspace=None, dtype=None, backend=None, workers=None,
+               max_memory=None, window=None, psf_threshold=0., support=None, background=0., background_pattern=None):
     """
     Convolve a scene image with the SOSS PSF and return dispersed image over
     the 2322x2322 pixel POM image area. The scene image is multiplied by the
@@ -27,11 +38,49 @@ def soss_scene(scene_image, sossoffset=True, psffile=None, throughput=0.8, angle
         An alternate path to the SOSS PSF image
     throughput: float
         The grism throughput value
+    angle: float
+        An optional rotation angle in degrees to apply to the PSF image
+    psfimage: np.ndarray
+        An already loaded SOSS PSF image, used instead of reading psffile
+    spotmask: np.ndarray
+        An already loaded 2048x2048 occulting spot mask
+    workspace: SossWorkspace
+        Preallocated buffers to build the POM field in; a temporary
+        workspace is used if None
+    dtype: str or type
+        The floating point type of the calculation, float32 or float64;
+        the precision module default if None
+    backend: str
+        The FFT convolution backend, the convolution module default if None
+    workers: int
+        The number of FFT threads, the convolution module default if None
+    max_memory: float
+        A ceiling in bytes for the FFT buffers; the convolution is done in
+        overlap-add blocks when needed to stay under it
+    window: str or sequence
+        Compute only this part of the output, either a subarray name from
+        SUBARRAY_WINDOWS or (y0, y1, x0, x1) POM image pixel ranges; only
+        the input pixels within reach of the PSF are used
+    psf_threshold: float
+        With a window, ignore PSF pixels at or below this fraction of the
+        PSF peak when working out its reach; 0 is exact
+    support: sequence
+        The (y0, y1, x0, x1) bounding box of psfimage above psf_threshold,
+        e.g. from get_psf_support, so a sweep finds it only once; found
+        from the PSF if None
+    background: float
+        A constant background level of the scene, which is added as a
+        multiple of the dispersed background pattern instead of being
+        convolved with the scene (see get_background_pattern)
+    background_pattern: np.ndarray
+        An already computed 2322x2322 background pattern for psfimage and
+        spotmask; computed here if a background is requested with a
+        psfimage or spotmask but no pattern
 
     Returns
     -------
     outimage: np.ndarray
-         The dispersed 2322x2322 scene
+         The dispersed 2322x2322 scene, or the requested window of it
     """
     imshape = scene_image.shape
     if (imshape[0] != 4231) or (imshape[1] != 4231):
@@ -39,10 +88,574 @@ def soss_scene(scene_image, sossoffset=True, psffile=None, throughput=0.8, angle
         return None
 
     # Get the spot mask data
+    cached_spotmask = spotmask is None
+    if cached_spotmask:
+        spotmask = get_spotmask()
+
+    # Get the psf image
+    dtype = get_dtype(dtype)
+    cached_psf = psfimage is None
+    if cached_psf:
+        psfimage = get_psf_image(psffile, angle, dtype=dtype)
+    else:
+        if angle is not None:
+            psfimage = ndimage.rotate(psfimage, angle)
+        psfimage = np.asarray(psfimage, dtype=dtype)
+
+    # Make the final image
+    if workspace is None or workspace.dtype != dtype:
+        workspace = SossWorkspace(dtype=dtype)
+    field_image = workspace.load_field(scene_image, spotmask, sossoffset=sossoffset)
+
+    # Convolve with the psf with the field
+    if window is not None:
+        window = SUBARRAY_WINDOWS.get(window, window)
+        if support is None and cached_psf:
+            support = get_psf_support(psffile, angle, dtype=dtype, threshold=psf_threshold)
+        elif support is None:
+            support = convolution.kernel_support(psfimage, psf_threshold)
+        outimage = convolution.windowed_convolve(field_image, psfimage, window, support=support,
+                                                 backend=backend, workers=workers, max_memory=max_memory)
+    else:
+        outimage = convolution.fftconvolve(field_image, psfimage, mode='same', backend=backend, workers=workers,
+                                           max_memory=max_memory)
+
+    # Add the background analytically
+    if background:
+        if background_pattern is None and cached_psf and cached_spotmask:
+            background_pattern = get_background_pattern(psffile, angle, dtype=dtype)
+        elif background_pattern is None:
+            background_pattern = make_background_pattern(psfimage, spotmask, dtype=dtype)
+        if window is not None:
+            background_pattern = background_pattern[window[0]:window[1], window[2]:window[3]]
+        outimage += background * background_pattern
+    outimage *= throughput
+
+    return outimage
+
+
+class SossWorkspace:
+    """
+    Reusable buffers for the rotate-disperse-trim pipeline.
+
+    One workspace should be kept per worker.  The POM field and the
+    4231x4231 output canvas are allocated on first use and then filled in
+    place on every call, so the arrays returned by ``load_field`` and
+    ``embed`` are views that are overwritten by the next PA.  Copy them if
+    they have to outlive the call.
+
+    Memory budget per concurrent PA (float64, halve for float32, which is
+    the default precision):
+
+    - POM field buffer, 2322x2322: 43 MB
+    - output canvas, 4231x4231: 143 MB
+    - FFT transients for the 8192x8192 SOSS PSF, which is cut down to
+      the central 4643x4643 that can reach the field: two 7200x3601
+      complex spectra, the 7200x7200 real inverse and the padded input,
+      about 1.7 GB, released when the convolution returns.  Pass
+      max_memory to soss_scene to bound this with overlap-add blocks.
+
+    The rotated scene (143 MB) is still produced by ``rotate_image``.
+
+    Parameters
+    ----------
+    dtype: str or type
+        The data type of the buffers, the precision module default if None
+    """
+
+    def __init__(self, dtype=None):
+        self.dtype = get_dtype(dtype)
+        self._field = None
+        self._fov = None
+
+    @property
+    def field(self):
+        """The 2322x2322 POM field buffer"""
+        if self._field is None:
+            self._field = np.empty((2322, 2322), dtype=self.dtype)
+        return self._field
+
+    @property
+    def fov(self):
+        """The 4231x4231 output canvas, zero outside the POM area"""
+        if self._fov is None:
+            self._fov = np.zeros((4231, 4231), dtype=self.dtype)
+        return self._fov
+
+    def load_field(self, scene_image, spotmask, sossoffset=True):
+        """
+        Copy the POM area of a 4231x4231 scene into the field buffer and
+        apply the spot mask.
+
+        Parameters
+        ----------
+        scene_image: np.ndarray
+            The 4231x4231 work scene image
+        spotmask: np.ndarray
+            The 2048x2048 occulting spot mask
+        sossoffset: bool
+            Offset the reference position to the SOSS acquisition position or not
+
+        Returns
+        -------
+        np.ndarray
+            A view of the 2322x2322 field buffer
+        """
+        return load_field(self.field, scene_image, spotmask, sossoffset=sossoffset)
+
+    def embed(self, dispersed_image):
+        """
+        Place a dispersed POM image in the output canvas.
+
+        Parameters
+        ----------
+        dispersed_image: np.ndarray
+            The 2322x2322 dispersed image
+
+        Returns
+        -------
+        np.ndarray
+            A view of the 4231x4231 canvas
+        """
+        fov = self.fov
+        fov[955:3277, 955:3277] = dispersed_image
+
+        return fov
+
+
+def soss_scene_stack(scene_images, sossoffset=True, psffile=None, throughput=0.8, angle=None,
+                     psfimage=None, spotmask=None, dtype=None, backend=None, workers=None,
+                     max_memory=None, background=0., background_pattern=None):
+    """
+    Disperse a stack of scene images, for example one per PA, in one go.
+
+    The POM fields are cut out and spot masked into one (N, 2322, 2322)
+    array, which is convolved with the shared SOSS PSF spectrum using
+    batched FFTs.  The batch size follows max_memory.
+
+    Parameters
+    ----------
+    scene_images: np.ndarray
+        The (N, 4231, 4231) stack of rotated work scene images
+    max_memory: float
+        A ceiling in bytes for the FFT buffers, which sets how many
+        images are transformed together
+
+    All other parameters are as for soss_scene.
+
+    Returns
+    -------
+    outimages: np.ndarray
+         The (N, 2322, 2322) stack of dispersed scenes
+    """
+    imshape = scene_images.shape
+    if (len(imshape) != 3) or (imshape[1] != 4231) or (imshape[2] != 4231):
+        print('Error in soss_scene_stack: wrong size stack {} passed to the routine.'.format(imshape))
+        return None
+
+    # Get the spot mask data
+    cached_spotmask = spotmask is None
+    if cached_spotmask:
+        spotmask = get_spotmask()
+
+    # Get the psf image
+    dtype = get_dtype(dtype)
+    cached_psf = psfimage is None
+    if cached_psf:
+        psfimage = get_psf_image(psffile, angle, dtype=dtype)
+    else:
+        if angle is not None:
+            psfimage = ndimage.rotate(psfimage, angle)
+        psfimage = np.asarray(psfimage, dtype=dtype)
+
+    # Make the stack of final images
+    fields = np.empty((imshape[0], 2322, 2322), dtype=dtype)
+    for field, scene_image in zip(fields, scene_images):
+        load_field(field, scene_image, spotmask, sossoffset=sossoffset)
+
+    # Convolve the psf with all the fields
+    outimages = convolution.fftconvolve_stack(fields, psfimage, mode='same', max_memory=max_memory,
+                                              backend=backend, workers=workers)
+
+    # Add the background analytically
+    if background:
+        if background_pattern is None and cached_psf and cached_spotmask:
+            background_pattern = get_background_pattern(psffile, angle, dtype=dtype)
+        elif background_pattern is None:
+            background_pattern = make_background_pattern(psfimage, spotmask, dtype=dtype)
+        outimages += background * background_pattern
+    outimages *= throughput
+
+    return outimages
+
+
+def make_background_pattern(psfimage, spotmask, dtype=None):
+    """
+    Disperse a unit background over the POM field.
+
+    A constant background B in the scene disperses to B times this
+    pattern, whatever the PA, so the background never has to be convolved
+    with the scene.
+
+    Parameters
+    ----------
+    psfimage: np.ndarray
+        The SOSS PSF image
+    spotmask: np.ndarray
+        The 2048x2048 occulting spot mask
+    dtype: str or type
+        The floating point type of the pattern
+
+    Returns
+    -------
+    np.ndarray
+        The 2322x2322 dispersed unit background, before the throughput
+    """
+    field = np.ones((2322, 2322), dtype=get_dtype(dtype))
+    field[137:2185, 137:2185] *= spotmask
+
+    return convolution.fftconvolve(field, psfimage, mode='same')
+
+
+def recombine(source_image, background_pattern, background=0., throughput=0.8):
+    """
+    Combine a dispersed scene of sources with a background and throughput.
+
+    Disperse the sources once with throughput=1 and no background, then
+    call this to try other background levels or throughputs.
+
+    Parameters
+    ----------
+    source_image: np.ndarray
+        The dispersed sources, without throughput or background
+    background_pattern: np.ndarray
+        The matching part of the dispersed unit background, see
+        get_background_pattern
+    background: float
+        The background level of the scene
+    throughput: float
+        The grism throughput value
+
+    Returns
+    -------
+    np.ndarray
+        The new dispersed scene
+    """
+    return throughput * (source_image + background * background_pattern)
+
+
+def load_field(field, scene_image, spotmask, sossoffset=True):
+    """
+    Copy the POM area of a 4231x4231 scene into a 2322x2322 field array
+    and apply the spot mask.
+
+    Parameters
+    ----------
+    field: np.ndarray
+        The 2322x2322 array to fill in place
+    scene_image: np.ndarray
+        The 4231x4231 work scene image
+    spotmask: np.ndarray
+        The 2048x2048 occulting spot mask
+    sossoffset: bool
+        Offset the reference position to the SOSS acquisition position or not
+
+    Returns
+    -------
+    np.ndarray
+        The filled field array
+    """
+    # The SOSS offset moves the scene by (174, 930) pixels, so the POM
+    # area starts at (955 - 174, 955 - 930) in the unshifted scene
+    if sossoffset:
+        field[:, :] = scene_image[781:3103, 25:2347]
+    else:
+        field[:, :] = scene_image[955:3277, 955:3277]
+    field[137:2185, 137:2185] *= spotmask
+
+    return field
+
+
+def subarray_positions(xpos, ypos, subarray='FULL', sossoffset=True):
+    """
+    Convert pixel positions in a 4231x4231 scene to positions in a
+    detector subarray.
+
+    Parameters
+    ----------
+    xpos: np.ndarray
+        The x positions in the scene
+    ypos: np.ndarray
+        The y positions in the scene
+    subarray: str or tuple
+        One of SUBARRAY_WINDOWS or a (y0, y1, x0, x1) POM image window
+    sossoffset: bool
+        Offset the reference position to the SOSS acquisition position or not
+
+    Returns
+    -------
+    xpos, ypos
+        New arrays of the positions relative to the subarray origin
+    """
+    y0, _, x0, _ = SUBARRAY_WINDOWS.get(subarray, subarray)
+
+    # The POM area starts at (781, 25) or (955, 955) in the scene, see load_field
+    yfield, xfield = (781, 25) if sossoffset else (955, 955)
+
+    return np.asarray(xpos) - (xfield + x0), np.asarray(ypos) - (yfield + y0)
+
+
+def footprint_radius(subarray=None, psfshape=None, support=None, sossoffset=True):
+    """
+    Find the largest distance from the scene centre at which a source can
+    still add flux to a subarray at some PA.
+
+    Scenes are rotated about their centre, so a source further out than
+    this never lands where its dispersed PSF reaches the subarray,
+    whatever the PA.
+
+    Parameters
+    ----------
+    subarray: str or tuple
+        One of SUBARRAY_WINDOWS or a (y0, y1, x0, x1) POM image window; the
+        whole POM image if None
+    psfshape: tuple
+        The shape of the PSF image; the sources reaching the subarray are
+        then limited to the POM image, which is all that is dispersed
+    support: tuple
+        The (y0, y1, x0, x1) bounding box of the PSF, see
+        convolution.kernel_support; the whole PSF image if None
+    sossoffset: bool
+        Offset the reference position to the SOSS acquisition position or not
+
+    Returns
+    -------
+    float
+        The radius in pixels about the centre of a 4231x4231 scene
+    """
+    y0, y1, x0, x1 = (0, 2322, 0, 2322) if subarray is None else SUBARRAY_WINDOWS.get(subarray, subarray)
+
+    # A source at p reaches the output pixels p + s - (K - 1) // 2 for the
+    # PSF pixels s in the support, see psf_placement
+    if psfshape is not None:
+        sy0, sy1, sx0, sx1 = support or (0, psfshape[0], 0, psfshape[1])
+        cy, cx = (psfshape[0] - 1) // 2, (psfshape[1] - 1) // 2
+        y0, y1 = max(y0 + cy - sy1 + 1, 0), min(y1 + cy - sy0, 2322)
+        x0, x1 = max(x0 + cx - sx1 + 1, 0), min(x1 + cx - sx0, 2322)
+    else:
+        y0, y1, x0, x1 = 0, 2322, 0, 2322
+
+    # The corners in scene pixels, see load_field
+    yfield, xfield = (781, 25) if sossoffset else (955, 955)
+    ys = np.array([y0, y1 - 1]) + yfield - 2115
+    xs = np.array([x0, x1 - 1]) + xfield - 2115
+
+    return float(np.hypot(np.abs(ys).max(), np.abs(xs).max()))
+
+
+def psf_placement(xpos, ypos, shape, psfshape, support=None, rows=None):
+    """
+    Find where the PSF of a point source lands in a dispersed frame.
+
+    A source at (y, x) adds psf[i - y + c] to output pixel i, with c the
+    centre (n - 1) // 2 of the PSF, as in the 'same' mode convolution.
+
+    Parameters
+    ----------
+    xpos: int
+        The x position of the source in the frame
+    ypos: int
+        The y position of the source in the frame
+    shape: sequence
+        The shape of the frame
+    psfshape: sequence
+        The shape of the PSF image
+    support: sequence
+        The (y0, y1, x0, x1) bounding box of the PSF, see
+        convolution.kernel_support; the whole image if None
+    rows: sequence
+        Only consider the (r0, r1) rows of the frame
+
+    Returns
+    -------
+    frame_slices, psf_slices
+        The matching parts of the frame and the PSF, or None if the PSF
+        does not reach the frame
+    """
+    ycen, xcen = (psfshape[0] - 1) // 2, (psfshape[1] - 1) // 2
+    py0, py1, px0, px1 = support or (0, psfshape[0], 0, psfshape[1])
+    r0, r1 = rows or (0, shape[0])
+
+    y0, y1 = max(r0, ypos - ycen + py0), min(r1, ypos - ycen + py1)
+    x0, x1 = max(0, xpos - xcen + px0), min(shape[1], xpos - xcen + px1)
+    if y0 >= y1 or x0 >= x1:
+        return None
+
+    return ((slice(y0, y1), slice(x0, x1)),
+            (slice(y0 - ypos + ycen, y1 - ypos + ycen), slice(x0 - xpos + xcen, x1 - xpos + xcen)))
+
+
+def in_field(xpos, ypos, window='FULL'):
+    """
+    Find which sources are in the 2322x2322 POM image, the only part of
+    the scene that is dispersed.
+
+    Parameters
+    ----------
+    xpos: np.ndarray
+        The x positions of the sources in the window
+    ypos: np.ndarray
+        The y positions of the sources in the window
+    window: str or sequence
+        One of SUBARRAY_WINDOWS or a (y0, y1, x0, x1) POM image window
+
+    Returns
+    -------
+    np.ndarray
+        True for the sources whose nearest POM image pixel is in the image
+    """
+    y0, _, x0, _ = SUBARRAY_WINDOWS.get(window, window)
+    y = np.rint(np.asarray(ypos, dtype=float)).astype(int) + y0
+    x = np.rint(np.asarray(xpos, dtype=float)).astype(int) + x0
+
+    return (y >= 0) & (y < 2322) & (x >= 0) & (x < 2322)
+
+
+def spot_transmission(xpos, ypos, window, spotmask):
+    """
+    Find the occulting spot mask value at a source position.
+
+    Parameters
+    ----------
+    xpos: int
+        The x position of the source in the window
+    ypos: int
+        The y position of the source in the window
+    window: str or sequence
+        One of SUBARRAY_WINDOWS or a (y0, y1, x0, x1) POM image window
+    spotmask: np.ndarray
+        The 2048x2048 occulting spot mask, or None
+
+    Returns
+    -------
+    float
+        The spot mask value, 1 off the mask
+    """
+    y0, _, x0, _ = SUBARRAY_WINDOWS.get(window, window)
+    sy, sx = ypos + y0 - 137, xpos + x0 - 137
+    if spotmask is None or not (0 <= sy < spotmask.shape[0] and 0 <= sx < spotmask.shape[1]):
+        return 1.
+
+    return spotmask[sy, sx]
+
+
+def add_sources(frame, xpos, ypos, flux, window='SUBSTRIP256', psffile=None, throughput=0.8, angle=None,
+                psfimage=None, spotmask=None, support=None, stamps=None):
+    """
+    Add the dispersed light of point sources to a dispersed frame in place,
+    or remove it with negative fluxes.
+
+    Dispersion is linear, so dispersing the pixels each source covers in
+    the rotated scene, its stamp, matches dispersing the scene with or
+    without the sources, but only touches the pixels the PSF reaches and
+    takes a small convolution per source instead of a full one.  Sources
+    outside the POM image are not dispersed and are skipped.
+
+    Parameters
+    ----------
+    frame: np.ndarray
+        The dispersed frame of the window, e.g. from soss_scene(window=...)
+    xpos: sequence
+        The x positions of the sources in the window, see subarray_positions
+    ypos: sequence
+        The y positions of the sources in the window
+    flux: sequence
+        The flux of each source in the scene; negative to remove it
+    window: str or sequence
+        One of SUBARRAY_WINDOWS or a (y0, y1, x0, x1) POM image window
+    psffile: str
+        An alternate path to the SOSS PSF image
+    throughput: float
+        The grism throughput value
+    angle: float
+        An optional rotation angle in degrees to apply to the PSF image
+    psfimage: np.ndarray
+        An already loaded SOSS PSF image, used instead of reading psffile
+    spotmask: np.ndarray
+        An already loaded 2048x2048 occulting spot mask
+    support: sequence
+        The (y0, y1, x0, x1) bounding box of the PSF; found from the PSF
+        if None
+    stamps: np.ndarray
+        The rotated unit source around each position, as the frame's
+        rotated scene holds it, see scene_image.rotate_sources; a single
+        pixel, as in an unrotated scene, if None
+
+    Returns
+    -------
+    np.ndarray
+        The updated frame
+    """
+    if spotmask is None:
+        spotmask = get_spotmask()
+    if psfimage is None:
+        psfimage = get_psf_image(psffile, angle, dtype=frame.dtype)
+        support = support or get_psf_support(psffile, angle, dtype=frame.dtype)
+    support = support or convolution.kernel_support(psfimage)
+    if stamps is None:
+        stamps = np.ones((len(xpos), 1, 1))
+
+    # A stamp pixel at q adds psf[s] to frame pixel q + s - c, as in the
+    # 'same' mode convolution, see psf_placement
+    y0, y1, x0, x1 = support
+    kernel = psfimage[y0:y1, x0:x1]
+    radius = (stamps.shape[1] - 1) // 2
+    cy, cx = (psfimage.shape[0] - 1) // 2 - y0 + radius, (psfimage.shape[1] - 1) // 2 - x0 + radius
+
+    dispersed = in_field(xpos, ypos, window)
+    for x, y, f, stamp in zip(np.rint(xpos).astype(int)[dispersed], np.rint(ypos).astype(int)[dispersed], np.asarray(flux)[dispersed],
+                              stamps[dispersed]):
+        convolution.add_convolved(frame, stamp, kernel, (y - cy, x - cx), scale=f * throughput * spot_transmission(x, y, window, spotmask))
+
+    return frame
+
+
+@lru_cache(maxsize=1)
+def get_spotmask():
+    """
+    Read the occulting spot mask once and cache it
+
+    Returns
+    -------
+    np.ndarray
+        The read-only 2048x2048 spot mask
+    """
     spotpath = resource_filename('grism_overlap', 'files/occulting_spots_mask.fits')
     spotmask = fits.getdata(spotpath)
+    spotmask.flags.writeable = False
 
-    # Get the psf image
+    return spotmask
+
+
+@lru_cache(maxsize=2)
+def get_psf_image(psffile=None, angle=None, dtype=None):
+    """
+    Read (and optionally rotate) the SOSS PSF once and cache it
+
+    Parameters
+    ----------
+    psffile: str
+        An alternate path to the SOSS PSF image
+    angle: float
+        An optional rotation angle in degrees
+    dtype: str or type
+        The floating point type of the returned image
+
+    Returns
+    -------
+    np.ndarray
+        The read-only PSF image
+    """
     if psffile is not None:
         psfimage = fits.getdata(psffile)
     else:
@@ -50,24 +663,60 @@ def soss_scene(scene_image, sossoffset=True, psffile=None, throughput=0.8, angle
 
     if angle is not None:
         psfimage = ndimage.rotate(psfimage, angle)
+    psfimage = np.array(psfimage, dtype=get_dtype(dtype))
+    psfimage.flags.writeable = False
 
-    # Check for offset
-    if not sossoffset:
-        new_image = scene_image
-    else:
-        new_image = scene_image * 0.
-        new_image[174:, 930:] = scene_image[0:4057, 0:3301]
+    return psfimage
 
-    # Make the final image
-    field_image = np.copy(new_image[955:3277, 955:3277])
-    y1 = 137
-    x1 = 137
-    field_image[y1:y1 + 2048, x1:x1 + 2048] = field_image[y1:y1 + 2048, x1:x1 + 2048] * spotmask
 
-    # Convolve with the psf with the field
-    outimage = signal.fftconvolve(field_image, psfimage, mode='same')
+@lru_cache(maxsize=2)
+def get_background_pattern(psffile=None, angle=None, dtype=None):
+    """
+    Disperse a unit background with the cached SOSS PSF and spot mask once
+    and cache it, see make_background_pattern
 
-    return outimage * throughput
+    Parameters
+    ----------
+    psffile: str
+        An alternate path to the SOSS PSF image
+    angle: float
+        An optional rotation angle in degrees
+    dtype: str or type
+        The floating point type of the pattern
+
+    Returns
+    -------
+    np.ndarray
+        The read-only 2322x2322 dispersed unit background
+    """
+    pattern = make_background_pattern(get_psf_image(psffile, angle, dtype=dtype), get_spotmask(), dtype=dtype)
+    pattern.flags.writeable = False
+
+    return pattern
+
+
+@lru_cache(maxsize=4)
+def get_psf_support(psffile=None, angle=None, dtype=None, threshold=0.):
+    """
+    Find and cache the bounding box of the cached SOSS PSF image
+
+    Parameters
+    ----------
+    psffile: str
+        An alternate path to the SOSS PSF image
+    angle: float
+        An optional rotation angle in degrees
+    dtype: str or type
+        The floating point type of the PSF image
+    threshold: float
+        The fraction of the PSF peak at or below which pixels are ignored
+
+    Returns
+    -------
+    tuple
+        The (y0, y1, x0, x1) pixel ranges of the PSF support
+    """
+    return convolution.kernel_support(get_psf_image(psffile, angle, dtype=dtype), threshold)
 
 
 def get_gr700_psf(files=None):
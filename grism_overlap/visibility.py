@@ -0,0 +1,177 @@
+"""
+An offline estimate of when and at which V3 position angles JWST can
+observe a target.
+
+JWST can point at targets whose solar elongation is between about 85 and
+135 degrees, with the sunshield facing the Sun.  At a given date that
+fixes the V3 position angle to the direction away from the Sun, within a
+small off-nominal roll.  Sweeping the dates of a year therefore gives
+the set of PAs that can be scheduled.  The Sun position comes from the
+low precision formula of the Astronomical Almanac (good to 0.01 degree),
+so no network access or ephemeris files are needed.
+
+sun_radec:   the RA and Dec of the Sun at the given Julian dates
+
+position_angle:   the position angle of one sky position seen from
+                  another, east of north
+
+visibility:   the solar elongation, visibility and nominal V3 PA of a
+              target over a range of dates
+
+allowed_pas:   the V3 PAs that can be scheduled over a range of dates
+"""
+from astropy.time import Time
+import numpy as np
+
+MIN_ELONGATION = 85.
+MAX_ELONGATION = 135.
+MAX_ROLL = 5.
+
+
+def sun_radec(jd):
+    """
+    Calculate the position of the Sun.
+
+    Parameters
+    ----------
+    jd: float or np.ndarray
+        The Julian date(s)
+
+    Returns
+    -------
+    ra, dec
+        The RA and Dec of the Sun in degrees
+    """
+    n = np.asarray(jd, dtype=float) - 2451545.
+    mean_longitude = 280.460 + 0.9856474 * n
+    anomaly = np.radians(357.528 + 0.9856003 * n)
+    longitude = np.radians(mean_longitude + 1.915 * np.sin(anomaly) + 0.020 * np.sin(2 * anomaly))
+    obliquity = np.radians(23.439 - 0.0000004 * n)
+
+    ra = np.degrees(np.arctan2(np.cos(obliquity) * np.sin(longitude), np.cos(longitude))) % 360.
+    dec = np.degrees(np.arcsin(np.sin(obliquity) * np.sin(longitude)))
+
+    return ra, dec
+
+
+def position_angle(ra1, dec1, ra2, dec2):
+    """
+    Calculate the position angle of (ra2, dec2) seen from (ra1, dec1)
+    and their separation.
+
+    Parameters
+    ----------
+    ra1: float or np.ndarray
+        The RA of the origin in degrees
+    dec1: float or np.ndarray
+        The Dec of the origin in degrees
+    ra2: float or np.ndarray
+        The RA of the other position in degrees
+    dec2: float or np.ndarray
+        The Dec of the other position in degrees
+
+    Returns
+    -------
+    pa, separation
+        The position angle east of north and the separation in degrees
+    """
+    ra1, dec1, ra2, dec2 = (np.radians(i) for i in (ra1, dec1, ra2, dec2))
+    dra = ra2 - ra1
+
+    pa = np.arctan2(np.sin(dra), np.cos(dec1) * np.tan(dec2) - np.sin(dec1) * np.cos(dra))
+    separation = np.arccos(np.clip(np.sin(dec1) * np.sin(dec2) + np.cos(dec1) * np.cos(dec2) * np.cos(dra), -1., 1.))
+
+    return np.degrees(pa) % 360., np.degrees(separation)
+
+
+def _to_jd(date):
+    """A date as a Julian date, numbers being taken as Julian dates already"""
+    if isinstance(date, (int, float)):
+        return float(date)
+
+    return Time(date).jd
+
+
+def _julian_dates(start=None, end=None, step=1.):
+    """The Julian dates from start to end, a year from today by default"""
+    start = Time.now().jd if start is None else _to_jd(start)
+    end = start + 365.25 if end is None else _to_jd(end)
+    if end < start:
+        raise ValueError('The end date must not be before the start date.')
+
+    return np.arange(start, end + step / 2., step)
+
+
+def visibility(ra, dec, start=None, end=None, step=1., min_elongation=MIN_ELONGATION, max_elongation=MAX_ELONGATION):
+    """
+    Calculate the visibility of a target over a range of dates.
+
+    Parameters
+    ----------
+    ra: float
+        The RA in decimal degrees
+    dec: float
+        The Declination in decimal degrees
+    start: str, float, astropy.time.Time
+        The first date, a Julian date or anything astropy.time.Time
+        accepts; today if None
+    end: str, float, astropy.time.Time
+        The last date; a year after start if None
+    step: float
+        The spacing of the dates in days
+    min_elongation: float
+        The smallest allowed solar elongation in degrees
+    max_elongation: float
+        The largest allowed solar elongation in degrees
+
+    Returns
+    -------
+    jd, elongation, visible, v3pa
+        The Julian dates, the solar elongation of the target, whether it
+        can be observed, and the nominal V3 PA at each date
+    """
+    jd = _julian_dates(start, end, step)
+    sun_ra, sun_dec = sun_radec(jd)
+
+    # The V3 axis points away from the Sun
+    sun_pa, elongation = position_angle(ra, dec, sun_ra, sun_dec)
+    v3pa = (sun_pa + 180.) % 360.
+    visible = (elongation >= min_elongation) & (elongation <= max_elongation)
+
+    return jd, elongation, visible, v3pa
+
+
+def allowed_pas(ra, dec, start=None, end=None, step=1., max_roll=MAX_ROLL, resolution=1., **kwargs):
+    """
+    Find the V3 PAs at which a target can be observed over a range of dates.
+
+    Parameters
+    ----------
+    ra: float
+        The RA in decimal degrees
+    dec: float
+        The Declination in decimal degrees
+    start: str, float, astropy.time.Time
+        The first date; today if None
+    end: str, float, astropy.time.Time
+        The last date; a year after start if None
+    step: float
+        The spacing of the dates in days
+    max_roll: float
+        The largest off-nominal roll in degrees
+    resolution: float
+        The spacing of the PA grid in degrees
+
+    Returns
+    -------
+    pas, allowed
+        The PA grid and whether each PA can be scheduled
+    """
+    _, _, visible, v3pa = visibility(ra, dec, start=start, end=end, step=step, **kwargs)
+    pas = np.arange(0., 360., resolution)
+
+    # Allowed if within the roll of the nominal PA on any visible date
+    offset = (pas[None, :] - v3pa[visible, None] + 180.) % 360. - 180.
+    allowed = (np.abs(offset) <= max_roll + resolution / 2.).any(axis=0)
+
+    return pas, allowed
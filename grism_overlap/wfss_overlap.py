@@ -0,0 +1,319 @@
+"""
+Find which WFSS sources contaminate which, from their trace bounding boxes.
+
+In WFSS every source in the field is a target.  The trace of a source
+covers the bounding box of the WFSS PSF support placed at its position
+(see wfss_scene), so two spectra can only overlap where their boxes do.
+Sorting the boxes along the axis across the traces, where they are
+narrow, and sweeping along it finds all the overlapping pairs in
+O(N log N + M) for N sources, where M is the number of pairs whose boxes
+overlap along that axis, instead of one image simulation per source.
+Sources outside the read-out area are not dispersed and get no box.
+
+trace_extent:   the bounding box of a trace relative to its source, from
+                the PSF support
+
+trace_boxes:   the trace bounding box of each source, clipped to the
+               detector
+
+overlap_pairs:   every pair of overlapping boxes and their shared area
+
+overlap_graph:   the overlap graph of a field for one filter and grism
+
+box_sums:   the flux of a frame inside each box
+
+own_flux:   the flux a source puts inside its own trace box
+
+source_contamination:   the contaminating over own flux in the trace box
+                        of every source of a dispersed frame
+"""
+import numpy as np
+
+from . import convolution
+from . import scene_image as si
+from .wfss_scene import get_wfss_psf
+
+# The detector as a (y0, y1, x0, x1) window of the 2322x2322 read-out area
+DETECTOR_WINDOW = (137, 2185, 137, 2185)
+
+
+def trace_extent(filtername=None, grismname=None, psffile=None, psfimage=None, threshold=1e-3):
+    """
+    Find the bounding box of a trace relative to the pixel of its source.
+
+    Parameters
+    ----------
+    filtername: str
+       A WFSS blocking filter name
+    grimsname: str
+        The NIRISS GR150 grism name, either 'GR150R' or 'GR150C'
+    psffile: str
+        The path to an alternate WFSS PSF image
+    psfimage: np.ndarray
+        An already loaded WFSS PSF image, used instead of the filter and
+        grism
+    threshold: float
+        The fraction of the PSF peak at or below which pixels are ignored
+
+    Returns
+    -------
+    tuple
+        The (dy0, dy1, dx0, dx1) pixel offsets of the box, the upper ends
+        exclusive
+    """
+    if psfimage is None:
+        psfimage = get_wfss_psf(filtername, grismname, psffile=psffile)
+    y0, y1, x0, x1 = convolution.kernel_support(psfimage, threshold)
+
+    # A source at p covers the pixels p + s - c of the 'same' convolution
+    cy, cx = (psfimage.shape[0] - 1) // 2, (psfimage.shape[1] - 1) // 2
+
+    return y0 - cy, y1 - cy, x0 - cx, x1 - cx
+
+
+def trace_boxes(xpos, ypos, extent, window=DETECTOR_WINDOW):
+    """
+    Place the trace bounding box at each source in the read-out area.
+
+    Parameters
+    ----------
+    xpos: np.ndarray
+        The x positions of the sources in the read-out area
+    ypos: np.ndarray
+        The y positions of the sources in the read-out area
+    extent: tuple
+        The (dy0, dy1, dx0, dx1) box of a trace, see trace_extent
+    window: tuple
+        The (y0, y1, x0, x1) window to clip the boxes to, or None
+
+    Returns
+    -------
+    np.ndarray
+        The (N, 4) boxes as (y0, y1, x0, x1) rows, the upper ends
+        exclusive; boxes outside the window and of sources outside the
+        2322x2322 read-out area, which wfss_scene does not disperse, are
+        empty (y1 <= y0 or x1 <= x0)
+    """
+    x = np.rint(np.asarray(xpos, dtype=float)).astype(int)
+    y = np.rint(np.asarray(ypos, dtype=float)).astype(int)
+    boxes = np.stack([y + extent[0], y + extent[1], x + extent[2], x + extent[3]], axis=1)
+    boxes[(x < 0) | (x >= 2322) | (y < 0) | (y >= 2322)] = 0
+
+    if window is not None:
+        boxes[:, 0:2] = np.clip(boxes[:, 0:2], window[0], window[1])
+        boxes[:, 2:4] = np.clip(boxes[:, 2:4], window[2], window[3])
+
+    return boxes
+
+
+def overlap_pairs(boxes):
+    """
+    Find every pair of overlapping boxes.
+
+    Parameters
+    ----------
+    boxes: np.ndarray
+        The (N, 4) boxes as (y0, y1, x0, x1) rows, see trace_boxes
+
+    Returns
+    -------
+    first, second, area
+        The indices of the two boxes of each pair, first < second, and the
+        number of pixels they share
+    """
+    boxes = np.asarray(boxes)
+    valid = np.flatnonzero((boxes[:, 1] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 2]))
+
+    # Sweep along the axis where the boxes are shorter, so few of the
+    # candidates are pairs that only overlap along it
+    extents = boxes[valid, 1::2] - boxes[valid, 0::2]
+    sweep = 2 * int(extents[:, 1].sum() < extents[:, 0].sum())
+    cross = 2 - sweep
+
+    # The boxes starting before a box ends are the only candidates that
+    # can overlap it
+    order = valid[np.argsort(boxes[valid, sweep], kind='stable')]
+    lower = boxes[order, sweep]
+    ends = np.searchsorted(lower, boxes[order, sweep + 1], side='left')
+
+    first, second, area = [], [], []
+    for n, end in enumerate(ends):
+        others = order[n + 1:end]
+        if len(others) == 0:
+            continue
+        box = boxes[order[n]]
+        across = np.minimum(box[cross + 1], boxes[others, cross + 1]) - np.maximum(box[cross], boxes[others, cross])
+        along = np.minimum(box[sweep + 1], boxes[others, sweep + 1]) - lower[n + 1:end]
+        hit = across > 0
+        first.append(np.minimum(order[n], others[hit]))
+        second.append(np.maximum(order[n], others[hit]))
+        area.append(across[hit] * along[hit])
+
+    if not first:
+        return np.array([], dtype=int), np.array([], dtype=int), np.array([], dtype=int)
+
+    return np.concatenate(first), np.concatenate(second), np.concatenate(area)
+
+
+def overlap_graph(xpos, ypos, filtername, grismname, x0=0, y0=0, pa=None, psffile=None, psfimage=None, threshold=1e-3):
+    """
+    Find which sources of a WFSS field contaminate which.
+
+    Parameters
+    ----------
+    xpos: np.ndarray
+        The x positions of the sources in the 4231x4231 scene
+    ypos: np.ndarray
+        The y positions of the sources in the scene
+    filtername: str
+       A WFSS blocking filter name
+    grimsname: str
+        The NIRISS GR150 grism name, either 'GR150R' or 'GR150C'
+    x0: int
+        The lower left corner x pixel value for the POM image read-out area
+    y0: int
+        The lower left corner y pixel value for the POM image read-out area
+    pa: float
+        The angle in degrees to rotate the scene by first, see
+        scene_image.rotate_positions
+    psffile: str
+        The path to an alternate WFSS PSF image
+    psfimage: np.ndarray
+        An already loaded WFSS PSF image
+    threshold: float
+        The fraction of the PSF peak at or below which pixels are ignored
+
+    Returns
+    -------
+    first, second, area
+        The overlapping pairs of sources on the detector and the number of
+        pixels their trace boxes share, see overlap_pairs
+    """
+    if pa is not None:
+        xpos, ypos = si.rotate_positions(xpos, ypos, pa)
+    extent = trace_extent(filtername, grismname, psffile=psffile, psfimage=psfimage, threshold=threshold)
+    boxes = trace_boxes(np.asarray(xpos) - x0, np.asarray(ypos) - y0, extent)
+
+    return overlap_pairs(boxes)
+
+
+def box_sums(frame, boxes):
+    """
+    Sum a frame inside each box with a summed-area table.
+
+    Parameters
+    ----------
+    frame: np.ndarray
+        A dispersed frame
+    boxes: np.ndarray
+        The (N, 4) boxes as (y0, y1, x0, x1) rows in the frame, see
+        trace_boxes
+
+    Returns
+    -------
+    np.ndarray
+        The flux inside each box, ignoring NaNs
+    """
+    table = np.zeros((frame.shape[0] + 1, frame.shape[1] + 1))
+    table[1:, 1:] = np.nan_to_num(frame, nan=0.).cumsum(axis=0, dtype=float).cumsum(axis=1)
+    y0, y1, x0, x1 = (np.clip(boxes[:, k], 0, frame.shape[k // 2]) for k in range(4))
+
+    return np.where((y1 > y0) & (x1 > x0), table[y1, x1] - table[y0, x1] - table[y1, x0] + table[y0, x0], 0.)
+
+
+def own_flux(xpos, ypos, flux, psfimage, boxes, transmission=1., throughput=0.8, stamps=None):
+    """
+    Calculate the flux each source puts inside its own box.
+
+    Dispersion is linear, so this is the source flux times the part of the
+    PSF that lands inside the box, from each pixel the source covers in a
+    rotated scene.  Sources outside the 2322x2322 read-out area are not
+    dispersed and put no flux anywhere.
+
+    Parameters
+    ----------
+    xpos: np.ndarray
+        The x positions of the sources in the frame
+    ypos: np.ndarray
+        The y positions of the sources in the frame
+    flux: np.ndarray
+        The flux of each source in the scene
+    psfimage: np.ndarray
+        The WFSS PSF image
+    boxes: np.ndarray
+        The (N, 4) boxes, see trace_boxes
+    transmission: float or np.ndarray
+        The occulting spot mask value of each source, see
+        wfss_scene.spot_transmission
+    throughput: float
+        The grism throughput
+    stamps: np.ndarray
+        The rotated unit source around each position, see
+        scene_image.rotate_sources; a single pixel if None
+
+    Returns
+    -------
+    np.ndarray
+        The flux of each source inside its box
+    """
+    x = np.rint(np.asarray(xpos, dtype=float)).astype(int)
+    y = np.rint(np.asarray(ypos, dtype=float)).astype(int)
+    cy, cx = (psfimage.shape[0] - 1) // 2, (psfimage.shape[1] - 1) // 2
+    if stamps is None:
+        stamps = np.ones((len(x), 1, 1))
+
+    # The box in PSF pixels of each stamp pixel, see trace_extent
+    radius = (stamps.shape[1] - 1) // 2
+    n, sy, sx = np.nonzero(stamps)
+    py, px = y[n] + sy - radius - cy, x[n] + sx - radius - cx
+    shifted = boxes[n] - np.stack([py, py, px, px], axis=1)
+    psf_sums = np.bincount(n, stamps[n, sy, sx] * box_sums(np.asarray(psfimage, dtype=float), shifted), minlength=len(x))
+    psf_sums[(x < 0) | (x >= 2322) | (y < 0) | (y >= 2322)] = 0.
+
+    return np.asarray(flux, dtype=float) * transmission * throughput * psf_sums
+
+
+def source_contamination(frame, xpos, ypos, flux, psfimage, transmission=1., throughput=0.8, threshold=1e-3,
+                         window=DETECTOR_WINDOW, stamps=None):
+    """
+    Calculate the contamination of every source's spectrum in a dispersed
+    frame of the whole field.
+
+    Parameters
+    ----------
+    frame: np.ndarray
+        The 2322x2322 dispersed frame, see wfss_scene, without background
+    xpos: np.ndarray
+        The x positions of the sources in the read-out area
+    ypos: np.ndarray
+        The y positions of the sources in the read-out area
+    flux: np.ndarray
+        The flux of each source in the scene
+    psfimage: np.ndarray
+        The WFSS PSF image the frame was made with
+    transmission: float or np.ndarray
+        The occulting spot mask value of each source
+    throughput: float
+        The grism throughput the frame was made with
+    threshold: float
+        The fraction of the PSF peak at or below which pixels are ignored
+        when finding the trace boxes
+    window: tuple
+        The (y0, y1, x0, x1) detector window to clip the boxes to
+    stamps: np.ndarray
+        The rotated unit source around each position, which the frame of
+        a rotated scene holds instead of a single pixel, see
+        scene_image.rotate_sources
+
+    Returns
+    -------
+    np.ndarray
+        The flux of the other sources over the source's own flux in its
+        trace box, NaN for sources with no flux on the detector, including
+        those outside the read-out area
+    """
+    boxes = trace_boxes(xpos, ypos, trace_extent(psfimage=psfimage, threshold=threshold), window=window)
+    own = own_flux(xpos, ypos, flux, psfimage, boxes, transmission=transmission, throughput=throughput, stamps=stamps)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(own > 0, (box_sums(frame, boxes) - own) / own, np.nan)
@@ -1,15 +1,27 @@
 """
 The code here takes a scene image and convolves with the NIRISS WFSS "PSF"
 image to produce a simulated dispersed scene.
+
+The trace shape changes over the field.  With a grid of PSFs at several
+detector positions (see get_wfss_psf_grid) the read-out area is split into
+tiles, each convolved with the PSF interpolated at its centre, and the
+tiles are blended where they overlap (see convolution.tiled_convolve).
 """
+from functools import lru_cache
 from pkg_resources import resource_filename
 
 import numpy
 from astropy.io import fits
-from scipy import signal
+from scipy import ndimage
+
+from . import convolution
+from .precision import get_dtype
+from .soss_scene import get_spotmask
 
 
-def wfss_scene(scene_image, filtername, grismname, x0, y0, psffile=None, throughput=0.8):
+def wfss_scene(scene_image, filtername, grismname, x0, y0, psffile=None, throughput=0.8,
+               psfimage=None, spotmask=None, dtype=None, backend=None, workers=None, max_memory=None,
+               background=0., background_pattern=None, field_psf=False, ntiles=(4, 4), overlap=64):
     """
     Convolve a scene image with the WFSS PSF and return dispersed image over
     the 2322x2322 pixel POM image area. The scene image is multiplied by the spot
@@ -28,9 +40,40 @@ def wfss_scene(scene_image, filtername, grismname, x0, y0, psffile=None, through
     y0: int
         The lower left corner y pixel value for the POM image read-out area
     psffile: str
-        The path to alternate WFSS PSF images
+        The path to alternate WFSS PSF images, or to a PSF grid with
+        field_psf
     throughput: float
         The grism throughput
+    psfimage: np.ndarray
+        An already loaded WFSS PSF image, used instead of reading psffile,
+        or a (ny, nx, ky, kx) array of tile PSFs (see tile_psfs)
+    spotmask: np.ndarray
+        An already loaded 2048x2048 occulting spot mask
+    dtype: str or type
+        The floating point type of the calculation, float32 or float64;
+        the precision module default if None
+    backend: str
+        The FFT convolution backend, the convolution module default if None
+    workers: int
+        The number of FFT threads, the convolution module default if None
+    max_memory: float
+        A ceiling in bytes for the FFT buffers; the convolution is done in
+        overlap-add blocks when needed to stay under it, tiles excepted
+    background: float
+        A constant background level of the scene, which is added as a
+        multiple of the dispersed background pattern instead of being
+        convolved with the scene (see get_background_pattern)
+    background_pattern: np.ndarray
+        An already computed 2322x2322 background pattern for psfimage and
+        spotmask; computed here if a background is requested with a
+        psfimage or spotmask but no pattern
+    field_psf: bool
+        Use the field-dependent PSF grid, with cached tile PSF spectra,
+        instead of the single PSF
+    ntiles: tuple
+        The number of (y, x) tiles of the read-out area with field_psf
+    overlap: int
+        The width in pixels of the blending ramps between tiles
 
     Returns
     -------
@@ -44,7 +87,7 @@ def wfss_scene(scene_image, filtername, grismname, x0, y0, psffile=None, through
         print('Error: bad grism name {} passed to wfss_scene'.format(grismname))
         return None
     if not filtername.upper() in filters:
-        print('Error: bad grism name {} passed to wfss_scene'.format(filtername))
+        print('Error: bad filter name {} passed to wfss_scene'.format(filtername))
         return None
 
     # Check data shape
@@ -54,21 +97,677 @@ def wfss_scene(scene_image, filtername, grismname, x0, y0, psffile=None, through
         return None
 
     # Get the spot mask data
-    spotpath = resource_filename('grism_overlap', 'files/occulting_spots_mask.fits')
-    spotmask = fits.getdata(spotpath)
+    cached_spotmask = spotmask is None
+    if cached_spotmask:
+        spotmask = get_spotmask()
+
+    # Get the psf image, or the psf and its spectrum for each tile
+    dtype = get_dtype(dtype)
+    cached_psf = psfimage is None
+    spectra = None
+    if cached_psf and field_psf:
+        ntiles = tuple(ntiles)
+        psfimage, spectra = get_wfss_tile_spectra(filtername, grismname, ntiles, overlap=overlap, psffile=psffile,
+                                                  dtype=dtype, backend=backend)
+    elif cached_psf:
+        psfimage = get_wfss_psf(filtername, grismname, psffile=psffile, dtype=dtype)
+    else:
+        psfimage = numpy.asarray(psfimage, dtype=dtype)
+
+    # Make the final image
+    field_image = numpy.array(scene_image[y0:y0 + 2322, x0:x0 + 2322], dtype=dtype)
+    _mask_field(field_image, spotmask)
+
+    # Convolve with the psf with the field
+    if psfimage.ndim == 4:
+        newimage = convolution.tiled_convolve(field_image, psfimage, overlap=overlap, spectra=spectra, backend=backend,
+                                              workers=workers)
+    else:
+        newimage = convolution.fftconvolve(field_image, psfimage, mode='same', backend=backend, workers=workers,
+                                           max_memory=max_memory)
+
+    # Add the background analytically
+    if background:
+        if background_pattern is None and cached_psf and cached_spotmask:
+            background_pattern = get_background_pattern(filtername, grismname, psffile=psffile, dtype=dtype,
+                                                        ntiles=ntiles if field_psf else None, overlap=overlap,
+                                                        backend=backend)
+        elif background_pattern is None:
+            background_pattern = make_background_pattern(psfimage, spotmask, dtype=dtype, overlap=overlap, spectra=spectra,
+                                                         backend=backend)
+        newimage += background * background_pattern
+    newimage *= throughput
+
+    return newimage
+
+
+def wfss_scene_stack(scene_images, filtername, grismname, x0, y0, psffile=None, throughput=0.8,
+                     psfimage=None, spotmask=None, dtype=None, backend=None, workers=None, max_memory=None,
+                     background=0., background_pattern=None):
+    """
+    Disperse a stack of scene images, for example one per PA, in one go.
+
+    The read-out areas are cut out and spot masked into one
+    (N, 2322, 2322) array, which is convolved with the shared WFSS PSF
+    spectrum using batched FFTs.  The batch size follows max_memory.
+
+    Parameters
+    ----------
+    scene_images: np.ndarray
+        The (N, H, W) stack of imaging scenes to disperse
+    max_memory: float
+        A ceiling in bytes for the FFT buffers, which sets how many
+        images are transformed together
+
+    All other parameters are as for wfss_scene.
+
+    Returns
+    -------
+    outimages: np.ndarray, None
+        The (N, 2322, 2322) stack of dispersed scenes
+    """
+    # Valid grisms and filters
+    grisms = ['GR150R', 'GR150C']
+    filters = ['F090W', 'F115W', 'F140M', 'F150W', 'F158M', 'F200W']
+    if not grismname.upper() in grisms:
+        print('Error: bad grism name {} passed to wfss_scene_stack'.format(grismname))
+        return None
+    if not filtername.upper() in filters:
+        print('Error: bad filter name {} passed to wfss_scene_stack'.format(filtername))
+        return None
+
+    # Check data shape
+    imshape = scene_images.shape
+    if (len(imshape) != 3) or (x0 < 0) or (y0 < 0) or (x0 + 2322 > imshape[2]) or (y0 + 2322 > imshape[1]):
+        print('Error in wfss_scene_stack: bad image offset values ({}, {}) passed to the routine.'.format(x0, y0))
+        return None
+
+    # Get the spot mask data
+    cached_spotmask = spotmask is None
+    if cached_spotmask:
+        spotmask = get_spotmask()
+
+    # Get the psf image
+    dtype = get_dtype(dtype)
+    cached_psf = psfimage is None
+    if cached_psf:
+        psfimage = get_wfss_psf(filtername, grismname, psffile=psffile, dtype=dtype)
+    else:
+        psfimage = numpy.asarray(psfimage, dtype=dtype)
+
+    # Make the stack of final images
+    field_images = numpy.array(scene_images[:, y0:y0 + 2322, x0:x0 + 2322], dtype=dtype)
+    for field_image in field_images:
+        _mask_field(field_image, spotmask)
+
+    # Convolve the psf with all the fields
+    newimages = convolution.fftconvolve_stack(field_images, psfimage, mode='same', max_memory=max_memory,
+                                              backend=backend, workers=workers)
+
+    # Add the background analytically
+    if background:
+        if background_pattern is None and cached_psf and cached_spotmask:
+            background_pattern = get_background_pattern(filtername, grismname, psffile=psffile, dtype=dtype)
+        elif background_pattern is None:
+            background_pattern = make_background_pattern(psfimage, spotmask, dtype=dtype)
+        newimages += background * background_pattern
+    newimages *= throughput
+
+    return newimages
+
+
+def wfss_scene_multi(scene_image, configs, x0, y0, scales=None, throughput=0.8, psfimages=None, spotmask=None, dtype=None,
+                     backend=None, workers=None, background=0.):
+    """
+    Disperse a scene for several filter and grism combinations at once.
+
+    The read-out area is cut out, spot masked and transformed once per
+    distinct scene, and each combination then only costs a product with
+    its PSF spectrum and an inverse FFT, so all twelve combinations of a
+    pointing cost about one forward and twelve inverse FFTs.  The PSF
+    spectra are cached when the bundled PSFs are used.
+
+    Parameters
+    ----------
+    scene_image: np.ndarray or dict
+        The imaging scene to disperse, or a dict of scenes by filter name
+        for fields whose sources do not all scale alike between filters;
+        filters sharing a scene array share its transform
+    configs: sequence
+        The (filtername, grismname) combinations
+    x0: int
+        The lower left corner x pixel value for the POM image read-out area
+    y0: int
+        The lower left corner y pixel value for the POM image read-out area
+    scales: dict
+        A flux factor by filter name, applied to the spectrum product, for
+        filters whose scene is the given scene times a constant
+    throughput: float
+        The grism throughput
+    psfimages: dict
+        Already loaded WFSS PSF images by (filtername, grismname), used
+        instead of the cached ones
+    spotmask: np.ndarray
+        An already loaded 2048x2048 occulting spot mask
+    dtype: str or type
+        The floating point type of the calculation, float32 or float64;
+        the precision module default if None
+    backend: str
+        The FFT convolution backend, the convolution module default if None
+    workers: int
+        The number of FFT threads, the convolution module default if None
+    background: float
+        A constant background level of the scenes, added as the dispersed
+        background pattern (see get_background_pattern)
+
+    Returns
+    -------
+    dict, None
+        The dispersed 2322x2322 scene of each (filtername, grismname)
+    """
+    # Valid grisms and filters
+    grisms = ['GR150R', 'GR150C']
+    filters = ['F090W', 'F115W', 'F140M', 'F150W', 'F158M', 'F200W']
+    configs = [(filtername.upper(), grismname.upper()) for filtername, grismname in configs]
+    for filtername, grismname in configs:
+        if grismname not in grisms:
+            print('Error: bad grism name {} passed to wfss_scene_multi'.format(grismname))
+            return None
+        if filtername not in filters:
+            print('Error: bad filter name {} passed to wfss_scene_multi'.format(filtername))
+            return None
+
+    # Check data shape
+    scenes = scene_image if isinstance(scene_image, dict) else {filtername: scene_image for filtername, _ in configs}
+    for filtername, _ in configs:
+        imshape = scenes[filtername].shape
+        if (x0 < 0) or (y0 < 0) or (x0 + 2322 > imshape[1]) or (y0 + 2322 > imshape[0]):
+            print('Error in wfss_scene_multi: bad image offset values ({}, {}) passed to the routine.'.format(x0, y0))
+            return None
+
+    # Get the spot mask data
+    cached_spotmask = spotmask is None
+    if cached_spotmask:
+        spotmask = get_spotmask()
+
+    # Get the psf spectra
+    dtype = get_dtype(dtype)
+    scales = scales or {}
+    if psfimages is None:
+        spectra = get_wfss_spectra(tuple(configs), dtype=dtype, backend=backend)
+    else:
+        kernels = [numpy.asarray(psfimages[config], dtype=dtype) for config in configs]
+        spectra = convolution.kernel_spectra((2322, 2322), kernels, backend=backend, workers=workers)
+
+    # Transform each distinct scene once
+    outimages = {}
+    groups = {}
+    for n, (filtername, _) in enumerate(configs):
+        groups.setdefault(id(scenes[filtername]), []).append(n)
+    for members in groups.values():
+        scene = scenes[configs[members[0]][0]]
+        field_image = numpy.array(scene[y0:y0 + 2322, x0:x0 + 2322], dtype=dtype)
+        _mask_field(field_image, spotmask)
+
+        group_spectra = ([spectra[0][n] for n in members], spectra[1], [spectra[2][n] for n in members],
+                         [spectra[3][n] for n in members])
+        group_scales = [scales.get(configs[n][0], 1.) for n in members]
+        results = convolution.fftconvolve_multi(field_image, scales=group_scales, spectra=group_spectra, backend=backend,
+                                                workers=workers)
+        for n, newimage in zip(members, results):
+            outimages[configs[n]] = newimage
+
+    # Add the background analytically and the throughput
+    for config, newimage in outimages.items():
+        if background:
+            if psfimages is None and cached_spotmask:
+                background_pattern = get_background_pattern(*config, dtype=dtype)
+            else:
+                psfimage = psfimages[config] if psfimages is not None else get_wfss_psf(*config, dtype=dtype)
+                background_pattern = make_background_pattern(psfimage, spotmask, dtype=dtype)
+            newimage += background * background_pattern
+        newimage *= throughput
+
+    return outimages
+
+
+def wfss_scene_dither(scene_image, filtername, grismname, offsets, psffile=None, throughput=0.8,
+                      psfimage=None, spotmask=None, dtype=None, backend=None, workers=None, max_memory=None,
+                      background=0., background_pattern=None):
+    """
+    Disperse a scene at several read-out offsets, e.g. the positions of a
+    dither pattern.
+
+    The canvas covering every read-out area is dispersed once without the
+    spot mask.  Each read-out area is then cut from it and corrected by
+    subtracting the dispersed light of the sources it should not hold:
+    those in the strips of the canvas outside the area, which are as wide
+    as the dither, and those behind the occulting spots.  Both are small,
+    so a 4 or 9 point dither costs little more than one position.
+
+    Parameters
+    ----------
+    scene_image: sequence
+        The imaging scene to disperse
+    offsets: sequence
+        The (x0, y0) lower left corners of the POM image read-out areas
+
+    All other parameters are as for wfss_scene; max_memory only applies
+    to the dispersion of the canvas.
+
+    Returns
+    -------
+    outimages: np.ndarray, None
+        The (N, 2322, 2322) dispersed scenes, one per offset
+    """
+    # Valid grisms and filters
+    grisms = ['GR150R', 'GR150C']
+    filters = ['F090W', 'F115W', 'F140M', 'F150W', 'F158M', 'F200W']
+    if not grismname.upper() in grisms:
+        print('Error: bad grism name {} passed to wfss_scene_dither'.format(grismname))
+        return None
+    if not filtername.upper() in filters:
+        print('Error: bad filter name {} passed to wfss_scene_dither'.format(filtername))
+        return None
+
+    # Check data shape
+    imshape = scene_image.shape
+    offsets = [(int(x0), int(y0)) for x0, y0 in offsets]
+    if not offsets:
+        print('Error in wfss_scene_dither: no offsets passed to the routine.')
+        return None
+    for x0, y0 in offsets:
+        if (x0 < 0) or (y0 < 0) or (x0 + 2322 > imshape[1]) or (y0 + 2322 > imshape[0]):
+            print('Error in wfss_scene_dither: bad image offset values ({}, {}) passed to the routine.'.format(x0, y0))
+            return None
+
+    # Get the spot mask data
+    cached_spotmask = spotmask is None
+    if cached_spotmask:
+        spotmask = get_spotmask()
 
     # Get the psf image
+    dtype = get_dtype(dtype)
+    cached_psf = psfimage is None
+    if cached_psf:
+        psfimage = get_wfss_psf(filtername, grismname, psffile=psffile, dtype=dtype)
+    else:
+        psfimage = numpy.asarray(psfimage, dtype=dtype)
+
+    # Disperse the canvas that holds every read-out area
+    cx0, cy0 = min(x0 for x0, _ in offsets), min(y0 for _, y0 in offsets)
+    cx1, cy1 = max(x0 for x0, _ in offsets) + 2322, max(y0 for _, y0 in offsets) + 2322
+    canvas = numpy.array(scene_image[cy0:cy1, cx0:cx1], dtype=dtype)
+    dispersed = convolution.fftconvolve(canvas, psfimage, mode='same', backend=backend, workers=workers,
+                                        max_memory=max_memory)
+
+    # A source at p lands on p + s - c of the 'same' convolution
+    centre = ((psfimage.shape[0] - 1) // 2, (psfimage.shape[1] - 1) // 2)
+    spots = _spot_regions(spotmask)
+
+    newimages = numpy.empty((len(offsets), 2322, 2322), dtype=dispersed.dtype)
+    for newimage, (x0, y0) in zip(newimages, offsets):
+        dy, dx = y0 - cy0, x0 - cx0
+        newimage[:] = dispersed[dy:dy + 2322, dx:dx + 2322]
+
+        # The canvas strips outside this read-out area, and the sources
+        # behind the spots, as (y, x, weights) patches in canvas pixels
+        strips = [(slice(0, dy), slice(0, canvas.shape[1])), (slice(dy + 2322, canvas.shape[0]), slice(0, canvas.shape[1])),
+                  (slice(dy, dy + 2322), slice(0, dx)), (slice(dy, dy + 2322), slice(dx + 2322, canvas.shape[1]))]
+        patches = [(ys.start, xs.start, canvas[ys, xs]) for ys, xs in strips]
+        for ys, xs in spots:
+            py, px = dy + 137 + ys.start, dx + 137 + xs.start
+            patches.append((py, px, canvas[py:py + ys.stop - ys.start, px:px + xs.stop - xs.start] * (1 - spotmask[ys, xs])))
+
+        # Take their dispersed light out of the read-out area
+        for py, px, patch in patches:
+            convolution.add_convolved(newimage, patch, psfimage, (py - centre[0] - dy, px - centre[1] - dx), scale=-1.,
+                                      backend=backend, workers=workers)
+
+    # Add the background analytically
+    if background:
+        if background_pattern is None and cached_psf and cached_spotmask:
+            background_pattern = get_background_pattern(filtername, grismname, psffile=psffile, dtype=dtype)
+        elif background_pattern is None:
+            background_pattern = make_background_pattern(psfimage, spotmask, dtype=dtype)
+        newimages += background * background_pattern
+    newimages *= throughput
+
+    return newimages
+
+
+def _spot_regions(spotmask):
+    """
+    Find the bounding boxes of the occulting spots, the connected regions
+    where the spot mask is below 1, as (y, x) slices of the mask
+    """
+    labels, _ = ndimage.label(spotmask != 1)
+
+    return ndimage.find_objects(labels)
+
+
+def _mask_field(field_image, spotmask):
+    """
+    Apply the spot mask to the detector pixels of a 2322x2322 read-out area
+    in place
+    """
+    field_image[137:2185, 137:2185] *= spotmask
+
+    return field_image
+
+
+def spot_transmission(xpos, ypos, spotmask=None):
+    """
+    Find the occulting spot mask value of sources in the read-out area.
+
+    Parameters
+    ----------
+    xpos: np.ndarray
+        The x positions of the sources in the 2322x2322 read-out area
+    ypos: np.ndarray
+        The y positions of the sources in the read-out area
+    spotmask: np.ndarray
+        The 2048x2048 occulting spot mask, the cached one if None
+
+    Returns
+    -------
+    np.ndarray
+        The spot mask value of each source, 1 off the mask
+    """
+    if spotmask is None:
+        spotmask = get_spotmask()
+    sy = numpy.rint(numpy.asarray(ypos, dtype=float)).astype(int) - 137
+    sx = numpy.rint(numpy.asarray(xpos, dtype=float)).astype(int) - 137
+    inside = (sy >= 0) & (sy < spotmask.shape[0]) & (sx >= 0) & (sx < spotmask.shape[1])
+
+    transmission = numpy.ones(sy.shape)
+    transmission[inside] = spotmask[sy[inside], sx[inside]]
+
+    return transmission
+
+
+def make_background_pattern(psfimage, spotmask, dtype=None, overlap=64, spectra=None, backend=None):
+    """
+    Disperse a unit background over the read-out area.
+
+    A constant background B in the scene disperses to B times this
+    pattern, so the background never has to be convolved with the scene.
+
+    Parameters
+    ----------
+    psfimage: np.ndarray
+        The WFSS PSF image, or a (ny, nx, ky, kx) array of tile PSFs
+    spotmask: np.ndarray
+        The 2048x2048 occulting spot mask
+    dtype: str or type
+        The floating point type of the pattern
+    overlap: int
+        The width in pixels of the blending ramps between tiles
+    spectra: tuple
+        The convolution.tiled_spectra of the tile PSFs, if already known
+    backend: str
+        The FFT convolution backend, the convolution module default if None
+
+    Returns
+    -------
+    np.ndarray
+        The 2322x2322 dispersed unit background, before the throughput
+    """
+    field_image = _mask_field(numpy.ones((2322, 2322), dtype=get_dtype(dtype)), spotmask)
+    if psfimage.ndim == 4:
+        return convolution.tiled_convolve(field_image, psfimage, overlap=overlap, spectra=spectra, backend=backend)
+
+    return convolution.fftconvolve(field_image, psfimage, mode='same', backend=backend)
+
+
+@lru_cache(maxsize=12)
+def get_background_pattern(filtername, grismname, psffile=None, dtype=None, ntiles=None, overlap=64, backend=None):
+    """
+    Disperse a unit background with a cached WFSS PSF and the spot mask
+    once and cache it, see make_background_pattern
+
+    Parameters
+    ----------
+    filtername: str
+       A WFSS blocking filter name
+    grimsname: str
+        The NIRISS GR150 grism name, either 'GR150R' or 'GR150C'
+    psffile: str
+        The path to an alternate WFSS PSF image, or PSF grid with ntiles
+    dtype: str or type
+        The floating point type of the pattern
+    ntiles: tuple
+        The number of (y, x) tiles for the field-dependent PSF, see
+        get_wfss_tile_spectra; the single PSF if None
+    overlap: int
+        The width in pixels of the blending ramps between tiles
+    backend: str
+        The FFT convolution backend, the convolution module default if
+        None; pass the one the scene uses so both share the cached
+        get_wfss_tile_spectra
+
+    Returns
+    -------
+    np.ndarray
+        The read-only 2322x2322 dispersed unit background
+    """
+    if ntiles is None:
+        psfimage, spectra = get_wfss_psf(filtername, grismname, psffile=psffile, dtype=dtype), None
+    else:
+        psfimage, spectra = get_wfss_tile_spectra(filtername, grismname, tuple(ntiles), overlap=overlap, psffile=psffile,
+                                                  dtype=dtype, backend=backend)
+    pattern = make_background_pattern(psfimage, get_spotmask(), dtype=dtype, overlap=overlap, spectra=spectra,
+                                      backend=backend)
+    pattern.flags.writeable = False
+
+    return pattern
+
+
+@lru_cache(maxsize=1)
+def get_wfss_spectra(configs, psffile=None, dtype=None, backend=None):
+    """
+    Transform the WFSS PSFs of several filter and grism combinations once
+    and cache them, see convolution.kernel_spectra
+
+    The spectra are padded to the read-out area plus the PSF, so each
+    combination takes 30 to 45 MB at float32 for PSFs of 300x300 to
+    1000x1000 pixels, and twice that at float64.  All twelve combinations
+    take up to about 1 GB, so only the latest set is kept.
+
+    Parameters
+    ----------
+    configs: tuple
+        The (filtername, grismname) combinations
+    psffile: str
+        The path to alternate WFSS PSF images
+    dtype: str or type
+        The floating point type of the PSF images
+    backend: str
+        The FFT convolution backend, the convolution module default if None
+
+    Returns
+    -------
+    tuple
+        The kernel spectra, FFT shape, output starts and output shapes
+    """
+    kernels = [get_wfss_psf(filtername, grismname, psffile=psffile, dtype=dtype) for filtername, grismname in configs]
+
+    return convolution.kernel_spectra((2322, 2322), kernels, backend=backend)
+
+
+@lru_cache(maxsize=12)
+def get_wfss_psf(filtername, grismname, psffile=None, dtype=None):
+    """
+    Read a WFSS PSF image once and cache it
+
+    Parameters
+    ----------
+    filtername: str
+       A WFSS blocking filter name
+    grimsname: str
+        The NIRISS GR150 grism name, either 'GR150R' or 'GR150C'
+    psffile: str
+        The path to an alternate WFSS PSF image
+    dtype: str or type
+        The floating point type of the returned image
+
+    Returns
+    -------
+    np.ndarray
+        The read-only PSF image
+    """
     if psffile is None:
         psffile = resource_filename('grism_overlap', 'files/{}_{}_psfimage.fits'.format(filtername, grismname).lower())
-    psfimage = fits.getdata(psffile)
+    psfimage = numpy.array(fits.getdata(psffile), dtype=get_dtype(dtype))
+    psfimage.flags.writeable = False
 
-    # Make the final image
-    field_image = numpy.copy(scene_image[y0:y0 + 2322, x0:x0 + 2322])
-    y1 = y0 + 137
-    x1 = x0 + 137
-    field_image[y1:y1 + 2048, x1:x1 + 2048] = field_image[y1:y1 + 2048, x1:x1 + 2048] * spotmask
+    return psfimage
 
-    # Convolve with the psf with the field
-    newimage = signal.fftconvolve(field_image, psfimage, mode='same')
 
-    return newimage * throughput
+@lru_cache(maxsize=12)
+def get_wfss_psf_grid(filtername, grismname, psffile=None, dtype=None):
+    """
+    Read a grid of WFSS PSF images at several field positions once and
+    cache it
+
+    The file holds the (ny, nx, ky, kx) PSFs in its primary HDU and the
+    detector pixel positions of the grid rows and columns, in increasing
+    order, in its YPOS and XPOS extensions.
+
+    Parameters
+    ----------
+    filtername: str
+       A WFSS blocking filter name
+    grimsname: str
+        The NIRISS GR150 grism name, either 'GR150R' or 'GR150C'
+    psffile: str
+        The path to an alternate WFSS PSF grid
+    dtype: str or type
+        The floating point type of the returned images
+
+    Returns
+    -------
+    psfs, ypos, xpos
+        The read-only PSF images and the y and x detector positions of the
+        grid
+    """
+    if psffile is None:
+        psffile = resource_filename('grism_overlap', 'files/{}_{}_psfgrid.fits'.format(filtername, grismname).lower())
+    with fits.open(psffile) as hdulist:
+        psfs = numpy.array(hdulist[0].data, dtype=get_dtype(dtype))
+        ypos = numpy.array(hdulist['YPOS'].data, dtype=float)
+        xpos = numpy.array(hdulist['XPOS'].data, dtype=float)
+    if psfs.shape[:2] != (len(ypos), len(xpos)):
+        raise ValueError('The PSF grid in {} has shape {} but {} by {} positions.'.format(psffile, psfs.shape, len(ypos), len(xpos)))
+    for array in psfs, ypos, xpos:
+        array.flags.writeable = False
+
+    return psfs, ypos, xpos
+
+
+def interpolate_psf(psfs, ypos, xpos, y, x):
+    """
+    Interpolate a PSF grid bilinearly at a detector position.
+
+    Parameters
+    ----------
+    psfs: np.ndarray
+        The (ny, nx, ky, kx) PSF grid, see get_wfss_psf_grid
+    ypos: np.ndarray
+        The increasing y detector positions of the grid rows
+    xpos: np.ndarray
+        The increasing x detector positions of the grid columns
+    y: float
+        The y detector position
+    x: float
+        The x detector position
+
+    Returns
+    -------
+    np.ndarray
+        The PSF image, the one at the nearest edge of the grid for
+        positions beyond it
+    """
+    # The neighbouring grid points and the fraction of the way between
+    # them along each axis
+    steps = []
+    for positions, value in ((ypos, y), (xpos, x)):
+        if len(positions) == 1:
+            steps.append((0, 0, 0.))
+            continue
+        value = min(max(value, positions[0]), positions[-1])
+        i = min(max(numpy.searchsorted(positions, value, side='right') - 1, 0), len(positions) - 2)
+        steps.append((i, i + 1, (value - positions[i]) / (positions[i + 1] - positions[i])))
+    (iy0, iy1, fy), (ix0, ix1, fx) = steps
+
+    psfimage = (1 - fy) * ((1 - fx) * psfs[iy0, ix0] + fx * psfs[iy0, ix1]) + fy * ((1 - fx) * psfs[iy1, ix0] + fx * psfs[iy1, ix1])
+
+    return psfimage.astype(psfs.dtype)
+
+
+def tile_psfs(psfs, ypos, xpos, ntiles=(4, 4)):
+    """
+    Interpolate a PSF grid at the centre of each tile of the read-out area.
+
+    Parameters
+    ----------
+    psfs: np.ndarray
+        The (ny, nx, ky, kx) PSF grid, see get_wfss_psf_grid
+    ypos: np.ndarray
+        The increasing y detector positions of the grid rows
+    xpos: np.ndarray
+        The increasing x detector positions of the grid columns
+    ntiles: tuple
+        The number of (y, x) tiles of the 2322x2322 read-out area
+
+    Returns
+    -------
+    np.ndarray
+        The (ntiles[0], ntiles[1], ky, kx) tile PSFs, for
+        convolution.tiled_convolve
+    """
+    # Tile centres in detector pixels, which start at read-out pixel 137
+    ycentres = (numpy.arange(ntiles[0]) + 0.5) * 2322 / ntiles[0] - 137
+    xcentres = (numpy.arange(ntiles[1]) + 0.5) * 2322 / ntiles[1] - 137
+
+    return numpy.array([[interpolate_psf(psfs, ypos, xpos, y, x) for x in xcentres] for y in ycentres])
+
+
+@lru_cache(maxsize=2)
+def get_wfss_tile_spectra(filtername, grismname, ntiles=(4, 4), overlap=64, psffile=None, dtype=None, backend=None):
+    """
+    Interpolate the WFSS PSF grid at each tile of the read-out area and
+    transform the tile PSFs once, and cache them
+
+    Every tile is padded to the largest tile plus its ramps and the PSF,
+    so at four by four tiles an entry takes 60 MB at float32 for a
+    300x300 pixel PSF and 190 MB for a 1000x1000 one, twice that at
+    float64.  Two entries, e.g. both grisms of a filter, are kept.
+
+    Parameters
+    ----------
+    filtername: str
+       A WFSS blocking filter name
+    grimsname: str
+        The NIRISS GR150 grism name, either 'GR150R' or 'GR150C'
+    ntiles: tuple
+        The number of (y, x) tiles of the read-out area
+    overlap: int
+        The width in pixels of the blending ramps between tiles
+    psffile: str
+        The path to an alternate WFSS PSF grid
+    dtype: str or type
+        The floating point type of the PSF images
+    backend: str
+        The FFT convolution backend, the convolution module default if None
+
+    Returns
+    -------
+    psfimages, spectra
+        The read-only tile PSFs, see tile_psfs, and their
+        convolution.tiled_spectra
+    """
+    psfimages = tile_psfs(*get_wfss_psf_grid(filtername, grismname, psffile=psffile, dtype=dtype), ntiles=ntiles)
+    psfimages.flags.writeable = False
+
+    return psfimages, convolution.tiled_spectra((2322, 2322), psfimages, overlap=overlap, backend=backend)
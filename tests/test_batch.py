@@ -0,0 +1,85 @@
+"""
+Tests for batch.py module
+"""
+import json
+import os
+
+from astropy.table import Table
+import numpy as np
+import pytest
+
+from grism_overlap import soss_scene as ss
+from grism_overlap import visibility as vis
+
+# The batch runs through grism_overlap_tool, which needs the plotting and
+# catalog packages
+bt = pytest.importorskip('grism_overlap.batch')
+got = bt.got
+
+
+def test_read_targets(tmp_path):
+    """Test reading targets from CSV and JSON files"""
+    csvfile = str(tmp_path / 'targets.csv')
+    with open(csvfile, 'w') as f:
+        f.write('name,ra,dec\nwasp,10.5,-20.25\n,11.,12.\n')
+    targets = bt.read_targets(csvfile)
+    assert targets == [{'name': 'wasp', 'ra': 10.5, 'dec': -20.25}, {'name': '11.0_12.0', 'ra': 11., 'dec': 12.}]
+
+    jsonfile = str(tmp_path / 'targets.json')
+    with open(jsonfile, 'w') as f:
+        json.dump([{'ra': 1, 'dec': 2}, {'ra': 3}], f)
+    with pytest.raises(ValueError):
+        bt.read_targets(jsonfile)
+
+
+def test_run_batch(tmp_path, monkeypatch):
+    """Test a batch of synthetic targets matches the ratio of each frame"""
+    psf = np.zeros((40, 60), dtype=np.float32)
+    psf[18:22, 5:55] = 1.
+    spotmask = np.ones((2048, 2048))
+
+    # The target sits on the subarray, POM image pixel (1975, 1100), and a
+    # neighbour next to it
+    ty, tx = 781 + 1975, 25 + 1100
+    scene = np.zeros((4231, 4231), dtype=np.float32)
+    scene[ty + 1, tx + 10] = 0.5
+    star_table = Table({'xloc': [tx + 10.], 'yloc': [ty + 1.], 'flux': [0.5]})
+
+    def grism_overlap_soss(ra, dec, pa, background=0.1, **kwargs):
+        """The target alone"""
+        target = np.zeros_like(scene)
+        target[ty, tx] = 1.
+        frame, _ = got.rotate_disperse_trim(pa, target, 'SUBSTRIP96', star_table, psfimage=psf, spotmask=spotmask, background=background)
+        return frame
+
+    monkeypatch.setattr(got, 'grism_overlap_soss', grism_overlap_soss)
+    monkeypatch.setattr(got, 'prepare_scene', lambda ra, dec, **kwargs: (scene, star_table))
+    monkeypatch.setattr(got, 'scene_radius', lambda subarray: 100.)
+    monkeypatch.setattr(bt.si, 'get_siaf', lambda instrument: None)
+    monkeypatch.setattr(ss, 'get_psf_image', lambda dtype=None: psf)
+    monkeypatch.setattr(ss, 'get_psf_support', lambda dtype=None: ss.convolution.kernel_support(psf))
+    monkeypatch.setattr(ss, 'get_spotmask', lambda: spotmask)
+
+    # The second target can never be scheduled
+    def allowed_pas(ra, dec, start=None, end=None):
+        return np.arange(360), np.full(360, ra < 50.)
+
+    monkeypatch.setattr(vis, 'allowed_pas', allowed_pas)
+
+    targets = [{'name': 'a', 'ra': 10., 'dec': 0.}, {'name': 'b', 'ra': 60., 'dec': 0.}, {'name': 'c', 'ra': 20., 'dec': 0.}]
+    summary = bt.run_batch(targets, str(tmp_path), subarray='SUBSTRIP96', skip_PA=180, nproc=2, chunk_size=2, dtype='float32')
+
+    assert list(summary['name']) == ['a', 'b', 'c']
+    assert list(summary['n_pa']) == [2, 0, 2]
+    assert np.isnan(summary['best_pa'][1])
+    assert os.path.exists(str(tmp_path / 'summary.csv'))
+
+    # The saved ratios are the contamination of each frame
+    result = np.load(str(tmp_path / 'a.npz'))
+    assert result['ratio'].shape == (2, 2048)
+    targ_frame = grism_overlap_soss(10., 0., 0, background=0.)
+    mask = got.ct.trace_mask(targ_frame)
+    frame, _ = got.rotate_disperse_trim(0, scene, 'SUBSTRIP96', star_table, psfimage=psf, spotmask=spotmask)
+    assert np.allclose(result['ratio'][0], got.ct.contamination_ratio(frame, mask, got.ct.aperture_flux(targ_frame, mask)), equal_nan=True)
+    assert np.nanmax(result['ratio'][0]) > 0
+    assert np.load(str(tmp_path / 'b.npz'))['ratio'].shape == (0, 2048)
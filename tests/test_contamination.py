@@ -0,0 +1,130 @@
+"""
+Tests for contamination.py module
+"""
+from astropy.table import Table
+import numpy as np
+from scipy.signal import convolve
+
+from grism_overlap import contamination as ct
+from grism_overlap import scene_image as si
+from grism_overlap import soss_scene as ss
+
+
+def _frames():
+    """A target trace along row 5 on a background and a contaminant frame"""
+    targ_frame = np.full((12, 8), 0.1)
+    targ_frame[4:7, :] += [[1.], [10.], [1.]]
+    targ_frame[:, -1] = 0.1
+    contam_frame = np.zeros((12, 8))
+    contam_frame[5, 2] = 5.5
+    contam_frame[0, 3] = 100.
+    contam_frame[6, 4] = np.nan
+
+    return targ_frame, contam_frame
+
+
+def test_trace_mask():
+    """Test the trace is found above the background"""
+    targ_frame, _ = _frames()
+    mask = ct.trace_mask(targ_frame, fraction=0.05)
+    assert mask.shape == targ_frame.shape
+    assert mask[4:7, :-1].all()
+    assert not mask[:4].any() and not mask[7:].any()
+
+    # A flat column has no trace
+    assert not mask[:, -1].any()
+
+
+def test_contamination_ratio():
+    """Test the ratio only counts flux inside the trace"""
+    targ_frame, contam_frame = _frames()
+    mask = ct.trace_mask(targ_frame, fraction=0.05)
+    target_flux = ct.aperture_flux(targ_frame, mask)
+    assert np.allclose(target_flux[:-1], 12.3)
+
+    ratio = ct.contamination_ratio(contam_frame, mask, target_flux)
+    assert ratio.shape == (8,)
+    assert np.isclose(ratio[2], 5.5 / 12.3)
+    assert ratio[3] == 0. and ratio[4] == 0.
+    assert np.isnan(ratio[-1])
+
+
+def test_summarize():
+    """Test the summary statistics of a sweep"""
+    ratio = np.array([[0.1, 0.2, np.nan], [0.001, 0.002, np.nan], [0.05, 0.0, np.nan]])
+    summary = ct.summarize([0, 10, 20], ratio, level=0.01)
+    assert summary['best_pa'] == 10
+    assert np.allclose(summary['max_ratio'], [0.2, 0.002, 0.05])
+    assert np.array_equal(summary['n_contaminated'], [2, 0, 1])
+
+    assert ct.summarize([], np.empty((0, 3)))['best_pa'] is None
+
+
+def test_source_contributions():
+    """Test the per-source contributions add up to the ratio of the dispersed frame"""
+    rng = np.random.default_rng(40)
+    psf = rng.random((15, 21))
+    window = (20, 40, 5, 75)
+
+    # A target and three neighbours at POM field positions
+    ypos, xpos, flux = np.array([28, 24, 33, 50]), np.array([40, 30, 52, 10]), np.array([10., 2., 1., 5.])
+
+    def disperse(sources):
+        field = np.zeros((60, 80))
+        field[ypos[sources], xpos[sources]] = flux[sources]
+        return 0.8 * convolve(field, psf, mode='same', method='direct')[20:40, 5:75]
+
+    targ_frame = disperse([0])
+    mask = ct.trace_mask(targ_frame, fraction=0.2)
+    target_flux = ct.aperture_flux(targ_frame, mask)
+    ratio = ct.contamination_ratio(disperse([1, 2, 3]), mask, target_flux)
+
+    index, column, source_ratio = ct.source_contributions(xpos[1:] - 5, ypos[1:] - 20, flux[1:], mask, target_flux, psf, subarray=window)
+    assert set(index) == {0, 1}
+    total = np.bincount(column, weights=source_ratio, minlength=70)
+    assert np.allclose(total, np.nan_to_num(ratio))
+
+    # A source left of the POM image is not dispersed, though its PSF
+    # would reach the subarray
+    edge_index, _, _ = ct.source_contributions([-1, 1], [5, 5], [1., 1.], np.ones((10, 30), dtype=bool), np.ones(30),
+                                               np.ones((5, 5)), subarray=(0, 10, 0, 30))
+    assert set(edge_index) == {1}
+
+    # Look up the worst neighbour at a PA
+    star_table = Table({'name': ['a', 'b', 'c'], 'flux': flux[1:], 'xloc': xpos[1:] + 1000., 'yloc': ypos[1:] + 1000.})
+    positions = [{'xloc': xpos[1:] - 5, 'yloc': ypos[1:] - 20, 'PA': pa} for pa in [0., 10.]]
+    table = ct.contributions_table(star_table, positions, mask, target_flux, psf, subarray=window, threshold=0.)
+    assert len(table) == 2 * len(index)
+    top = ct.top_contributors(table, 0.)
+    assert top['source'][0] == ['a', 'b'][np.argmax(np.bincount(index, weights=source_ratio))]
+
+
+def test_contributions_rotated():
+    """Test the contributions add up to the ratio of a rotated scene"""
+    pa = 30.
+    rng = np.random.default_rng(40)
+    psf = np.zeros((15, 201))
+    psf[:, 20:180] = np.exp(-0.5 * ((np.arange(15) - 7) / 2.) ** 2)[:, None] * rng.uniform(0.5, 1., 160)
+    spotmask = np.ones((2048, 2048))
+
+    # A target and three neighbours that rotate onto SUBSTRIP96, whose
+    # origin is at scene pixel (2710, 162)
+    xpos, ypos = si.rotate_positions([1162., 1202., 1122., 1262.], [2758., 2759., 2757., 2758.], -pa)
+    xpos, ypos, flux = np.rint(xpos), np.rint(ypos), np.array([10., 2., 1., 5.])
+
+    def disperse(sources):
+        scene = np.zeros((4231, 4231))
+        scene[ypos[sources].astype(int), xpos[sources].astype(int)] = flux[sources]
+        return ss.soss_scene(si.rotate_image(scene, pa), psfimage=psf, spotmask=spotmask, window='SUBSTRIP96', dtype='float64')
+
+    targ_frame = disperse([0])
+    mask = ct.trace_mask(targ_frame)
+    target_flux = ct.aperture_flux(targ_frame, mask)
+    ratio = ct.contamination_ratio(disperse([1, 2, 3]), mask, target_flux)
+
+    star_table = Table({'name': ['a', 'b', 'c'], 'flux': flux[1:], 'xloc': xpos[1:], 'yloc': ypos[1:]})
+    xloc, yloc = ss.subarray_positions(*si.rotate_positions(xpos[1:], ypos[1:], pa), 'SUBSTRIP96')
+    table = ct.contributions_table(star_table, [{'xloc': xloc, 'yloc': yloc, 'PA': pa}], mask, target_flux, psf, subarray='SUBSTRIP96',
+                                   spotmask=spotmask, threshold=0.)
+    total = np.bincount(table['column'], weights=table['ratio'], minlength=2048)
+    assert np.isclose((total * target_flux).sum(), np.nansum(ratio * target_flux), rtol=0.02)
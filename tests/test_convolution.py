@@ -0,0 +1,175 @@
+"""
+Tests for convolution.py module
+"""
+import numpy as np
+import pytest
+from scipy import signal
+
+from grism_overlap import convolution as cv
+
+
+def test_fftconvolve():
+    """Test fftconvolve matches scipy.signal.fftconvolve"""
+    rng = np.random.default_rng(4)
+    image = rng.random((123, 98))
+    kernel = rng.random((31, 57))
+
+    for mode in ['full', 'same', 'valid']:
+        expected = signal.fftconvolve(image, kernel, mode=mode)
+        for workers in [1, -1]:
+            result = cv.fftconvolve(image, kernel, mode=mode, workers=workers)
+            assert result.shape == expected.shape
+            assert np.allclose(result, expected)
+        assert np.allclose(cv.fftconvolve(image, kernel, mode=mode, backend='signal'), expected)
+
+    # Single precision stays single precision
+    assert cv.fftconvolve(image.astype(np.float32), kernel.astype(np.float32)).dtype == np.float32
+
+    # Bad backend and mode
+    with pytest.raises(ValueError):
+        cv.fftconvolve(image, kernel, backend='foobar')
+    with pytest.raises(ValueError):
+        cv.fftconvolve(image, kernel, mode='foobar')
+
+
+def test_set_backend():
+    """Test the global backend settings"""
+    previous = cv.set_backend(workers=2)
+    try:
+        assert cv.get_backend()['workers'] == 2
+        assert cv.get_workers() == 2
+        assert cv.get_workers(-1) >= 1
+        with pytest.raises(ValueError):
+            cv.set_backend('foobar')
+        if cv.pyfftw is None:
+            with pytest.raises(ValueError):
+                cv.set_backend('pyfftw')
+    finally:
+        cv.set_backend(**previous)
+    assert cv.get_backend() == previous
+
+
+def test_oaconvolve():
+    """Test the overlap-add mode matches fftconvolve under a memory ceiling"""
+    rng = np.random.default_rng(5)
+    image = rng.random((150, 130))
+    kernel = rng.random((401, 333))
+
+    expected = signal.fftconvolve(image, kernel, mode='same')
+    for max_memory in [None, 2e6, 5e5]:
+        assert np.allclose(cv.oaconvolve(image, kernel, max_memory=max_memory), expected)
+        assert np.allclose(cv.fftconvolve(image, kernel, max_memory=max_memory), expected)
+
+    # Blocks are chosen to fit the budget
+    blocks = cv._choose_blocks(image.shape, kernel.shape, image.shape, np.float64, 5e5)
+    assert blocks != [[150, 150], [130, 130]]
+
+    # A budget smaller than the output cannot be met
+    with pytest.raises(ValueError):
+        cv.oaconvolve(image, kernel, max_memory=1000)
+
+
+def test_fftconvolve_stack():
+    """Test the batched stack convolution matches single convolutions"""
+    rng = np.random.default_rng(6)
+    images = rng.random((5, 90, 70))
+    kernel = rng.random((201, 151))
+
+    for max_memory in [None, 6e6]:
+        result = cv.fftconvolve_stack(images, kernel, max_memory=max_memory)
+        assert result.shape == images.shape
+        for image, convolved in zip(images, result):
+            assert np.allclose(convolved, signal.fftconvolve(image, kernel, mode='same'))
+
+    # A budget too small for one image
+    with pytest.raises(ValueError):
+        cv.fftconvolve_stack(images, kernel, max_memory=1000)
+
+
+def test_fftconvolve_multi():
+    """Test one image spectrum serves kernels of different shapes"""
+    rng = np.random.default_rng(48)
+    image = rng.random((90, 70))
+    kernels = [rng.random((201, 151)), rng.random((5, 31)), rng.random((40, 3))]
+
+    for mode in ['same', 'full', 'valid']:
+        results = cv.fftconvolve_multi(image, kernels, mode=mode, scales=[1., 2., 0.5])
+        for result, kernel, scale in zip(results, kernels, [1., 2., 0.5]):
+            assert np.allclose(result, scale * signal.fftconvolve(image, kernel, mode=mode))
+
+    # Precomputed spectra give the same results
+    spectra = cv.kernel_spectra(image.shape, kernels)
+    for result, kernel in zip(cv.fftconvolve_multi(image, spectra=spectra), kernels):
+        assert np.allclose(result, signal.fftconvolve(image, kernel, mode='same'))
+
+
+def test_windowed_convolve():
+    """Test a window of the convolution matches the full calculation"""
+    rng = np.random.default_rng(8)
+    image = np.zeros((300, 280))
+    image[rng.integers(0, 300, 30), rng.integers(0, 280, 30)] = rng.random(30)
+    kernel = np.zeros((501, 601))
+    kernel[230:270, 100:500] = rng.random((40, 400))
+    support = cv.kernel_support(kernel)
+    assert support == (230, 270, 100, 500)
+
+    for dense in [False, True]:
+        expected = signal.fftconvolve(image + 0.1 * dense, kernel, mode='same')
+        for window in [(200, 264, 10, 270), (0, 300, 0, 280), (290, 300, 0, 5)]:
+            for method in ['auto', 'fft', 'direct']:
+                result = cv.windowed_convolve(image + 0.1 * dense, kernel, window, support=support, method=method)
+                assert np.allclose(result, expected[window[0]:window[1], window[2]:window[3]])
+
+    # The memory ceiling reaches the FFT of the reduced problem
+    result = cv.windowed_convolve(image + 0.1, kernel, (0, 300, 0, 280), support=support, method='fft', max_memory=2e6)
+    assert np.allclose(result, expected)
+
+    with pytest.raises(ValueError):
+        cv.windowed_convolve(image, kernel, (0, 10, 0, 10), method='foobar')
+
+
+def test_tiled_convolve():
+    """Test the tiled convolution blends the tile kernels"""
+    for n, ntiles, overlap in [(500, 4, 20), (97, 3, 0), (50, 1, 64)]:
+        ranges, weights = cv.tile_weights(n, ntiles, overlap)
+        total = np.zeros(n)
+        for (start, stop), weight in zip(ranges, weights):
+            total[start:stop] += weight
+        assert np.allclose(total, 1.)
+    with pytest.raises(ValueError):
+        cv.tile_weights(100, 4, 30)
+
+    rng = np.random.default_rng(50)
+    image = rng.random((300, 200))
+    kernel = rng.random((9, 41))
+
+    # One kernel everywhere is a plain convolution
+    kernels = np.broadcast_to(kernel, (3, 2) + kernel.shape)
+    for mode in ['full', 'same', 'valid']:
+        assert np.allclose(cv.tiled_convolve(image, kernels, overlap=16, mode=mode), signal.fftconvolve(image, kernel, mode=mode))
+
+    # A source in the core of a tile gets that tile's kernel, and one in
+    # the ramp between two tiles the weighted mean of their kernels, here
+    # half a pixel past the edge
+    kernels = rng.random((3, 2, 9, 41))
+    spectra = cv.tiled_spectra(image.shape, kernels, overlap=16)
+    for y, x, expected in [(150, 50, kernels[1, 0]), (100, 150, 0.46875 * kernels[0, 1] + 0.53125 * kernels[1, 1])]:
+        source = np.zeros(image.shape)
+        source[y, x] = 1.
+        result = cv.tiled_convolve(source, kernels, overlap=16, mode='full', spectra=spectra)
+        assert np.allclose(result[y:y + 9, x:x + 41], expected)
+        assert np.isclose(result.sum(), expected.sum())
+
+
+def test_add_convolved():
+    """Test adding a patch convolution matches convolving the whole image"""
+    rng = np.random.default_rng(49)
+    kernel = rng.random((9, 31))
+    for patch in [np.eye(6), rng.random((40, 50))]:
+        image = np.zeros((100, 120))
+        image[60:60 + patch.shape[0], 70:70 + patch.shape[1]] = patch
+        expected = -signal.fftconvolve(image, kernel, mode='same')
+
+        # The 'same' output starts at the kernel centre of the full one
+        outimage = cv.add_convolved(np.zeros((100, 120)), patch, kernel, (60 - 4, 70 - 15), scale=-1.)
+        assert np.allclose(outimage, expected)
@@ -0,0 +1,33 @@
+"""
+Tests for grism_overlap_tool.py module
+"""
+from astropy.table import Table
+import numpy as np
+import pytest
+
+from grism_overlap import visibility as vis
+
+# The tool needs the plotting and catalog packages
+got = pytest.importorskip('grism_overlap.grism_overlap_tool')
+
+
+def test_soss_contam_never_visible(monkeypatch):
+    """Test a target that can never be scheduled gives empty results"""
+    targ_frame = np.zeros((96, 2048))
+    targ_frame[40:50] = 1.
+    star_table = Table({'name': ['a'], 'xloc': [2000.], 'yloc': [2100.], 'flux': [0.5]})
+
+    monkeypatch.setattr(got, 'grism_overlap_soss', lambda ra, dec, pa, **kwargs: targ_frame)
+    monkeypatch.setattr(got, 'prepare_scene', lambda ra, dec, **kwargs: (np.zeros((4231, 4231)), star_table))
+    monkeypatch.setattr(got, 'scene_radius', lambda subarray, psffile=None, angle=None: 100.)
+    monkeypatch.setattr(vis, 'allowed_pas', lambda ra, dec, start=None, end=None: (np.arange(360), np.zeros(360, bool)))
+
+    for adaptive in [False, True]:
+        contam_frames, frame, table, metrics = got.grism_overlap_soss_contam(10., 0., subarray='SUBSTRIP96', background=0., adaptive=adaptive,
+                                                                             contributions=True)
+        assert contam_frames.shape == (0, 96, 2048)
+        assert frame is targ_frame
+        assert len(table) == 0 and 'PA' in table.colnames
+        assert metrics['ratio'].shape == (0, 2048)
+        assert metrics['best_pa'] is None
+        assert len(metrics['contributions']) == 0
@@ -0,0 +1,126 @@
+"""
+Tests for pa_sweep.py module
+"""
+import numpy as np
+import pytest
+
+from grism_overlap import pa_sweep as ps
+
+
+def _column_sums(pa, scene_image, psfimage, scale=1.):
+    """A small per-PA function reading the shared arrays"""
+    return pa, scale * scene_image.sum(axis=0) + psfimage.sum()
+
+
+def test_run_sweep():
+    """Test all executors give the same results in PA order"""
+    arrays = {'scene_image': np.arange(20.).reshape(4, 5), 'psfimage': np.ones((3, 3))}
+    pa_list = [0, 10, 20, 30, 40]
+    expected = [_column_sums(pa, scale=2., **arrays) for pa in pa_list]
+
+    for executor in ps.EXECUTORS:
+        results = ps.run_sweep(_column_sums, pa_list, arrays=arrays, kwargs={'scale': 2.}, executor=executor, nproc=2)
+        assert [i[0] for i in results] == pa_list
+        for result, check in zip(results, expected):
+            assert np.array_equal(result[1], check[1])
+
+    with pytest.raises(ValueError):
+        ps.run_sweep(_column_sums, pa_list, arrays=arrays, executor='foobar')
+
+
+def test_shared_arrays():
+    """Test arrays round trip through shared memory read-only"""
+    array = np.random.default_rng(10).random((50, 40)).astype(np.float32)
+    with ps.SharedArrays({'scene': array}) as shared:
+        attached, blocks = ps.attach_arrays(shared.specs)
+        assert np.array_equal(attached['scene'], array)
+        assert attached['scene'].dtype == np.float32
+        assert not attached['scene'].flags.writeable
+        del attached
+        for block in blocks:
+            block.close()
+
+
+def test_adaptive_sweep():
+    """Test the adaptive sweep resolves a narrow feature with few evaluations"""
+    def metric(pa):
+        return np.array([np.exp(-(((pa - 127 + 180) % 360) - 180) ** 2 / 20.), 1.])
+
+    calls = []
+
+    def evaluate(pas):
+        calls.extend(pas)
+        return [metric(pa) for pa in pas]
+
+    pas, samples, dense_pas, curve = ps.adaptive_sweep(evaluate, coarse_step=10, min_step=1, rtol=0.05)
+
+    assert len(calls) == len(pas) < 100
+    assert np.array_equal(dense_pas, np.arange(360))
+    assert curve.shape == (360, 2)
+    assert np.allclose(curve[:, 1], 1.)
+    assert np.abs(curve[:, 0] - np.array([metric(pa)[0] for pa in dense_pas])).max() < 0.05
+
+    # A flat metric needs no refinement
+    pas, _, _, curve = ps.adaptive_sweep(lambda pas: [1.] * len(pas), coarse_step=30)
+    assert len(pas) == 12
+    assert np.allclose(curve, 1.)
+
+
+def test_interpolate_pa():
+    """Test interpolation wraps around 360 degrees"""
+    curve = ps.interpolate_pa(np.array([0., 355., 5.]), np.array([10., 350.]), np.array([0., 20.]))
+    assert np.allclose(curve, [10., 15., 5.])
+
+
+def test_stream_frames(tmp_path):
+    """Test frames are stored and reduced as they arrive, in memory or on disk"""
+    frames = [np.full((3, 4), pa, dtype=np.float32) for pa in range(5)]
+    frames[2][0, 0] = np.nan
+
+    for outfile in [None, str(tmp_path / 'frames.npy')]:
+        results = ((frame, 'table{}'.format(n)) for n, frame in enumerate(frames))
+        cube, column_sums, tables = ps.stream_frames(results, len(frames), outfile=outfile)
+        assert np.array_equal(cube, np.array(frames), equal_nan=True)
+        assert np.allclose(column_sums, np.nansum(np.array(frames), axis=1))
+        assert tables == ['table{}'.format(n) for n in range(5)]
+
+    assert np.array_equal(np.load(outfile), cube, equal_nan=True)
+
+    # Only keep a reduction of each frame
+    results = ((frame, n) for n, frame in enumerate(frames))
+    cube, maxima, extras = ps.stream_frames(results, len(frames), keep=False, reduce=np.nanmax)
+    assert cube is None
+    assert np.array_equal(maxima, [0., 1., 2., 3., 4.])
+
+    # Results stream through iter_sweep in order
+    results = ps.iter_sweep(_column_sums, [0, 10, 20], arrays={'scene_image': np.ones((2, 2)), 'psfimage': np.ones(1)}, nproc=2)
+    assert [i[0] for i in results] == [0, 10, 20]
+
+
+def test_checkpoint(tmp_path):
+    """Test a checkpointed sweep only computes the missing PAs on a rerun"""
+    computed = []
+
+    def compute(pas):
+        for pa in pas:
+            computed.append(pa)
+            yield np.full((2, 3), pa), {'pa': pa}
+
+    inputs = ps.hash_inputs(np.ones((4, 4)), ra=1., dec=2.)
+    assert inputs == ps.hash_inputs(np.ones((4, 4)), dec=2., ra=1.)
+    assert inputs != ps.hash_inputs(np.zeros((4, 4)), ra=1., dec=2.)
+
+    # Stop part way through
+    results = ps.Checkpoint(str(tmp_path), inputs).run([0, 10, 20, 30], compute)
+    next(results), next(results)
+    assert computed == [0, 10]
+
+    # Resume
+    results = list(ps.Checkpoint(str(tmp_path), inputs).run([0, 10, 20, 30], compute))
+    assert computed == [0, 10, 20, 30]
+    assert [i[1]['pa'] for i in results] == [0, 10, 20, 30]
+    assert np.array_equal(results[1][0], np.full((2, 3), 10))
+
+    # Other inputs start over
+    checkpoint = ps.Checkpoint(str(tmp_path), ps.hash_inputs(ra=3.))
+    assert not checkpoint.done(0)
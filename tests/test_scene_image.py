@@ -3,6 +3,8 @@ Tests for soss_scene.py module
 """
 from pkg_resources import resource_filename
 
+import numpy as np
+
 from grism_overlap import scene_image as si
 
 
@@ -36,6 +38,38 @@ def test_make_star_image():
             assert all([i is None for i in stars])
 
 
+def test_faint_sources():
+    """Test faint sources are pruned by relative or absolute flux"""
+    flux = np.array([100., 1., 0.01, 50., 0.5])
+    faint, dropped = si.faint_sources(flux, reference=100., min_flux_ratio=0.02)
+    assert np.array_equal(faint, [1, 2, 4])
+    assert np.isclose(dropped, 1.51)
+
+    faint, _ = si.faint_sources(flux, reference=100., min_flux_ratio=0.001, min_flux=0.6)
+    assert np.array_equal(faint, [2, 4])
+    assert len(si.faint_sources(flux)[0]) == 0
+
+    # Pruned sources leave the scene and are reported
+    file = resource_filename('grism_overlap', 'files/stars_bd60d1753_gaiadr3_allfilters.txt')
+    pos = 261.21781401047, 60.43076384536
+    scene, stars = si.make_star_image_and_table(file, pos, 'F200W', simple=True)
+    pruned_scene, pruned_stars = si.make_star_image_and_table(file, pos, 'F200W', simple=True, min_flux_ratio=1e-3)
+    assert pruned_stars.meta['n_pruned'] >= len(stars) - len(pruned_stars) > 0
+    assert np.all(pruned_stars['flux'][2:] >= 1e-3 * np.max(stars['flux'][:2]))
+    assert scene.sum() - pruned_scene.sum() <= pruned_stars.meta['pruned_flux'] * (1 + 1e-6)
+
+
+def test_catalog_radius():
+    """Test sources outside the radius are left out of the scene"""
+    file = resource_filename('grism_overlap', 'files/stars_bd60d1753_gaiadr3_allfilters.txt')
+    pos = 261.21781401047, 60.43076384536
+    scene, stars = si.make_star_image_and_table(file, pos, 'F200W', simple=True)
+    near_scene, near_stars = si.make_star_image_and_table(file, pos, 'F200W', simple=True, radius=60.)
+    assert np.all(near_stars['distance'] <= 60.)
+    assert list(near_stars['name']) == [name for name, distance in zip(stars['name'], stars['distance']) if distance <= 60.]
+    assert near_scene.sum() < scene.sum()
+
+
 def test_make_galaxy_image():
     """Test of make_galaxy_image function"""
     # Get the input
@@ -60,3 +94,31 @@ def test_make_galaxy_image():
             assert scene.shape == (4231, 4231)
         else:
             assert scene is None
+
+
+def test_rotate_positions():
+    """Test source positions follow rotate_image"""
+    image = np.zeros((201, 201))
+    image[40, 130] = 1.
+    yy, xx = np.indices(image.shape)
+
+    for angle in [0., 17., 90., 200., -30.]:
+        rotated = np.clip(si.rotate_image(image, angle), 0., None)
+        xpos, ypos = si.rotate_positions([130.], [40.], angle, shape=image.shape)
+        assert np.isclose(xpos[0], (rotated * xx).sum() / rotated.sum(), atol=0.2)
+        assert np.isclose(ypos[0], (rotated * yy).sum() / rotated.sum(), atol=0.2)
+
+
+def test_rotate_sources():
+    """Test the rotated stamps of isolated sources match rotate_image"""
+    image = np.zeros((201, 201))
+    image[40, 130] = 2.
+    image[150, 60] = 1.
+
+    for angle in [0., 0.5, 30., 200., -45.]:
+        rotated = si.rotate_image(image, angle)
+        stamps = si.rotate_sources([130., 60.], [40., 150.], angle, shape=image.shape)
+        xpos, ypos = si.rotate_positions([130., 60.], [40., 150.], angle, shape=image.shape)
+        for x, y, flux, stamp in zip(np.rint(xpos).astype(int), np.rint(ypos).astype(int), [2., 1.], stamps):
+            assert np.allclose(rotated[y - 16:y + 17, x - 16:x + 17], flux * stamp, atol=1e-10)
+        assert np.isclose(rotated.sum(), 2. * stamps[0].sum() + stamps[1].sum())
@@ -0,0 +1,58 @@
+"""
+Tests for soss_overlap.py module
+"""
+import numpy as np
+
+from grism_overlap import scene_image as si
+from grism_overlap import soss_overlap as so
+from grism_overlap import soss_scene as ss
+
+
+def _psf():
+    """A small PSF with three curved traces"""
+    psf = np.zeros((121, 401))
+    columns = np.arange(401)
+    for order, offset in enumerate([-40, 0, 45]):
+        rows = 60 + offset + ((columns - 200) / 60.) ** 2 * (order - 1)
+        good = (rows >= 0) & (rows < 121)
+        psf[rows[good].astype(int), columns[good]] = 1. / (order + 1)
+    return psf
+
+
+def test_occupancy():
+    """Test the coarse grid marks the cells holding significant pixels"""
+    image = np.zeros((10, 17))
+    image[9, 16] = 1.
+    image[0, 0] = 1e-6
+    grid = so.occupancy(image, binsize=4)
+    assert grid.shape == (3, 5)
+    assert np.array_equal(np.argwhere(grid), [[2, 4]])
+    assert so.occupancy(image, binsize=4, threshold=0.).sum() == 2
+
+
+def test_overlap_screen():
+    """Test the screen never misses a pixel level overlap"""
+    psf = _psf()
+    rng = np.random.default_rng(45)
+    xpos, ypos = rng.uniform(1200, 3000, 300), rng.uniform(1200, 3000, 300)
+    aperture = so.trace_aperture(1200, 2831, psf, 'SUBSTRIP256')
+    assert aperture.shape == (256, 2048) and aperture.any()
+
+    pa_list = np.arange(0, 360, 30)
+    overlaps = so.overlap_screen(xpos, ypos, pa_list, aperture, psf, 'SUBSTRIP256')
+    assert overlaps.shape == (12, 300)
+
+    exact = np.zeros_like(overlaps)
+    for n, pa in enumerate(pa_list):
+        x, y = si.rotate_positions(xpos, ypos, pa)
+        fx, fy = ss.subarray_positions(x, y, (0, 2322, 0, 2322))
+        for m in range(len(xpos)):
+            if 0 <= np.rint(fx[m]) < 2322 and 0 <= np.rint(fy[m]) < 2322:
+                exact[n, m] = (so.trace_aperture(x[m], y[m], psf, 'SUBSTRIP256') & aperture).any()
+
+    assert exact.any()
+    assert np.all(overlaps[exact])
+
+    # Coarser grids only add near misses, and one pixel cells are exact
+    assert np.array_equal(so.overlap_screen(xpos, ypos, pa_list, aperture, psf, 'SUBSTRIP256', binsize=1), exact)
+    assert np.all(so.overlap_screen(xpos, ypos, pa_list, aperture, psf, 'SUBSTRIP256', binsize=2) <= overlaps)
@@ -2,7 +2,9 @@
 Tests for soss_scene.py module
 """
 import numpy as np
+from scipy.signal import convolve
 
+from grism_overlap import scene_image as si
 from grism_overlap import soss_scene as sc
 
 
@@ -21,4 +23,220 @@ def test_soss_scene():
 
 def test_get_gr700_psf():
     """Test get_gr700_psf function"""
-    assert sc.get_gr700_psf().shape == (8192, 8192)
\ No newline at end of file
+    assert sc.get_gr700_psf().shape == (8192, 8192)
+
+
+def test_soss_workspace():
+    """Test the SossWorkspace buffers match the copying implementation"""
+    scene = np.random.default_rng(1).random((4231, 4231))
+    spotmask = np.ones((2048, 2048))
+    spotmask[1000:1010, 1000:1010] = 0.
+    workspace = sc.SossWorkspace(dtype='float64')
+
+    # Reference: shift the scene to the SOSS position then cut the POM area
+    shifted = scene * 0.
+    shifted[174:, 930:] = scene[0:4057, 0:3301]
+    expected = np.copy(shifted[955:3277, 955:3277])
+    expected[137:2185, 137:2185] *= spotmask
+    field = workspace.load_field(scene, spotmask, sossoffset=True)
+    assert np.array_equal(field, expected)
+
+    # Buffers are reused between calls
+    assert workspace.load_field(scene, spotmask, sossoffset=False) is field
+
+    # The canvas is zero outside the POM area
+    fov = workspace.embed(np.ones((2322, 2322)))
+    assert fov.shape == (4231, 4231)
+    assert fov.sum() == 2322 * 2322
+
+    # Synthetic PSF and spot mask can be passed in directly
+    psf = np.zeros((5, 5))
+    psf[2, 2] = 1.
+    out = sc.soss_scene(scene, psfimage=psf, spotmask=spotmask, throughput=1., workspace=workspace, dtype='float64')
+    assert np.allclose(out, expected)
+
+
+def test_soss_scene_precision():
+    """Test the float32 pipeline stays close to float64"""
+    rng = np.random.default_rng(2)
+    scene = np.full((4231, 4231), 0.1)
+    scene[rng.integers(0, 4231, 200), rng.integers(0, 4231, 200)] = rng.uniform(1e2, 1e6, 200)
+    spotmask = np.ones((2048, 2048))
+    psf = rng.random((101, 301))
+    psf /= psf.sum()
+
+    out32 = sc.soss_scene(scene, psfimage=psf, spotmask=spotmask, dtype='float32')
+    out64 = sc.soss_scene(scene, psfimage=psf, spotmask=spotmask, dtype='float64')
+    assert out32.dtype == np.float32
+    assert out64.dtype == np.float64
+
+    # Errors are bounded relative to the brightest pixel
+    assert np.max(np.abs(out32 - out64)) < 1e-5 * np.max(np.abs(out64))
+
+
+def test_soss_scene_stack():
+    """Test the stacked dispersion matches one PA at a time"""
+    rng = np.random.default_rng(7)
+    scenes = np.zeros((2, 4231, 4231), dtype=np.float32)
+    scenes[:, rng.integers(0, 4231, 50), rng.integers(0, 4231, 50)] = 100.
+    spotmask = np.ones((2048, 2048))
+    psf = rng.random((51, 151))
+
+    stack = sc.soss_scene_stack(scenes, psfimage=psf, spotmask=spotmask, dtype='float32')
+    assert stack.shape == (2, 2322, 2322)
+    for scene, dispersed in zip(scenes, stack):
+        single = sc.soss_scene(scene, psfimage=psf, spotmask=spotmask, dtype='float32')
+        assert np.allclose(dispersed, single, atol=1e-4 * single.max())
+
+    # Returns None if wrong shape
+    assert sc.soss_scene_stack(np.ones((2, 100, 200))) is None
+
+
+def test_soss_scene_window():
+    """Test subarray windows match the trimmed full dispersion"""
+    rng = np.random.default_rng(9)
+    scene = np.zeros((4231, 4231))
+    scene[rng.integers(0, 4231, 300), rng.integers(0, 4231, 300)] = 100.
+    spotmask = np.ones((2048, 2048))
+    psf = np.zeros((801, 2501))
+    psf[380:420, 200:2300] = rng.random((40, 2100))
+
+    full = sc.soss_scene(scene, psfimage=psf, spotmask=spotmask, dtype='float64')
+    for subarray, (y0, y1, x0, x1) in sc.SUBARRAY_WINDOWS.items():
+        window = sc.soss_scene(scene, psfimage=psf, spotmask=spotmask, dtype='float64', window=subarray)
+        assert np.allclose(window, full[y0:y1, x0:x1])
+
+    # A support found once for a sweep
+    support = sc.convolution.kernel_support(psf)
+    window = sc.soss_scene(scene, psfimage=psf, spotmask=spotmask, dtype='float64', window='SUBSTRIP96', support=support)
+    assert np.allclose(window, full[1929:2025, 137:2185])
+
+
+def test_subarray_positions():
+    """Test scene positions are shifted to the subarray origin"""
+    xpos, ypos = np.array([162., 1000.]), np.array([918., 2710.])
+
+    x, y = sc.subarray_positions(xpos, ypos, 'FULL')
+    assert np.array_equal(x, [0., 838.]) and np.array_equal(y, [0., 1792.])
+
+    x, y = sc.subarray_positions(xpos, ypos, 'SUBSTRIP256')
+    assert np.array_equal(x, [0., 838.]) and np.array_equal(y, [-1792., 0.])
+
+    x, y = sc.subarray_positions(xpos, ypos, 'FULL', sossoffset=False)
+    assert np.array_equal(x, [-930., -92.])
+
+    # The input arrays are not modified
+    assert np.array_equal(xpos, [162., 1000.])
+
+
+def test_add_sources():
+    """Test adding and removing sources matches dispersing the scene"""
+    rng = np.random.default_rng(41)
+    psf = rng.random((15, 21))
+    spotmask = np.ones((2048, 2048))
+    spotmask[10:20, 20:30] = 0.5
+    window = (140, 170, 145, 215)
+    ypos, xpos, flux = np.array([150, 165, 180]), np.array([160, 200, 150]), np.array([3., 1., 2.])
+
+    def disperse(sources):
+        field = np.zeros((400, 400))
+        field[ypos[sources], xpos[sources]] = flux[sources] * spotmask[ypos[sources] - 137, xpos[sources] - 137]
+        return 0.8 * convolve(field, psf, mode='same', method='direct')[140:170, 145:215]
+
+    frame = disperse([0])
+    sc.add_sources(frame, xpos[1:] - 145, ypos[1:] - 140, flux[1:], window=window, psfimage=psf, spotmask=spotmask)
+    assert np.allclose(frame, disperse([0, 1, 2]))
+
+    sc.add_sources(frame, xpos[:1] - 145, ypos[:1] - 140, -flux[:1], window=window, psfimage=psf, spotmask=spotmask)
+    assert np.allclose(frame, disperse([1, 2]))
+
+    # Sources outside the POM image are not dispersed
+    frame = np.zeros((10, 30))
+    sc.add_sources(frame, [23, 28], [5, 5], [1., 1.], window=(0, 10, 2300, 2330), psfimage=np.ones((5, 5)), spotmask=spotmask)
+    assert not frame.any()
+
+
+def test_add_sources_rotated():
+    """Test removing and adding back a source of a rotated scene"""
+    pa = 0.5
+    rng = np.random.default_rng(41)
+    psf = np.zeros((15, 201))
+    psf[4:11, 20:180] = rng.random((7, 160))
+    spotmask = np.ones((2048, 2048))
+
+    # Two sources that rotate onto SUBSTRIP96, whose origin is at scene
+    # pixel (2710, 162)
+    xpos, ypos = np.array([1160., 1230.]), np.array([2750., 2770.])
+    flux = np.array([3., 2.])
+
+    def disperse(sources):
+        scene = np.zeros((4231, 4231))
+        scene[ypos[sources].astype(int), xpos[sources].astype(int)] = flux[sources]
+        return sc.soss_scene(si.rotate_image(scene, pa), psfimage=psf, spotmask=spotmask, window='SUBSTRIP96', dtype='float64')
+
+    frame = disperse([0, 1])
+    original = frame.copy()
+    xloc, yloc = sc.subarray_positions(*si.rotate_positions(xpos[1:], ypos[1:], pa), 'SUBSTRIP96')
+    stamps = si.rotate_sources(xpos[1:], ypos[1:], pa)
+
+    sc.add_sources(frame, xloc, yloc, -flux[1:], window='SUBSTRIP96', psfimage=psf, spotmask=spotmask, stamps=stamps)
+    assert np.allclose(frame, disperse([0]), atol=1e-5 * original.max())
+
+    sc.add_sources(frame, xloc, yloc, flux[1:], window='SUBSTRIP96', psfimage=psf, spotmask=spotmask, stamps=stamps)
+    assert np.allclose(frame, original, atol=1e-5 * original.max())
+
+
+def test_background_pattern():
+    """Test the analytic background matches dispersing it with the scene"""
+    rng = np.random.default_rng(42)
+    scene = np.zeros((4231, 4231))
+    scene[rng.integers(800, 3000, 50), rng.integers(100, 2300, 50)] = rng.uniform(1., 100., 50)
+    psf = rng.random((9, 15))
+    spotmask = np.ones((2048, 2048))
+    spotmask[1000:1010, 1000:1010] = 0.
+    kwargs = {'psfimage': psf, 'spotmask': spotmask, 'dtype': 'float64'}
+
+    expected = sc.soss_scene(scene + 0.1, **kwargs)
+    assert np.allclose(sc.soss_scene(scene, background=0.1, **kwargs), expected)
+
+    # Recombine the sources with other backgrounds and throughputs
+    pattern = sc.make_background_pattern(psf, spotmask, dtype='float64')
+    sources = sc.soss_scene(scene, throughput=1., **kwargs)
+    assert np.allclose(sc.recombine(sources, pattern, background=0.1), expected)
+    assert np.allclose(sc.recombine(sources, pattern, background=0.3, throughput=0.5),
+                       sc.soss_scene(scene + 0.3, throughput=0.5, **kwargs))
+
+    # Windows are cut from the same pattern
+    window = sc.SUBARRAY_WINDOWS['SUBSTRIP96']
+    out = sc.soss_scene(scene, background=0.1, window='SUBSTRIP96', **kwargs)
+    assert np.allclose(out, expected[window[0]:window[1], window[2]:window[3]])
+
+    # And added to every scene of a stack
+    out = sc.soss_scene_stack(np.array([scene, 2 * scene]), background=0.1, **kwargs)
+    assert np.allclose(out[0], expected)
+
+
+def test_footprint_radius():
+    """Test the footprint radius covers the sources the PSF carries onto the subarray"""
+    # The whole POM image
+    assert np.isclose(sc.footprint_radius(sossoffset=False), np.hypot(1161, 1161))
+
+    # A single pixel PSF only reaches the subarray itself
+    psf = np.zeros((5, 5))
+    psf[2, 2] = 1.
+    radius = sc.footprint_radius('SUBSTRIP96', psf.shape, support=(2, 3, 2, 3))
+    assert np.isclose(radius, np.hypot(2024 + 781 - 2115, 137 + 25 - 2115))
+
+    # A PSF extending right of its centre reaches the subarray from further left
+    wider = sc.footprint_radius('SUBSTRIP96', psf.shape, support=(2, 3, 2, 5))
+    assert np.isclose(wider, np.hypot(2024 + 781 - 2115, 135 + 25 - 2115))
+
+    # But never beyond the POM image
+    assert sc.footprint_radius('SUBSTRIP96', (8001, 8001)) == sc.footprint_radius()
+
+
+def test_cached_loaders():
+    """Test the PSF loaders keep one cache each"""
+    for loader in [sc.get_spotmask, sc.get_psf_image, sc.get_background_pattern, sc.get_psf_support]:
+        assert hasattr(loader, 'cache_info')
+        assert not hasattr(loader.__wrapped__, 'cache_info')
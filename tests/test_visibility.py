@@ -0,0 +1,44 @@
+"""
+Tests for visibility.py module
+"""
+import numpy as np
+import pytest
+
+from grism_overlap import visibility as vis
+
+
+def test_sun_radec():
+    """Test the Sun position at J2000 and its motion over a year"""
+    ra, dec = vis.sun_radec(2451545.)
+    assert ra == pytest.approx(281.29, abs=0.02)
+    assert dec == pytest.approx(-23.03, abs=0.02)
+
+    ra, dec = vis.sun_radec(2451545. + np.arange(366))
+    assert ra.shape == (366,)
+    assert dec.max() == pytest.approx(23.44, abs=0.01)
+
+
+def test_position_angle():
+    """Test position angles are east of north"""
+    pa, sep = vis.position_angle(10., 0., [10., 11., 10., 9.], [1., 0., -1., 0.])
+    assert np.allclose(pa, [0., 90., 180., 270.])
+    assert np.allclose(sep, 1.)
+
+
+def test_allowed_pas():
+    """Test a target at the ecliptic pole is always visible and one on the ecliptic is not"""
+    jd, elongation, visible, v3pa = vis.visibility(270., 66.56, start=2459580.5, end=2459580.5 + 365)
+    assert np.allclose(elongation, 90., atol=0.1)
+    assert visible.all()
+
+    pas, allowed = vis.allowed_pas(270., 66.56, start='2022-01-01', end='2023-01-01')
+    assert pas.shape == (360,)
+    assert allowed.all()
+
+    jd, elongation, visible, v3pa = vis.visibility(0., 0., start='2022-01-01', end='2023-01-01')
+    assert 0 < visible.sum() < len(jd)
+    pas, allowed = vis.allowed_pas(0., 0., start='2022-01-01', end='2023-01-01')
+    assert 0 < allowed.sum() < 360
+
+    with pytest.raises(ValueError):
+        vis.visibility(0., 0., start='2022-01-01', end='2021-01-01')
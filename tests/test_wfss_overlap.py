@@ -0,0 +1,106 @@
+"""
+Tests for wfss_overlap.py module
+"""
+import numpy as np
+
+from grism_overlap import scene_image as si
+from grism_overlap import wfss_overlap as wo
+from grism_overlap import wfss_scene as ws
+
+
+def test_trace_extent():
+    """Test the trace box follows the PSF support around its centre"""
+    psf = np.zeros((11, 101))
+    psf[4:7, 60:95] = 1.
+    assert wo.trace_extent(psfimage=psf) == (-1, 2, 10, 45)
+
+    boxes = wo.trace_boxes([200., 2180.], [500., 100.], (-1, 2, 10, 45))
+    assert np.array_equal(boxes, [[499, 502, 210, 245], [137, 137, 2185, 2185]])
+
+    # Sources outside the read-out area are not dispersed
+    boxes = wo.trace_boxes([-30., 200.], [500., 2322.], (-1, 2, 10, 45), window=None)
+    assert np.array_equal(boxes, np.zeros((2, 4)))
+
+
+def test_overlap_pairs():
+    """Test the sweep finds the same pairs and areas as checking every pair"""
+    rng = np.random.default_rng(46)
+    xpos, ypos = rng.uniform(0, 2322, 2000), rng.uniform(0, 2322, 2000)
+
+    # Traces along x and along y
+    for extent in [(-3, 4, -150, 40), (-150, 40, -3, 4)]:
+        boxes = wo.trace_boxes(xpos, ypos, extent)
+        first, second, area = wo.overlap_pairs(boxes)
+
+        height = np.minimum(boxes[:, None, 1], boxes[None, :, 1]) - np.maximum(boxes[:, None, 0], boxes[None, :, 0])
+        width = np.minimum(boxes[:, None, 3], boxes[None, :, 3]) - np.maximum(boxes[:, None, 2], boxes[None, :, 2])
+        overlap = (height > 0) & (width > 0)
+        np.fill_diagonal(overlap, False)
+        expected = {(i, j): height[i, j] * width[i, j] for i, j in zip(*np.nonzero(np.triu(overlap)))}
+
+        assert len(expected) > 0
+        assert dict(zip(zip(first.tolist(), second.tolist()), area.tolist())) == expected
+
+    assert len(wo.overlap_pairs(boxes[:1])[0]) == 0
+
+
+def test_overlap_graph():
+    """Test rotating the field moves the traces apart"""
+    psf = np.zeros((5, 201))
+    psf[2, 100:200] = 1.
+    xpos, ypos = np.array([1500., 1550.]), np.array([1600., 1600.])
+    first, second, area = wo.overlap_graph(xpos, ypos, 'F150W', 'GR150R', x0=500, y0=500, psfimage=psf)
+    assert first.tolist() == [0] and second.tolist() == [1] and area.tolist() == [50]
+
+    first, _, _ = wo.overlap_graph(xpos, ypos, 'F150W', 'GR150R', x0=500, y0=500, pa=90., psfimage=psf)
+    assert len(first) == 0
+
+
+def test_source_contamination():
+    """Test the per-source contamination matches dispersing each source alone"""
+    psf = np.zeros((7, 121))
+    psf[2:5, 70:120] = np.random.default_rng(47).random((3, 50))
+    xpos, ypos, flux = np.array([300, 340, 1000, 2180]), np.array([400, 401, 800, 600]), np.array([2., 1., 5., 3.])
+    transmission = np.array([1., 0.5, 1., 1.])
+
+    def disperse(sources):
+        """Place the PSF at each source, as the 'same' mode convolution does"""
+        padded = np.zeros((2322 + 7, 2322 + 121))
+        for n in sources:
+            padded[ypos[n]:ypos[n] + 7, xpos[n]:xpos[n] + 121] += 0.8 * flux[n] * transmission[n] * psf
+        return padded[3:2325, 60:2382]
+
+    frame = disperse([0, 1, 2, 3])
+    ratio = wo.source_contamination(frame, xpos, ypos, flux, psf, transmission=transmission)
+
+    boxes = wo.trace_boxes(xpos, ypos, wo.trace_extent(psfimage=psf))
+    for n in range(3):
+        own = wo.box_sums(disperse([n]), boxes[n:n + 1])[0]
+        assert np.isclose(ratio[n], (wo.box_sums(frame, boxes[n:n + 1])[0] - own) / own)
+    assert ratio[0] > 0 and ratio[1] > 0 and ratio[2] == 0.
+
+    # The last trace falls off the detector
+    assert np.isnan(ratio[3])
+
+    # A source outside the read-out area is not dispersed, even where its
+    # trace box would reach the detector
+    ratio = wo.source_contamination(frame, np.array([300, -30]), np.array([400, 400]), flux[:2], psf)
+    assert ratio[0] > 0 and np.isnan(ratio[1])
+    assert wo.own_flux([-30], [400], [1.], psf, np.array([[397, 404, 137, 200]]))[0] == 0.
+
+
+def test_source_contamination_rotated():
+    """Test an isolated source is not contaminated at any PA"""
+    psf = np.zeros((7, 121))
+    psf[2:5, 70:120] = np.random.default_rng(47).random((3, 50))
+    scene = np.zeros((2400, 2400))
+    scene[1200, 1100] = 3.
+    spotmask = np.ones((2048, 2048))
+
+    for pa in [0., 10., 30., 45.]:
+        rotated = si.rotate_image(scene, pa)
+        frame = ws.wfss_scene(rotated, 'F150W', 'GR150R', 0, 0, psfimage=psf, spotmask=spotmask, dtype='float64')
+        xpos, ypos = si.rotate_positions([1100.], [1200.], pa, shape=scene.shape)
+        stamps = si.rotate_sources([1100.], [1200.], pa, shape=scene.shape)
+        ratio = wo.source_contamination(frame, xpos, ypos, [3.], psf, stamps=stamps)
+        assert abs(ratio[0]) < 1e-4
@@ -2,6 +2,7 @@
 Tests for wfss_scene.py module
 """
 import numpy as np
+from astropy.io import fits
 
 from grism_overlap import wfss_scene as sc
 
@@ -35,3 +36,118 @@ def test_wfss_scene():
     for grism in grisms:
         for filter in filters:
             assert sc.wfss_scene(good_scene, filter, grism, x0, y0).shape == (2322, 2322)
+
+
+def test_wfss_scene_precision():
+    """Test the float32 pipeline stays close to float64"""
+    rng = np.random.default_rng(3)
+    scene = np.full((2322, 2322), 0.1)
+    scene[rng.integers(0, 2322, 200), rng.integers(0, 2322, 200)] = rng.uniform(1e2, 1e6, 200)
+    spotmask = np.ones((2048, 2048))
+    psf = rng.random((41, 201))
+    psf /= psf.sum()
+
+    out32 = sc.wfss_scene(scene, 'F150W', 'GR150R', 0, 0, psfimage=psf, spotmask=spotmask, dtype='float32')
+    out64 = sc.wfss_scene(scene, 'F150W', 'GR150R', 0, 0, psfimage=psf, spotmask=spotmask, dtype='float64')
+    assert out32.dtype == np.float32
+    assert out64.dtype == np.float64
+    assert np.max(np.abs(out32 - out64)) < 1e-5 * np.max(np.abs(out64))
+
+
+def test_wfss_spot_mask():
+    """Test the spot mask covers the detector of any read-out area"""
+    scene = np.ones((4231, 4231))
+    psf = np.zeros((3, 3))
+    psf[1, 1] = 1.
+    spotmask = np.ones((2048, 2048))
+    spotmask[1000:1010, 1000:1010] = 0.
+
+    out = sc.wfss_scene(scene, 'F150W', 'GR150R', 955, 955, psfimage=psf, spotmask=spotmask, throughput=1.)
+    assert np.array_equal(np.argwhere(out < 0.5).min(axis=0), [1137, 1137])
+    assert (out < 0.5).sum() == 100
+
+    transmission = sc.spot_transmission([1140., 1200., 10.], [1140., 1140., 10.], spotmask)
+    assert np.array_equal(transmission, [0., 1., 1.])
+
+
+def test_wfss_scene_multi():
+    """Test one transform per scene matches dispersing each configuration"""
+    rng = np.random.default_rng(48)
+    scene = np.zeros((2400, 2400))
+    scene[rng.integers(0, 2400, 100), rng.integers(0, 2400, 100)] = rng.uniform(1., 100., 100)
+    spotmask = np.ones((2048, 2048))
+    spotmask[500:520, 500:520] = 0.
+    psfimages = {('F150W', 'GR150R'): rng.random((11, 201)), ('F150W', 'GR150C'): rng.random((301, 9)),
+                 ('F200W', 'GR150R'): rng.random((15, 251))}
+    kwargs = {'spotmask': spotmask, 'dtype': 'float64'}
+
+    # One scene, scaled for F200W
+    out = sc.wfss_scene_multi(scene, list(psfimages), 40, 30, scales={'F200W': 2.}, psfimages=psfimages, background=0.1, **kwargs)
+    for (filtername, grismname), psf in psfimages.items():
+        scale = 2. if filtername == 'F200W' else 1.
+        expected = sc.wfss_scene(scale * scene, filtername, grismname, 40, 30, psfimage=psf, background=0.1, **kwargs)
+        assert np.allclose(out[filtername, grismname], expected)
+
+    # A scene per filter
+    out = sc.wfss_scene_multi({'F150W': scene, 'F200W': scene[::-1]}, list(psfimages), 40, 30, psfimages=psfimages, **kwargs)
+    expected = sc.wfss_scene(scene[::-1], 'F200W', 'GR150R', 40, 30, psfimage=psfimages['F200W', 'GR150R'], **kwargs)
+    assert np.allclose(out['F200W', 'GR150R'], expected)
+
+    assert sc.wfss_scene_multi(scene, [('F150W', 'foobar')], 0, 0) is None
+
+
+def test_wfss_scene_dither():
+    """Test a dither sweep matches dispersing each read-out area"""
+    rng = np.random.default_rng(49)
+    scene = np.zeros((2400, 2400))
+    scene[rng.integers(0, 2400, 300), rng.integers(0, 2400, 300)] = rng.uniform(1., 100., 300)
+    scene[1100:1130, 1100:1130] = 5.
+    spotmask = np.ones((2048, 2048))
+    spotmask[950:1010, 960:1000] = 0.
+    spotmask[1500:1505, 200:210] = 0.5
+    psf = rng.random((11, 201))
+    offsets = [(20, 20), (40, 20), (20, 45), (40, 45)]
+    kwargs = {'psfimage': psf, 'spotmask': spotmask, 'dtype': 'float64', 'background': 0.1}
+
+    out = sc.wfss_scene_dither(scene, 'F150W', 'GR150R', offsets, **kwargs)
+    assert out.shape == (4, 2322, 2322)
+    for newimage, (x0, y0) in zip(out, offsets):
+        expected = sc.wfss_scene(scene, 'F150W', 'GR150R', x0, y0, **kwargs)
+        assert np.allclose(newimage, expected, atol=1e-8 * np.max(expected))
+
+    assert sc.wfss_scene_dither(scene, 'F150W', 'GR150R', [(20, 20), (100, 20)], **kwargs) is None
+
+
+def test_wfss_psf_grid(tmp_path, monkeypatch):
+    """Test the field-dependent PSF grid and tiled dispersion"""
+    rng = np.random.default_rng(50)
+    psfs = rng.random((2, 3, 11, 101))
+    ypos, xpos = np.array([0., 2047.]), np.array([0., 1000., 2047.])
+    psffile = str(tmp_path / 'psfgrid.fits')
+    fits.HDUList([fits.PrimaryHDU(psfs), fits.ImageHDU(ypos, name='YPOS'), fits.ImageHDU(xpos, name='XPOS')]).writeto(psffile)
+
+    grid = sc.get_wfss_psf_grid('F150W', 'GR150R', psffile=psffile, dtype='float64')
+    assert np.array_equal(grid[0], psfs)
+    assert np.allclose(sc.interpolate_psf(*grid, 1023.5, 500.), 0.25 * (psfs[0, 0] + psfs[0, 1] + psfs[1, 0] + psfs[1, 1]))
+    assert np.allclose(sc.interpolate_psf(*grid, -500., 3000.), psfs[0, 2])
+    assert sc.tile_psfs(*grid, ntiles=(3, 2)).shape == (3, 2, 11, 101)
+
+    # The same PSF everywhere matches the single PSF
+    spotmask = np.ones((2048, 2048))
+    spotmask[500:520, 500:520] = 0.
+    scene = np.zeros((2322, 2322))
+    scene[rng.integers(0, 2322, 100), rng.integers(0, 2322, 100)] = rng.uniform(1., 100., 100)
+    flat = (np.broadcast_to(psfs[0, 0], psfs.shape), ypos, xpos)
+    kwargs = {'spotmask': spotmask, 'dtype': 'float64', 'background': 0.1}
+    expected = sc.wfss_scene(scene, 'F150W', 'GR150R', 0, 0, psfimage=psfs[0, 0], **kwargs)
+    out = sc.wfss_scene(scene, 'F150W', 'GR150R', 0, 0, psfimage=sc.tile_psfs(*flat), **kwargs)
+    assert np.allclose(out, expected)
+
+    # The cached tile spectra from the grid file, shared with the cached
+    # background
+    monkeypatch.setattr(sc, 'get_spotmask', lambda: spotmask)
+    sc.get_wfss_tile_spectra.cache_clear()
+    out = sc.wfss_scene(scene, 'F150W', 'GR150R', 0, 0, psffile=psffile, field_psf=True, ntiles=(2, 2), dtype='float64',
+                        background=0.1)
+    assert out.shape == (2322, 2322)
+    assert sc.get_wfss_tile_spectra.cache_info().currsize == 1